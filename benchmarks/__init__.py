@@ -0,0 +1,2 @@
+"""Benchmarks of the prediction steps on synthetic density maps, run with
+`python -m benchmarks.run_benchmarks`"""
@@ -0,0 +1,102 @@
+"""Replaces the CNN by confidence maps computed from the ground truth
+
+The stub has the same interface and writes the same files as the
+'cnn.predict_with_module' prediction step, so the post-processing steps can be
+run without TensorFlow and the saved model. Confidences are derived from the
+Ca atoms of the ground truth structure: the Ca confidence is high at the Ca
+atoms, the backbone confidence along the lines between consecutive Ca atoms and
+every voxel of the map gets the secondary structure of its closest Ca atom.
+"""
+
+import mrcfile
+import numpy as np
+from scipy import ndimage
+from scipy.spatial import cKDTree
+from postprocessing.pdb_reader_writer import PDB_Reader_Writer
+from .synthetic_map import get_indices, write_map
+
+RESOURCE_CLASS = 'cpu'
+
+# Secondary structure classes in the order the CNN predicts them
+LOOP, SHEET, HELIX = 0, 1, 2
+
+
+def update_paths(paths):
+    paths['loops_confidence'] = paths['output'] + 'loops_confidence.mrc'
+    paths['sheet_confidence'] = paths['output'] + 'sheet_confidence.mrc'
+    paths['helix_confidence'] = paths['output'] + 'helix_confidence.mrc'
+    paths['backbone_confidence'] = paths['output'] + 'backbone_confidence.mrc'
+    paths['ca_confidence'] = paths['output'] + 'ca_confidence.mrc'
+
+
+def execute(paths):
+    with mrcfile.open(paths['normalized_map'], mode='r') as normalized_map:
+        mask = normalized_map.data > 0
+        origin = normalized_map.header.origin.item(0)
+
+    chains = PDB_Reader_Writer().read_pdb(paths['ground_truth'])
+    for key, image in make_confidence_maps(mask, origin, chains).items():
+        write_map(paths[key], image, origin)
+
+
+def make_confidence_maps(mask, origin, chains, seed=0):
+    """Returns dict from the path keys of the confidence maps to the maps
+
+    Parameters
+    ----------
+    mask: np.ndarray
+        Boolean (z, y, x) array of the voxels of the normalized map which are
+        larger than zero, all confidences outside of it are zero
+
+    origin: tuple
+        Origin of the map as (x, y, z) tuple
+
+    chains: list
+        'Chain' objects of the ground truth structure
+
+    seed: int
+        Seed of the noise added to the Ca confidence, which keeps the
+        confidence walk from having to break ties between equal confidences
+    """
+    shape = mask.shape
+    ca_points = np.zeros(shape)
+    backbone_points = np.zeros(shape, dtype=bool)
+    cas = list()
+    secondary_structure = list()
+    for chain in chains:
+        coordinates = chain.coordinates.astype(np.float64)
+        np.add.at(ca_points, get_indices(coordinates, origin, shape), 1)
+        # Points along the lines between consecutive Ca atoms
+        steps = np.linspace(0, 1, 8)[:, np.newaxis, np.newaxis]
+        lines = coordinates[:-1] + steps * (coordinates[1:] - coordinates[:-1])
+        backbone_points[get_indices(lines.reshape((-1, 3)), origin, shape)] = True
+
+        labels = np.full(len(chain), LOOP, dtype=np.int8)
+        for start, end in chain.sheets.tolist():
+            labels[start:end + 1] = SHEET
+        for start, end in chain.helices.tolist():
+            labels[start:end + 1] = HELIX
+        cas.append(coordinates)
+        secondary_structure.append(labels)
+
+    rng = np.random.RandomState(seed)
+    ca_image = ndimage.gaussian_filter(ca_points, 1.0) * 100 + rng.rand(*shape) * 0.5
+    backbone_mask = ndimage.binary_dilation(backbone_points) & mask
+    ca_image = np.where(backbone_mask | ((ca_image > 2) & mask), ca_image + 5, 0)
+    backbone_image = np.where(backbone_mask, 4 + ndimage.gaussian_filter(backbone_points.astype(np.float64), 1.0) * 10,
+                              0)
+
+    # Every voxel gets the secondary structure of its closest Ca atom
+    secondary_image = np.full(shape, -1, dtype=np.int8)
+    if len(cas) > 0:
+        voxels = np.argwhere(mask)
+        _, closest = cKDTree(np.concatenate(cas)).query(voxels[:, ::-1] + origin)
+        secondary_image[mask] = np.concatenate(secondary_structure)[closest]
+
+    return {
+        'loops_confidence': secondary_image == LOOP,
+        'sheet_confidence': secondary_image == SHEET,
+        'helix_confidence': secondary_image == HELIX,
+        'backbone_confidence': backbone_image,
+        'ca_confidence': ca_image
+    }
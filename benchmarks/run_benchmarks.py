@@ -0,0 +1,217 @@
+"""Benchmarks the prediction steps on synthetic density maps
+
+For every number of copies a synthetic density map of that many copies of the
+structure is generated and all prediction steps after the Chimera steps are run
+on it several times, the CNN being replaced by 'cnn_stub'. Every step is
+measured on its own, with the results of the previous steps already written,
+and the whole run is measured as 'end_to_end'. The median wall time is used as
+latency, the number of voxels of the map per second of it as throughput.
+
+Results are written to a JSON file and compared with a baseline file of an
+earlier run. A step regresses if its wall time or peak memory exceeds the
+baseline by more than the tolerance.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import mrcfile
+import numpy as np
+import preprocessing as pre
+import postprocessing as post
+from postprocessing import instrumentation
+from postprocessing.progress import ProgressReporter, set_reporter
+from . import cnn_stub, synthetic_map
+
+# Prediction steps which are benchmarked, in the order they are run
+BENCHMARK_PIPELINE = [
+    pre.normalize_map,
+    cnn_stub,
+    post.build_backbone_trace,
+    post.helix_refinement,
+    post.remove_duplicates,
+    post.merge_chains
+]
+
+END_TO_END = 'end_to_end'
+
+# Differences to the baseline below these values are never regressions, so
+# steps which only take a few milliseconds do not fail because of noise
+MIN_DIFFERENCES = {
+    'wall_time': 0.1,
+    'peak_rss': 16 * 2 ** 20
+}
+
+
+def run_benchmarks(pdb_file, output_path, copies_list=(1,), repeat=3, resolution=5.0):
+    """Runs the benchmarks and returns list of result dicts, one for every
+    step and number of copies
+
+    Parameters
+    ----------
+    pdb_file: str
+        Path of the pdb file the synthetic maps are generated from
+
+    output_path: str
+        Path of the folder where the maps and the results of the prediction
+        steps are stored
+
+    copies_list: list
+        Numbers of copies of the structure the benchmarked maps contain
+
+    repeat: int
+        Number of times every benchmark is run
+
+    resolution: float
+        Resolution of the synthetic maps in Angstrom
+    """
+    set_reporter(ProgressReporter(quiet=True))
+    results = list()
+    for copies in copies_list:
+        map_path = output_path + 'copies_' + str(copies) + '/'
+        inputs = synthetic_map.generate(pdb_file, map_path, copies, resolution)
+        with mrcfile.open(inputs['cleaned_map'], mode='r') as density:
+            voxels = int(density.data.size)
+
+        spans = list()
+        for _ in range(repeat):
+            # Results of earlier runs are removed, so no step resumes them
+            shutil.rmtree(map_path + 'run/', ignore_errors=True)
+            run_pipeline(dict(inputs), map_path + 'run/', spans)
+
+        for stage in [step.__name__.split('.')[-1] for step in BENCHMARK_PIPELINE] + [END_TO_END]:
+            results.append(summarize([span for span in spans if span.stage == stage], stage, copies, voxels))
+
+    return results
+
+
+def run_pipeline(paths, output_path, spans):
+    """Runs all prediction steps of the 'BENCHMARK_PIPELINE' and appends their
+    spans and the span of the whole run to 'spans'"""
+    step_spans = list()
+    with instrumentation.measure(END_TO_END, None, spans):
+        for prediction_step in BENCHMARK_PIPELINE:
+            step_name = prediction_step.__name__.split('.')[-1]
+            paths['output'] = output_path + prediction_step.__name__.split('.')[0] + '/'
+            os.makedirs(paths['output'], exist_ok=True)
+            prediction_step.update_paths(paths)
+            with instrumentation.measure(step_name, None, step_spans):
+                prediction_step.execute(paths)
+
+    # Every step resets the peak memory, so the peak of the whole run is the
+    # largest peak of its steps
+    spans[-1] = spans[-1]._replace(peak_rss=max_or_none(span.peak_rss for span in step_spans))
+    spans += step_spans
+
+
+def summarize(spans, stage, copies, voxels):
+    """Returns result dict of the spans of a step"""
+    wall_time = float(np.median([span.wall_time for span in spans]))
+
+    return {
+        'stage': stage,
+        'copies': copies,
+        'voxels': voxels,
+        'wall_time': wall_time,
+        'wall_times': [span.wall_time for span in spans],
+        'cpu_time': float(np.median([span.cpu_time for span in spans])),
+        'peak_rss': max_or_none(span.peak_rss for span in spans),
+        'read_bytes': max_or_none(span.read_bytes for span in spans),
+        'written_bytes': max_or_none(span.written_bytes for span in spans),
+        'throughput': voxels / wall_time if wall_time > 0 else None
+    }
+
+
+def max_or_none(values):
+    values = [value for value in values if value is not None]
+    return max(values) if values else None
+
+
+def compare(results, baseline, tolerance):
+    """Returns list of messages describing the results which exceed the
+    result of the same step and number of copies in the baseline by more than
+    'tolerance' times the baseline"""
+    baseline_results = {(result['stage'], result['copies']): result for result in baseline}
+    regressions = list()
+    for result in results:
+        baseline_result = baseline_results.get((result['stage'], result['copies']))
+        if baseline_result is None:
+            continue
+
+        for metric, min_difference in MIN_DIFFERENCES.items():
+            value, baseline_value = result[metric], baseline_result.get(metric)
+            if value is None or baseline_value is None:
+                continue
+            if value > baseline_value * (1 + tolerance) and value - baseline_value > min_difference:
+                regressions.append('%s (%d copies): %s %.4g exceeds baseline %.4g by %.0f%%' %
+                                   (result['stage'], result['copies'], metric, value, baseline_value,
+                                    100 * (value / baseline_value - 1)))
+
+    return regressions
+
+
+def format_results(results):
+    """Formats results as table"""
+    lines = ['%-22s %6s %10s %10s %10s %12s' % ('Stage', 'Copies', 'Wall (s)', 'CPU (s)', 'Peak (MB)', 'Mvoxels/s')]
+    for result in results:
+        lines.append('%-22s %6d %10.3f %10.3f %10s %12s' %
+                     (result['stage'], result['copies'], result['wall_time'], result['cpu_time'],
+                      '%.1f' % (result['peak_rss'] / 2 ** 20) if result['peak_rss'] is not None else '-',
+                      '%.3f' % (result['throughput'] / 1e6) if result['throughput'] is not None else '-'))
+
+    return '\n'.join(lines)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the prediction steps on synthetic density maps')
+    parser.add_argument('pdb_file', type=str, help='PDB file the synthetic density maps are generated from')
+    parser.add_argument('output', type=str, help='Folder where the maps and benchmark results will be stored')
+    parser.add_argument('-n', '--copies', metavar='N', type=int, nargs='+', default=[1],
+                        help='Numbers of copies of the structure the benchmarked maps contain')
+    parser.add_argument('-r', '--repeat', metavar='N', type=int, default=3,
+                        help='Number of times every benchmark is run')
+    parser.add_argument('--resolution', metavar='A', type=float, default=5.0,
+                        help='Resolution of the synthetic maps in Angstrom')
+    parser.add_argument('-b', '--baseline', metavar='BASELINE_FILE', type=str,
+                        help='JSON file of an earlier run the results are compared with')
+    parser.add_argument('-t', '--tolerance', metavar='T', type=float, default=0.2,
+                        help='Fraction by which a step may exceed the baseline before it counts as regression')
+    parser.add_argument('-u', '--update_baseline', action='store_const', const=True, default=False,
+                        help='Write the results to the baseline file instead of comparing them')
+    args = parser.parse_args(args)
+
+    args.output += '/' if args.output[-1] != '/' else ''
+
+    results = run_benchmarks(args.pdb_file, args.output, args.copies, args.repeat, args.resolution)
+    print(format_results(results))
+
+    report = {
+        'pdb_file': args.pdb_file,
+        'resolution': args.resolution,
+        'repeat': args.repeat,
+        'results': results
+    }
+    with open(args.output + 'benchmarks.json', 'w') as f:
+        json.dump(report, f, indent=4)
+
+    if args.baseline is None:
+        return
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=4)
+        return
+
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f)['results'], args.tolerance)
+
+    for regression in regressions:
+        print('Regression: ' + regression)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""Generates synthetic density maps from pdb files
+
+The density map is the sum of Gaussians at all atoms of the structure, similar
+to the maps Chimera's molmap command creates, on a grid with a voxel size of 1.
+Larger maps are created by placing several copies of the structure next to each
+other. The Ca atoms of the copies are written as ground truth pdb file, including
+the secondary structure of the original structure.
+"""
+
+import os
+import mrcfile
+import numpy as np
+from scipy import ndimage
+from postprocessing import pdb_io
+from postprocessing.pdb_reader_writer import PDB_Reader_Writer, Chain
+
+# Consecutive Ca atoms which are further apart belong to different chains
+MAX_CA_DISTANCE = 4.2
+
+# Empty space around the structure and between its copies in Angstrom
+PADDING = 10
+
+
+def generate(pdb_file, output_path, copies=1, resolution=5.0):
+    """Writes synthetic density map, its threshold and the ground truth
+    structure to the output path
+
+    Parameters
+    ----------
+    pdb_file: str
+        Path of the pdb file of the structure
+
+    output_path: str
+        Path of the folder the files are written to
+
+    copies: int
+        Number of copies of the structure the map contains
+
+    resolution: float
+        Resolution of the map in Angstrom
+
+    Returns
+    ----------
+    paths: dict
+        Paths of the density map as 'cleaned_map', its threshold as
+        'threshold' and the ground truth structure as 'ground_truth'
+    """
+    os.makedirs(output_path, exist_ok=True)
+    coordinates, chains = read_structure(pdb_file)
+    coordinates, chains = replicate(coordinates, chains, copies)
+    density, origin = make_density_map(coordinates, resolution)
+
+    paths = {
+        'cleaned_map': output_path + 'density.mrc',
+        'threshold': output_path + 'threshold',
+        'ground_truth': output_path + 'structure.pdb'
+    }
+    write_map(paths['cleaned_map'], density, origin)
+    with open(paths['threshold'], 'w') as f:
+        f.write(str(get_threshold(density, origin, chains)))
+    PDB_Reader_Writer().write_pdb(chains, paths['ground_truth'])
+
+    return paths
+
+
+def read_structure(pdb_file):
+    """Returns (N, 3) coordinates of all atoms of the pdb file and its Ca atoms
+    as list of 'Chain' objects with secondary structure"""
+    records = pdb_io.read_pdb(pdb_file)
+    atoms = records.atoms
+    cas = atoms[np.char.startswith(atoms['name'], b'CA ', start=1)]
+    coordinates = cas['coordinates']
+
+    # HELIX and SHEET records are matched by their residue numbers only
+    helix = np.zeros(len(cas), dtype=bool)
+    for start, end in records.helices.tolist():
+        helix |= (cas['residue'] >= start) & (cas['residue'] <= end)
+    sheet = np.zeros(len(cas), dtype=bool)
+    for start, end in records.sheets.tolist():
+        sheet |= (cas['residue'] >= start) & (cas['residue'] <= end) & ~helix
+
+    # Chains are split at TER records and at gaps between Ca atoms
+    breaks = np.flatnonzero((np.diff(cas['segment']) != 0) |
+                            (np.linalg.norm(np.diff(coordinates, axis=0), axis=1) > MAX_CA_DISTANCE)) + 1
+    chains = [Chain(chain_coordinates, get_intervals(chain_helix), get_intervals(chain_sheet))
+              for chain_coordinates, chain_helix, chain_sheet
+              in zip(np.split(coordinates, breaks), np.split(helix, breaks), np.split(sheet, breaks))
+              if len(chain_coordinates) > 0]
+
+    return atoms['coordinates'], chains
+
+
+def get_intervals(mask):
+    """Returns (K, 2) array of the first and last index of every run of true
+    values of the mask"""
+    changes = np.flatnonzero(np.diff(np.concatenate(([0], mask.astype(np.int8), [0]))))
+
+    return changes.reshape((-1, 2)) - [0, 1]
+
+
+def replicate(coordinates, chains, copies):
+    """Returns atom coordinates and chains of 'copies' copies of the structure
+    placed next to each other along the x axis"""
+    width = coordinates[:, 0].max() - coordinates[:, 0].min() + PADDING
+    all_coordinates = list()
+    all_chains = list()
+    for copy in range(copies):
+        shift = np.array([copy * width, 0, 0])
+        all_coordinates.append(coordinates + shift)
+        all_chains += [Chain(chain.coordinates + shift, chain.helices, chain.sheets) for chain in chains]
+
+    return np.concatenate(all_coordinates), all_chains
+
+
+def make_density_map(coordinates, resolution):
+    """Returns density map of the atoms as (z, y, x) array and its origin as
+    (x, y, z) tuple"""
+    origin = np.floor(coordinates.min(axis=0)) - PADDING
+    shape = (np.ceil(coordinates.max(axis=0) - origin).astype(int) + PADDING + 1)[::-1]
+
+    density = np.zeros(shape, dtype=np.float32)
+    np.add.at(density, get_indices(coordinates, origin, shape), 1)
+    # Width of the Gaussians like Chimera's molmap command uses them
+    density = ndimage.gaussian_filter(density, 0.225 * resolution)
+
+    return density, tuple(origin.tolist())
+
+
+def get_threshold(density, origin, chains):
+    """Returns threshold below which the density map is set to zero, which is
+    low enough to keep the density of all Ca atoms"""
+    cas = np.concatenate([chain.coordinates for chain in chains])
+
+    return 0.5 * float(np.percentile(density[get_indices(cas, origin, density.shape)], 5))
+
+
+def get_indices(coordinates, origin, shape):
+    """Returns index tuple of the voxels of (N, 3) coordinates in a map with
+    voxel size 1"""
+    indices = np.round(np.asarray(coordinates, dtype=np.float64) - origin).astype(int)[:, ::-1]
+    indices = np.clip(indices, 0, np.array(shape) - 1)
+
+    return tuple(indices.T)
+
+
+def write_map(file_name, data, origin):
+    """Writes map with the origin as mrc file"""
+    with mrcfile.new(file_name, overwrite=True) as mrc:
+        mrc.set_data(np.asarray(data, dtype=np.float32))
+        mrc.header.origin = origin
+        mrc.update_header_stats()
@@ -22,6 +22,12 @@ import prediction as pre
 __author__ = 'Moritz Spencer'
 
 
+RESOURCE_CLASS = 'tf'
+
+# Files the CNN is loaded from, relative to this module
+DATA_FILES = ['saved_module/5-7A_Full_SS_Combo/']
+
+
 def update_paths(paths):
     paths['loops_confidence'] = paths['output'] + 'loops_confidence.mrc'
     paths['sheet_confidence'] = paths['output'] + 'sheet_confidence.mrc'
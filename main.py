@@ -10,17 +10,25 @@ if __name__ == '__main__':
     parser.add_argument('-s', '--skip', metavar='N', type=int, nargs=1, default=[0],
                         help='Number of prediction steps that should be skipped')
     parser.add_argument('-c', '--check_existing', action='store_const', const=True, default=False,
-                        help='Check if results already exists and if so skip prediction step')
+                        help='Skip prediction steps whose results already exist and whose inputs did not change since')
     parser.add_argument('-d', '--hidedusts', metavar='HideDusts', type=str,
                         help='JSON file which contains the hide dust sizes')
     parser.add_argument('-b', '--debug', action='store_const', const=True, default=False,
-                        help='Enter debug mode, where mrc files are kept, otherwise mrc files are deleted at end to save memory')
+                        help='Enter debug mode, where mrc files are kept, otherwise mrc files are deleted at end to save memory. '
+                             'Intermediate results of the post-processing are also written as pdb files')
     parser.add_argument('-p', '--chimera_path', metavar='Links', type=str,
                         help='location that identifies where the chimera symbolic link is')
+    parser.add_argument('-w', '--component_walks', action='store_const', const=True, default=False,
+                        help='Trace disconnected components of the backbone prediction in parallel')
+    parser.add_argument('-e', '--peak_seeding', action='store_const', const=True, default=False,
+                        help='Extract Ca atoms as peaks of the Ca confidence instead of using the confidence walk')
+    parser.add_argument('-q', '--quiet', action='store_const', const=True, default=False,
+                        help='Do not log the progress of the prediction steps')
 
     args = parser.parse_args()
 
     args.input += '/' if args.input[-1] != '/' else ''
     args.output += '/' if args.output[-1] != '/' else ''
 
-    run_predictions(args.input, args.output, args.thresholds, args.skip[0], args.check_existing, args.hidedusts, args.debug, args.chimera_path)
+    run_predictions(args.input, args.output, args.thresholds, args.skip[0], args.check_existing, args.hidedusts, args.debug, args.chimera_path,
+                    args.component_walks, args.peak_seeding, args.quiet)
@@ -8,22 +8,39 @@ the actual backbone in the protein, and the 'Graph' class through which the
 traces are refined.
 """
 
+import os
 import mrcfile
 import numpy as np
 from copy import deepcopy
 import math
 from collections import deque
-from .pdb_reader_writer import PDB_Reader_Writer
+from scipy import ndimage
+from scipy.spatial import cKDTree
+from . import pdb_io
+from .pdb_reader_writer import PDB_Reader_Writer, Chain
+from .walk_journal import WalkJournal
+from .trace_set import TraceSet
+from .parallel import parallel_map
+from .progress import get_reporter
 
 __author__ = 'Spencer Moritz'
 
 
+RESOURCE_CLASS = 'cpu'
+
+
 def update_paths(paths):
     paths['first_confidence_walk'] = paths['output'] + 'first_confidence_walk.pdb'
     paths['second_confidence_walk'] = paths['output'] + 'second_confidence_walk.pdb'
     paths['refined_backbone'] = paths['output'] + 'refined_backbone.mrc'
     paths['final_ca_prediction'] = paths['output'] + 'final_ca_prediction.pdb'
-    paths['traces'] = paths['output'] + 'traces.pdb'
+    paths['traces'] = paths['output'] + 'traces.npz'
+
+
+def get_fingerprint(paths):
+    """Returns the options the traces depend on, see
+    'prediction.stage_cache'"""
+    return {option: paths.get(option, False) for option in ('component_walks', 'peak_seeding', 'debug')}
 
 
 def execute(paths):
@@ -34,70 +51,184 @@ def execute(paths):
     sheet_image = mrcfile.open(paths['sheet_confidence'], mode='r').data
     backbone_image = mrcfile.open(paths['backbone_confidence'], mode='r').data
     origin = normalized_map.header.origin.item(0)
+    walk = peak_walk if paths.get('peak_seeding', False) else confidence_walk
+
+    if paths.get('component_walks', False):
+        # Disconnected components of the backbone prediction never exchange
+        # traces, so every component is traced in its own process
+        first_ca_sets, new_backbone, second_ca_sets, graph = trace_components(ca_image, backbone_image, origin, paths,
+                                                                              walk)
+        write_refined_backbone(paths['refined_backbone'], new_backbone, normalized_map)
+        print_ca_sets(first_ca_sets, origin, paths['first_confidence_walk'])
+    else:
+        resume = False
+        if walk is confidence_walk and os.path.isfile(paths['refined_backbone']):
+            # If the second walk of the same images was interrupted, the first
+            # walk and the refined backbone are already complete
+            new_backbone = deepcopy(mrcfile.open(paths['refined_backbone'], mode='r').data)
+            resume = WalkJournal(paths['second_confidence_walk'],
+                                 WalkJournal.hash_images(ca_image, backbone_image, new_backbone)).exists()
+
+        if not resume:
+            # This is the major Post-Processing step where the full backbone trace
+            # is built. This may take a few minutes to execute.
+            first_ca_sets = walk(deepcopy(ca_image), backbone_image, paths['first_confidence_walk'])
+
+            graph = build_graph(first_ca_sets, ca_image, origin, remove_tail_loops=False)
+            new_backbone = graph.refine_backbone(backbone_image, origin)
+            write_refined_backbone(paths['refined_backbone'], new_backbone, normalized_map)
+
+            # The walk is only written out as an artifact, the graph is built
+            # directly from the traces
+            print_ca_sets(first_ca_sets, origin, paths['first_confidence_walk'])
+
+        # The refined backbone depends on the backbone prediction, so both are
+        # part of the fingerprint of the second walk
+        second_ca_sets = walk(deepcopy(ca_image), new_backbone, paths['second_confidence_walk'],
+                              WalkJournal.hash_images(ca_image, backbone_image, new_backbone))
+
+        graph = build_graph(second_ca_sets, ca_image, origin, remove_tail_loops=True)
+
+    # Now print the final graphs to output
+    graph.print_graph(paths['final_ca_prediction'])
+    PDB_Reader_Writer().write_chains(graph.get_chains(sheet_image, helix_image, origin), paths['traces'],
+                                     paths.get('debug', False))
+    print_ca_sets(second_ca_sets, origin, paths['second_confidence_walk'])
 
-    # This is the major Post-Processing step where the full backbone trace is
-    # built. This may take a few minutes to execute.
-    confidence_walk(deepcopy(ca_image), origin, backbone_image, paths['first_confidence_walk'])
-
-    # Build graph and then clean it to improve final output.
-    graph = make_graph(paths['first_confidence_walk'])
-    graph.edge_check()
-    graph.remove_side_chains()
-    graph.remove_loops(ca_image, origin)
-    graph.remove_single_ends()
-    graph.remove_empty_nodes()
-    graph.remove_side_chains()
-    graph.remove_loops(ca_image, origin)
-    graph.remove_single_ends()
-    graph.remove_empty_nodes()
 
-    new_backbone = graph.refine_backbone(backbone_image, origin)
-    with mrcfile.new(paths['refined_backbone'], overwrite=True) as mrc:
+def write_refined_backbone(file_name, new_backbone, normalized_map):
+    """Writes refined backbone image with the header origin of the normalized
+    map"""
+    with mrcfile.new(file_name, overwrite=True) as mrc:
         mrc.set_data(new_backbone)
         mrc.header.origin = normalized_map.header.origin.item(0)
         mrc.update_header_stats()
         mrc.close()
 
-    confidence_walk(deepcopy(ca_image), origin, new_backbone, paths['second_confidence_walk'])
-
-    # Build graph and then clean it to improve final output.
-    graph = make_graph(paths['second_confidence_walk'])
-    graph.edge_check()
-    graph.remove_side_chains()
-    graph.remove_loops(ca_image, origin)
-    graph.remove_single_ends()
-    graph.remove_empty_nodes()
-    graph.remove_side_chains()
-    graph.remove_loops(ca_image, origin)
-    graph.remove_single_ends()
-    graph.remove_tail_loops()
-    graph.remove_empty_nodes()
 
-    # Now print the final graphs to output
-    graph.print_graph(paths['final_ca_prediction'])
-    graph.print_traces(sheet_image, helix_image, origin, paths['traces'])
+def trace_components(ca_image, backbone_image, origin, paths, walk):
+    """Runs both confidence walks and the graph cleanup for every connected
+    component of the backbone prediction in a process pool
+
+    Returns the traces of the first walk, the refined backbone image, the
+    traces of the second walk and the cleaned graph of the whole map. Traces
+    are returned in voxel indices of the full map. 'walk' is either
+    'confidence_walk' or 'peak_walk'.
+    """
+    components = find_components(ca_image, backbone_image)
+    params_list = list()
+    for label, (box, ca_crop, backbone_crop) in enumerate(components, 1):
+        # Shift the origin so the crop is placed at the same coordinates
+        crop_origin = (origin[0] + box[2].start, origin[1] + box[1].start, origin[2] + box[0].start)
+        params_list.append((walk, ca_crop, backbone_crop, crop_origin,
+                            paths['first_confidence_walk'] + '.' + str(label),
+                            paths['second_confidence_walk'] + '.' + str(label)))
+
+    first_ca_sets = list()
+    second_ca_sets = list()
+    new_backbone = np.zeros(np.shape(backbone_image), dtype=np.float32)
+    graph = Graph()
+    for (box, _, _), result in zip(components, parallel_map(trace_component, params_list)):
+        component_first_ca_sets, component_backbone, component_second_ca_sets, component_graph = result
+        start = [box[0].start, box[1].start, box[2].start]
+        first_ca_sets += shift_ca_sets(component_first_ca_sets, start)
+        second_ca_sets += shift_ca_sets(component_second_ca_sets, start)
+        # Components do not share any backbone voxels
+        new_backbone[box] += component_backbone
+        for node in component_graph.nodes.values():
+            graph.add_node(node)
+
+    return first_ca_sets, new_backbone, second_ca_sets, graph
+
+
+def trace_component(params):
+    """Traces a single component, see 'trace_components'"""
+    walk, ca_image, backbone_image, origin, first_walk_file, second_walk_file = params
+
+    first_ca_sets = walk(deepcopy(ca_image), backbone_image, first_walk_file)
+    graph = build_graph(first_ca_sets, ca_image, origin, remove_tail_loops=False)
+    new_backbone = graph.refine_backbone(backbone_image, origin)
+
+    second_ca_sets = walk(deepcopy(ca_image), new_backbone, second_walk_file)
+    graph = build_graph(second_ca_sets, ca_image, origin, remove_tail_loops=True)
+
+    return first_ca_sets, new_backbone, second_ca_sets, graph
+
+
+def find_components(ca_image, backbone_image, margin=5):
+    """Splits the prediction into the connected components of the backbone
+    prediction
+
+    Ca voxels outside of the backbone prediction are assigned to the closest
+    component. Every component is returned as (box, ca_crop, backbone_crop)
+    tuple, where 'box' is the tuple of slices of its bounding box enlarged by
+    'margin' voxels and the crops only contain the voxels of the component.
+    """
+    labels, num_components = ndimage.label(backbone_image > 0)
+    if num_components == 0:
+        return list()
+
+    indices = ndimage.distance_transform_edt(labels == 0, return_distances=False, return_indices=True)
+    ca_labels = np.where(ca_image > 0, labels[tuple(indices)], 0)
+    component_labels = np.where(labels > 0, labels, ca_labels)
+
+    components = list()
+    for label, box in enumerate(ndimage.find_objects(component_labels), 1):
+        box = tuple(slice(max(s.start - margin, 0), min(s.stop + margin, size))
+                    for s, size in zip(box, np.shape(backbone_image)))
+        ca_crop = np.where(component_labels[box] == label, ca_image[box], 0).astype(np.float32)
+        backbone_crop = np.where(labels[box] == label, backbone_image[box], 0).astype(np.float32)
+        components.append((box, ca_crop, backbone_crop))
+
+    return components
 
 
-def confidence_walk(prediction_image, offset, backbone_image, output_file):
+def shift_ca_sets(set_of_ca_sets, start):
+    """Moves traces of a cropped image into the voxel indices of the full
+    image"""
+    return [[[ca[0] + start[0], ca[1] + start[1], ca[2] + start[2]] for ca in ca_set] for ca_set in set_of_ca_sets]
+
+
+def confidence_walk(prediction_image, backbone_image, output_file, fingerprint=None):
     """ It produces a series of traces representative of the protein's backbone
     structure
 
     This is the main function used for the path-walking.
 
     prediction_image: the Ca-confidence 3D image.
-    offset: A 3x1 vectors containing the x, y, z offset of the original .PDB image.
-    pdbId: ID of the given protein, used to prefix the file name when printing.
-    ss_image: A 3D image containing the a-helix confidence image.
     backbone_image: A 3D image containing the backbone confidence prediction of the protein.
+    output_file: Path of the walk's pdb artifact, the journal is stored next to it.
+    fingerprint: Fingerprint of the journal, defaults to the hash of both images.
     The primary loop of this function path-walks the prediction image along the backbone
     prediction. It finds areas of high confidence for Ca atoms and places an atom at each
     location. Once each trace has been founds, this function connects each trace and
-    then prints the final graph to a file for further processing.
+    returns the final set of traces as 'TraceSet' for further processing.
+    Every iteration is recorded in a journal next to the output file, so an
+    interrupted walk resumes from its last snapshot when it is started again.
     """
     num_ca_edges_hash = np.zeros((np.shape(prediction_image)))
     untouched_prediction = deepcopy(prediction_image)
-    set_of_ca_sets = list()
-    for index in range(2436111 + 1):
+    if fingerprint is None:
+        fingerprint = WalkJournal.hash_images(prediction_image, backbone_image)
+
+    # Resume from the journal if a previous walk of the same images was
+    # interrupted
+    journal = WalkJournal(output_file, fingerprint)
+    restored_ca_sets, start_index, entries = journal.restore(prediction_image, num_ca_edges_hash)
+    set_of_ca_sets = TraceSet(restored_ca_sets)
+    for index, location, neighbor in entries:
+        update_confidence_image(prediction_image, num_ca_edges_hash, location)
+        if neighbor is not None:
+            update_confidence_image(prediction_image, num_ca_edges_hash, neighbor)
+            update_ca_sets(set_of_ca_sets, location, neighbor)
+        start_index = index + 1
+
+    # Every edge adds a single Ca atom to a trace, or two when it starts one
+    edges_placed = sum(len(ca_set) - 1 for ca_set in set_of_ca_sets)
+    reporter = get_reporter()
+    reporter.start('confidence_walk')
+
+    for index in range(start_index, 2436111 + 1):
         # Find and update for the high-confident location
         location = find_highest_confidence_ca(prediction_image, set_of_ca_sets)
         if location is None:
@@ -109,31 +240,180 @@ def confidence_walk(prediction_image, offset, backbone_image, output_file):
         if neighbor is not None:
             update_confidence_image(prediction_image, num_ca_edges_hash, neighbor)
             update_ca_sets(set_of_ca_sets, location, neighbor)
-            print('Placed Edge: ' + str(index + 1))
+            edges_placed += 1
+
+        if reporter.is_due('confidence_walk'):
+            reporter.update('confidence_walk', edges_placed, count_remaining_voxels(prediction_image))
 
-        if index % 10 == 0:
-            print_ca_sets(set_of_ca_sets, offset, output_file)
+        journal.record(index, location, neighbor)
+        if (index + 1) % journal.snapshot_interval == 0:
+            journal.snapshot(index + 1, set_of_ca_sets, prediction_image, untouched_prediction, num_ca_edges_hash)
+
+    reporter.finish('confidence_walk', edges_placed, count_remaining_voxels(prediction_image))
 
     massage_ends(set_of_ca_sets)
     overlay_cas(set_of_ca_sets)
 
-    print_ca_sets(set_of_ca_sets, offset, output_file)  # Final print
+    journal.remove()
+
+    return set_of_ca_sets
+
+
+def build_graph(set_of_ca_sets, ca_image, origin, remove_tail_loops):
+    """Build graph from the traces and then clean it to improve final output"""
+    graph = Graph.from_traces(set_of_ca_sets, origin)
+    graph.cleanup(ca_image, origin, remove_tail_loops)
+
+    return graph
+
+
+def peak_walk(prediction_image, backbone_image, output_file, fingerprint=None):
+    """Alternative to 'confidence_walk' which extracts all Ca candidates at
+    once instead of finding them one at a time
+
+    The Ca candidates are the local maxima of the Ca-confidence image which
+    are above the quitting threshold of the walk and at least 3A apart.
+    Candidates which are 3A to 4.5A apart are connected by edges scored with
+    the backbone density between them. The traces are then walked greedily
+    over these edges, starting from the candidate with the highest
+    confidence. The walk is fast enough to not be journaled, so 'output_file'
+    and 'fingerprint' are unused and only accepted to make both walks
+    interchangeable.
+    """
+    reporter = get_reporter()
+    reporter.start('peak_walk')
+    peaks = find_ca_peaks(prediction_image)
+    neighbors = find_peak_neighbors(peaks, backbone_image)
+
+    traces = list()
+    trace_indices = np.full(len(peaks), -1)
+    for seed in range(len(peaks)):
+        if trace_indices[seed] != -1:
+            continue
+
+        members = {seed}
+        forward = walk_peaks(peaks, neighbors, trace_indices, members, [seed])
+        backward = walk_peaks(peaks, neighbors, trace_indices, members, forward[:1] + [seed])
+        trace = backward[::-1] + [seed] + forward
+        if len(trace) < 2:
+            continue
+
+        for index in trace:
+            if trace_indices[index] == -1:
+                trace_indices[index] = len(traces)
+        traces.append([peaks[index].tolist() for index in trace])
+
+    reporter.finish('peak_walk', sum(len(trace) - 1 for trace in traces))
+
+    set_of_ca_sets = TraceSet(traces)
+    massage_ends(set_of_ca_sets)
+    overlay_cas(set_of_ca_sets)
+
+    return set_of_ca_sets
+
+
+def find_ca_peaks(prediction_image, min_distance=3, threshold=8):
+    """Returns the local maxima of the prediction image which are above
+    'threshold' as array of voxel indices, sorted by descending confidence
+
+    Maxima on plateaus are suppressed so all peaks are at least 'min_distance'
+    apart."""
+    radius = int(math.ceil(min_distance)) - 1
+    grid = np.indices((2 * radius + 1,) * 3) - radius
+    footprint = np.sum(grid ** 2, axis=0) < min_distance ** 2
+    maxima = ndimage.maximum_filter(prediction_image, footprint=footprint, mode='constant', cval=0)
+    candidates = np.argwhere((prediction_image == maxima) & (prediction_image > threshold))
+    values = prediction_image[tuple(candidates.T)]
+    candidates = candidates[np.argsort(-values, kind='stable')]
+
+    # Only maxima with equal values can be closer than 'min_distance'
+    tree = cKDTree(candidates)
+    suppressed = np.zeros(len(candidates), dtype=bool)
+    peaks = list()
+    for index in range(len(candidates)):
+        if not suppressed[index]:
+            peaks.append(index)
+            suppressed[tree.query_ball_point(candidates[index], np.nextafter(min_distance, 0))] = True
+
+    return candidates[peaks]
+
+
+def find_peak_neighbors(peaks, backbone_image, min_ca_distance=3, max_ca_distance=4.5, steps=10):
+    """Scores all possible edges between the peaks at once
+
+    The score of an edge is the average backbone density sampled along it.
+    Edges which pass through voxels without backbone density are dropped.
+    Returns a list with the (score, index) tuples of the neighbors of every
+    peak, sorted by descending score."""
+    neighbors = [list() for _ in range(len(peaks))]
+    if len(peaks) < 2:
+        return neighbors
+
+    pairs = cKDTree(peaks).query_pairs(max_ca_distance, output_type='ndarray')
+    lengths = np.linalg.norm(peaks[pairs[:, 0]] - peaks[pairs[:, 1]], axis=1)
+    pairs = pairs[lengths >= min_ca_distance]
+
+    t = np.linspace(0, 1, steps + 1)
+    starts = peaks[pairs[:, 0]][:, None, :]
+    ends = peaks[pairs[:, 1]][:, None, :]
+    points = starts + t[None, :, None] * (ends - starts)
+    density = ndimage.map_coordinates(backbone_image, points.reshape((-1, 3)).T, order=1)
+    density = density.reshape((len(pairs), steps + 1))
+    scores = density.mean(axis=1)
+
+    for (index1, index2), score, connected in zip(pairs.tolist(), scores.tolist(), (density > 0).all(axis=1)):
+        if connected:
+            neighbors[index1].append((score, index2))
+            neighbors[index2].append((score, index1))
+
+    for peak_neighbors in neighbors:
+        peak_neighbors.sort(key=lambda neighbor: (-neighbor[0], neighbor[1]))
+
+    return neighbors
+
+
+def walk_peaks(peaks, neighbors, trace_indices, members, path):
+    """Extends 'path' from its last peak along the best scoring edges and
+    returns the peaks which were added
+
+    Peaks of the current trace ('members') are never revisited and every step
+    has to turn by less than 110 degrees, like in 'find_nearest_ca'. The walk
+    stops once it reaches a peak of another trace."""
+    added = list()
+    while True:
+        end = path[-1]
+        previous = path[-2] if len(path) > 1 else None
+        next_peak = None
+        for score, index in neighbors[end]:
+            if index in members or score <= 0:
+                continue
+            if previous is not None and peak_angle(peaks[previous], peaks[end], peaks[index]) <= 70:
+                continue
+            next_peak = index
+            break
+
+        if next_peak is None:
+            return added
+
+        path.append(next_peak)
+        added.append(next_peak)
+        members.add(next_peak)
+        if trace_indices[next_peak] != -1:
+            return added
+
+
+def peak_angle(previous, location, next_location):
+    """Angle at 'location' between the two neighboring peaks in degrees"""
+    ba = previous - location
+    bc = next_location - location
+    cosine_angle = np.dot(ba, bc) / (np.linalg.norm(ba) * np.linalg.norm(bc))
+
+    return np.degrees(np.arccos(np.clip(cosine_angle, -1, 1)))
 
 
-def build_graph(pdb_file, ca_image, origin, remove_tail_loops):
-    """Build graph and then clean it to improve final output"""
-    graph = make_graph(pdb_file)
-    graph.edge_check()
-    graph.remove_side_chains()
-    graph.remove_loops(ca_image, origin)
-    graph.remove_single_ends()
-    graph.remove_empty_nodes()
-    graph.remove_side_chains()
-    graph.remove_loops(ca_image, origin)
-    graph.remove_single_ends()
-    if remove_tail_loops:
-        graph.remove_tail_loops()
-    graph.remove_empty_nodes()
+def count_remaining_voxels(remaining_image):
+    """Counts voxels which are still above the quitting threshold of the walk"""
+    return int(np.count_nonzero(remaining_image > 8))
 
 
 def find_highest_confidence_ca(remaining_image, set_of_ca_sets):
@@ -146,13 +426,11 @@ def find_highest_confidence_ca(remaining_image, set_of_ca_sets):
     """
     max_location = None
     max_value = 0
-    for ca_set in set_of_ca_sets:
-        for index in range(len(ca_set)):
-            if index == 0 or index == len(ca_set) - 1:
-                value = remaining_image[ca_set[index][0], ca_set[index][1], ca_set[index][2]]
-                if value > max_value:
-                    max_value = value
-                    max_location = ca_set[index]
+    for ca in set_of_ca_sets.get_ends():
+        value = remaining_image[ca[0], ca[1], ca[2]]
+        if value > max_value:
+            max_value = value
+            max_location = ca
     if max_value <= 0:
         # Only do this if we cannot find a good fit on the current back-chain
         box_size = np.shape(remaining_image)
@@ -258,32 +536,7 @@ def find_my_neighbors(set_of_ca_sets, location):
 
     This is useful for preventing the path-walking method from looping on itself
     """
-    neighbor_list = list()
-    for ca_set in set_of_ca_sets:
-        for index in range(len(ca_set)):
-            if np.array_equal(ca_set[index], location):
-                if index + 1 < len(ca_set):
-                    neighbor_list.append(ca_set[index + 1])
-                if index + 2 < len(ca_set):
-                    neighbor_list.append(ca_set[index + 2])
-                if index + 3 < len(ca_set):
-                    neighbor_list.append(ca_set[index + 3])
-                if index + 4 < len(ca_set):
-                    neighbor_list.append(ca_set[index + 4])
-                if index + 5 < len(ca_set):
-                    neighbor_list.append(ca_set[index + 5])
-                if index > 0:
-                    neighbor_list.append(ca_set[index - 1])
-                if index > 1:
-                    neighbor_list.append(ca_set[index - 2])
-                if index > 2:
-                    neighbor_list.append(ca_set[index - 3])
-                if index > 3:
-                    neighbor_list.append(ca_set[index - 4])
-                if index > 4:
-                    neighbor_list.append(ca_set[index - 5])
-
-    return neighbor_list
+    return set_of_ca_sets.get_neighbors(location, 5)
 
 
 def already_placed(location, invalid_ca_spots):
@@ -364,64 +617,35 @@ def cylindrical_density(ca_1, ca_2, input_image, untouched_prediction):
 
 def find_angle2(set_of_ca_sets, old_location, new_location):
     """Another function to calculate the angle between three Ca-atoms"""
-    for ca_set in set_of_ca_sets:
-        for index in range(len(ca_set)):
-            if np.array_equal(ca_set[index], old_location):
-                if index + 1 < len(ca_set):
-                    a = np.array([ca_set[index + 1][0], ca_set[index + 1][1], ca_set[index + 1][2]])
-                elif index > 0:
-                    a = np.array([ca_set[index - 1][0], ca_set[index - 1][1], ca_set[index - 1][2]])
-                else:
-                    return 180
-                b = np.array([old_location[0], old_location[1], old_location[2]])
-                c = np.array([new_location[0], new_location[1], new_location[2]])
-                ba = a - b
-                bc = c - b
+    adjacent = set_of_ca_sets.get_adjacent(old_location)
+    if adjacent is None:
+        return 180
 
-                cosine_angle = np.dot(ba, bc) / (np.linalg.norm(ba) * np.linalg.norm(bc))
-                angle = np.arccos(cosine_angle)
+    a = np.array([adjacent[0], adjacent[1], adjacent[2]])
+    b = np.array([old_location[0], old_location[1], old_location[2]])
+    c = np.array([new_location[0], new_location[1], new_location[2]])
+    ba = a - b
+    bc = c - b
 
-                return np.degrees(angle)
-    return 180
+    cosine_angle = np.dot(ba, bc) / (np.linalg.norm(ba) * np.linalg.norm(bc))
+    angle = np.arccos(cosine_angle)
 
-
-def update_ca_sets(set_of_ca_sets, location, neighbor):
-    location_ca_set = find_ca_in_set_of_traces(location, set_of_ca_sets)
-    if location_ca_set is None:
-        location_ca_set = list()
-        location_ca_set.append(location)
-        location_ca_set.append(neighbor)
-        set_of_ca_sets.append(location_ca_set)
-    else:
-        if location_ca_set[0] == location:
-            location_ca_set.insert(0, neighbor)
-        else:
-            location_ca_set.append(neighbor)
+    return np.degrees(angle)
 
 
-def find_ca_in_set_of_traces(cur_ca, set_of_traces):
-    """Finds the trace that contains a given Ca coordinate. If no trace
-    contains this coordinate, returns None."""
-    for ca_set in set_of_traces:
-        for ca in ca_set:
-            if np.array_equal(ca, cur_ca):
-                return ca_set
-    return None
+def update_ca_sets(set_of_ca_sets, location, neighbor):
+    """Adds edge to the first trace containing 'location' or starts a new
+    trace, see 'TraceSet.add_edge'"""
+    set_of_ca_sets.add_edge(location, neighbor)
 
 
 def print_ca_sets(set_of_ca_sets, offset, file_name):
     """Prints the final set of Ca-traces to a new file that will be later read
     in the graph post processing step. Each trace is assigned its own chain
     letter."""
-    confidence_walk_pdb = open(file_name, "w")
-    counter = 0
-    for index in range(len(set_of_ca_sets)):
-        next_set = set_of_ca_sets[index]
-        counter += 1       
-        for ca in range(len(next_set)):
-            PDB_Reader_Writer.write_single_pdb(file=confidence_walk_pdb, type='ATOM', chain='A', node=np.array([(next_set[ca][2] + offset[0]),(next_set[ca][1] + offset[1]),(next_set[ca][0] + offset[2])]), seqnum=counter)
-            counter += 1
-    confidence_walk_pdb.close()
+    traces = [np.array(list(next_set), dtype=float).reshape((-1, 3))[:, ::-1] + offset for next_set in set_of_ca_sets]
+    with open(file_name, 'w') as confidence_walk_pdb:
+        confidence_walk_pdb.write(pdb_io.format_chains(traces, ter=False))
 
 
 def massage_ends(set_of_ca_sets):
@@ -429,56 +653,133 @@ def massage_ends(set_of_ca_sets):
 
     Essentially, this method created a graph of traces from a set of disjoint
     graphs. This is accomplished by reassigning the ends og traces to lie on
-    top of nodes within a neighboring trace."""
-    for ca_set in set_of_ca_sets:
-        switch_start_ca = None
-        switch_start_distance = 1000
-        switch_end_ca = None
-        switch_end_distance = 1000
-        ca_start = ca_set[0]
-        ca_end = ca_set[len(ca_set) - 1]
-        for next_ca_set in set_of_ca_sets:
-            if next_ca_set != ca_set:
-                for ca in next_ca_set:
-                    start_dist = distance(ca[2], ca_start[2], ca[1], ca_start[1], ca[0], ca_start[0])
-                    end_dist = distance(ca[2], ca_end[2], ca[1], ca_end[1], ca[0], ca_end[0])
-                    if start_dist < 3 and start_dist < switch_start_distance:
-                        switch_start_ca = deepcopy(ca)
-                        switch_start_distance = start_dist
-                    if end_dist < 3 and end_dist < switch_end_distance:
-                        switch_end_ca = deepcopy(ca)
-                        switch_end_distance = end_dist
+    top of nodes within a neighboring trace. The closest Ca atom within 3A is
+    used, ties are broken by the order of the traces."""
+    spatial_hash = SpatialHash(3)
+    for i, ca_set in enumerate(set_of_ca_sets):
+        for j, ca in enumerate(ca_set):
+            spatial_hash.add(ca, (i, j))
+
+    for i, ca_set in enumerate(set_of_ca_sets):
+        last = len(ca_set) - 1
+        switch_start_ca = find_closest_ca(spatial_hash, set_of_ca_sets, i, ca_set[0])
+        switch_end_ca = find_closest_ca(spatial_hash, set_of_ca_sets, i, ca_set[last])
         if switch_start_ca is not None:
+            spatial_hash.remove(ca_set[0], (i, 0))
             ca_set[0] = switch_start_ca
+            spatial_hash.add(ca_set[0], (i, 0))
         if switch_end_ca is not None:
-            ca_set[len(ca_set) - 1] = switch_end_ca
+            spatial_hash.remove(ca_set[last], (i, last))
+            ca_set[last] = switch_end_ca
+            spatial_hash.add(ca_set[last], (i, last))
+
+
+def find_closest_ca(spatial_hash, set_of_ca_sets, i, location):
+    """Returns copy of the closest Ca atom within 3A of 'location' which does
+    not belong to the i-th trace (or a trace equal to it)"""
+    closest = None
+    for (k, j), ca in spatial_hash.query(location, 3):
+        if k != i and set_of_ca_sets[k] != set_of_ca_sets[i]:
+            key = (distance(ca[2], location[2], ca[1], location[1], ca[0], location[0]), k, j)
+            if closest is None or key < closest:
+                closest = key
+
+    if closest is None:
+        return None
+
+    return list(set_of_ca_sets[closest[1]][closest[2]])
 
 
 def overlay_cas(set_of_ca_sets):
+    """Moves every Ca atom onto the first Ca atom (in trace order) which lies
+    within 3A of it
+
+    Each distinct location is kept once in a spatial hash. When a location is
+    overlaid all Ca atoms at the close locations are moved onto it and those
+    locations are removed from the hash, since no new locations are created."""
+    spatial_hash = SpatialHash(3)
+    positions = dict()
+    for i, ca_set in enumerate(set_of_ca_sets):
+        for j, ca in enumerate(ca_set):
+            location = tuple(ca)
+            if location not in positions:
+                positions[location] = list()
+                spatial_hash.add(location, location)
+            positions[location].append((i, j))
+
+    overlaid = set()
     for ca_set in set_of_ca_sets:
         for index, ca in enumerate(ca_set):
-            for next_ca_set in set_of_ca_sets:
-                for next_index, next_ca in enumerate(next_ca_set):
-                    if ca != next_ca:
-                        if distance(ca[2], next_ca[2], ca[1], next_ca[1], ca[0], next_ca[0]) < 3:
-                            print('Before: ' + str(next_ca_set[next_index]))
-                            next_ca_set[next_index] = ca_set[index]
-                            print('After: ' + str(next_ca_set[next_index]))
+            location = tuple(ca)
+            if location in overlaid:
+                continue
+            overlaid.add(location)
+
+            for close_location, _ in spatial_hash.query(location, 3):
+                if close_location == location:
+                    continue
+                for i, j in positions.pop(close_location):
+                    set_of_ca_sets[i][j] = ca_set[index]
+                    positions[location].append((i, j))
+                spatial_hash.remove(close_location, close_location)
+
+
+class SpatialHash:
+    """Spatial hash of cubic cells used to find items close to a location
+
+    Parameters
+    ----------
+    cell_size: float
+        Edge length of the cells. Queries are only exact for radii up to the
+        cell size
+    """
+
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = dict()
+
+    def get_cell(self, location):
+        return (int(math.floor(location[0] / self.cell_size)),
+                int(math.floor(location[1] / self.cell_size)),
+                int(math.floor(location[2] / self.cell_size)))
+
+    def add(self, location, item):
+        self.cells.setdefault(self.get_cell(location), dict())[item] = tuple(location)
+
+    def remove(self, location, item):
+        del self.cells[self.get_cell(location)][item]
+
+    def query(self, location, radius):
+        """Returns list of (item, location) tuples which are closer than
+        'radius' to the given location"""
+        x, y, z = self.get_cell(location)
+        result = list()
+        for cell in [(x + i, y + j, z + k) for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1)]:
+            for item, item_location in self.cells.get(cell, {}).items():
+                if distance(item_location[2], location[2], item_location[1], location[1],
+                            item_location[0], location[0]) < radius:
+                    result.append((item, item_location))
+
+        return result
 
 
 class Node:
     """Simple Node class defining the location of a Ca atom along with which Ca
-    atoms may be connected to it. There may be any number of connected Ca atoms."""
+    atoms may be connected to it. There may be any number of connected Ca atoms.
+
+    Locations are stored as tuples so they can be used as keys of the graph."""
+
+    __slots__ = ('location', 'edges')
 
     def __init__(self, location):
-        self.location = location
+        self.location = tuple(location)
         self.edges = list()
 
     def get_location(self):
         return self.location
 
     def add_edge(self, edge):
-        self.edges.append(edge)
+        self.edges.append(tuple(edge))
 
     def get_num_edges(self):
         return len(self.edges)
@@ -491,33 +792,79 @@ class Graph:
     """Graph class that defines the full backbone-Ca structure of the protein
 
     This class contains functions used to clean and improve the predicted
-    backbone structure as a final step of post-processing"""
+    backbone structure as a final step of post-processing. Nodes are indexed by
+    their location (in insertion order) so lookups, insertions, and removals
+    are O(1).
+
+    Walks along chains of nodes with two edges (segments) are memoized, so
+    the cleanup passes reuse them instead of walking the same chain from both
+    of its ends. Every modification of the graph invalidates the segments
+    running through the modified nodes."""
 
     def __init__(self):
-        self.nodes = list()
+        self.nodes = dict()
+        self._segments = dict()
+        self._segment_keys = dict()
+        self._modified = None
+
+    @classmethod
+    def from_traces(cls, set_of_ca_sets, offset):
+        """Builds graph directly from the traces of 'confidence_walk'
+
+        Consecutive Ca atoms of a trace are connected, which matches the graph
+        'make_graph' builds from the pdb file written by 'print_ca_sets'
+        without going through the text representation."""
+        graph = cls()
+        for ca_set in set_of_ca_sets:
+            previous_location = None
+            for ca in ca_set:
+                location = (float(ca[2] + offset[0]), float(ca[1] + offset[1]), float(ca[0] + offset[2]))
+                if not graph.contains_location(location):
+                    graph.add_node(Node(location))
+                if previous_location is not None:
+                    graph.add_edge(previous_location, location)
+                previous_location = location
+
+        return graph
 
     def add_node(self, node):
-        self.nodes.append(node)
+        self.nodes[node.get_location()] = node
+        self._invalidate_segments(node.get_location())
+
+    def remove_node(self, location):
+        del self.nodes[tuple(location)]
+        self._invalidate_segments(location)
 
     def contains_location(self, location):
-        for node in self.nodes:
-            if node.get_location() == location:
-                return True
-        return False
+        return tuple(location) in self.nodes
 
     def get_node(self, location):
-        for node in self.nodes:
-            if node.get_location() == location:
-                return node
-
-        raise ValueError('No node found with given location')
+        try:
+            return self.nodes[tuple(location)]
+        except KeyError:
+            raise ValueError('No node found with given location')
+
+    def add_edge(self, location1, location2):
+        """Connects the nodes at both locations with each other"""
+        self.get_node(location1).add_edge(location2)
+        self.get_node(location2).add_edge(location1)
+        self._invalidate_segments(location1)
+        self._invalidate_segments(location2)
+
+    def remove_edge(self, location1, location2):
+        """Removes the connection between the nodes at both locations"""
+        self.get_node(location1).edges.remove(tuple(location2))
+        self.get_node(location2).edges.remove(tuple(location1))
+        self._invalidate_segments(location1)
+        self._invalidate_segments(location2)
 
     def edge_check(self):
-        for node in self.nodes:
+        for node in self.nodes.values():
             index = 0
             while index < node.get_num_edges():
                 if node.get_edges()[index] == node.get_location():
                     node.get_edges().remove(node.get_edges()[index])
+                    self._invalidate_segments(node.get_location())
                     index -= 1
                 index += 1
             for edge in node.get_edges():
@@ -526,7 +873,7 @@ class Graph:
 
     def get_end_nodes(self):
         end_nodes = list()
-        for node in self.nodes:
+        for node in self.nodes.values():
             if node.get_num_edges() <= 1:
                 end_nodes.append(node)
         return end_nodes
@@ -535,115 +882,229 @@ class Graph:
         """This method removes all nodes/edges that are connected to a node
         that have 3 or more edges. It also removes Nodes that are connected
         to other end Nodes (a pair of disconnected Ca atoms)."""
-        for node in self.nodes:
-            if node.get_num_edges() == 1: # This is a single connection
-                neighbor_node = self.get_node(node.get_edges()[0])
-                if neighbor_node.get_num_edges() >= 3 or neighbor_node.get_num_edges() == 1:
-                    neighbor_node.edges.remove(node.get_location())
-                    node.edges.remove(neighbor_node.get_location())
-                else:
-                    for node_2 in neighbor_node.get_edges():
-                        next_node = self.get_node(node_2)
-                        if next_node.get_num_edges() >= 3:
-                            next_node.edges.remove(neighbor_node.get_location())
-                            neighbor_node.edges.remove(next_node.get_location())
-                            neighbor_node.edges.remove(node.get_location())
-                            node.edges.remove(neighbor_node.get_location())
+        for node in self.nodes.values():
+            self.remove_single_end(node)
+
+    def remove_single_end(self, node):
+        """Applies 'remove_single_ends' to a single node and returns true if
+        the graph was changed"""
+        changed = False
+        if node.get_num_edges() == 1: # This is a single connection
+            neighbor_node = self.get_node(node.get_edges()[0])
+            if neighbor_node.get_num_edges() >= 3 or neighbor_node.get_num_edges() == 1:
+                self.remove_edge(neighbor_node.get_location(), node.get_location())
+                changed = True
+            else:
+                for node_2 in neighbor_node.get_edges():
+                    next_node = self.get_node(node_2)
+                    if next_node.get_num_edges() >= 3:
+                        self.remove_edge(next_node.get_location(), neighbor_node.get_location())
+                        self.remove_edge(neighbor_node.get_location(), node.get_location())
+                        changed = True
+
+        return changed
 
     def walk_until_trinary(self, location, visited):
-        """A recursive method used to find the end of a trace
+        """A method used to find the end of a trace
 
         An end of a trace is defined as the point where the trace ends or when
-        the trace hits a Ca atom with 3 or more edges"""
+        the trace hits a Ca atom with 3 or more edges. Returns the visited
+        nodes in the order in which they were visited."""
+        if len(visited) == 1:
+            walk, clean = self.get_segment(visited[0], location)
+            return list(walk)
+
+        return self._walk_until_trinary(location, visited)
+
+    def walk_graph(self, location, visited, depth):
+        """A method similar to walk_until_trinary that finds the depth of
+        trace. Also stops when it reaches a node that has 3 edges or a
+        terminating node."""
+        if len(visited) == 1:
+            walk, clean = self.get_segment(visited[0], location)
+            if clean:
+                return depth + len(walk) - 2
+
+        return self._walk_graph(location, visited, depth)
+
+    def get_segment(self, start, location):
+        """Returns the memoized walk from 'start' over 'location' until the
+        end of the trace
+
+        The walk is returned together with a flag which is true if every node
+        of the walk only connects to its predecessor and successor. Only for
+        such clean segments the walk can be reversed and the depth of the trace
+        equals the length of the walk."""
+        key = (tuple(start), tuple(location))
+        if key not in self._segments:
+            walk = self._walk_until_trinary(key[1], [key[0]])
+            clean = self._is_clean_segment(walk)
+            self._add_segment(walk, clean)
+
+            # The reversed segment is only identical if the walk ended at a
+            # node at which a walk from the other side stops as well
+            if (clean and len(walk) >= 3 and self.get_node(walk[-1]).get_num_edges() != 2 and
+                    self.get_node(walk[0]).get_num_edges() >= 3):
+                self._add_segment(walk[::-1], clean)
+
+        return self._segments[key]
+
+    def _add_segment(self, walk, clean):
+        key = (walk[0], walk[1])
+        self._segments[key] = (tuple(walk), clean)
+        for location in walk:
+            self._segment_keys.setdefault(location, set()).add(key)
+
+    def _invalidate_segments(self, location):
+        if self._modified is not None:
+            self._modified.append(tuple(location))
+        for key in self._segment_keys.pop(tuple(location), ()):
+            self._segments.pop(key, None)
+
+    def _is_clean_segment(self, walk):
+        for i in range(1, len(walk) - 1):
+            edges = self.get_node(walk[i]).get_edges()
+            if len(edges) != 2 or {edges[0], edges[1]} != {walk[i - 1], walk[i + 1]}:
+                return False
+
+        end_node = self.get_node(walk[-1])
+        if end_node.get_num_edges() <= 2:
+            visited = set(walk)
+            return all(edge in visited for edge in end_node.get_edges())
+
+        return True
+
+    def _walk_until_trinary(self, location, visited):
+        """Iterative walk that follows nodes with exactly two edges
+
+        Nodes are appended to 'visited' in the same order as a depth-first
+        recursion which passes its visited nodes on to the next call."""
+        visited = list(visited)
+        visited_set = set(visited)
+        stack = list()
+
         node = self.get_node(location)
-        visited.append(location)
+        visited.append(node.get_location())
+        visited_set.add(node.get_location())
         if node.get_num_edges() == 2:
-            for edge in node.get_edges():
-                if edge not in visited:
-                    visited = self.walk_until_trinary(edge, deepcopy(visited))
+            stack.append(iter(node.get_edges()))
+
+        while stack:
+            for edge in stack[-1]:
+                if edge not in visited_set:
+                    node = self.get_node(edge)
+                    visited.append(edge)
+                    visited_set.add(edge)
+                    if node.get_num_edges() == 2:
+                        stack.append(iter(node.get_edges()))
+                    break
+            else:
+                stack.pop()
+
         return visited
 
-    def walk_graph(self, location, visited, depth):
-        """A recursive method similar to walk_until_trinary that finds the
-        depth of trace. Also stops when it reaches a node that has 3 edges
-        or a terminating node."""
+    def _walk_graph(self, location, visited, depth):
+        """Iterative walk that follows nodes with up to two edges
+
+        Every branch of the walk only treats the nodes of its own path as
+        visited. The depth is increased by one for every node the walk
+        steps on."""
+        path = set(visited)
         node = self.get_node(location)
-        if node.get_num_edges() <= 2:
-            visited.append(location)
-            for edge in node.get_edges():
-                if edge not in visited:
-                    depth = self.walk_graph(edge, deepcopy(visited), depth + 1)
+        if node.get_num_edges() > 2:
+            return depth
+
+        path.add(node.get_location())
+        stack = [(node.get_location(), iter(node.get_edges()))]
+        while stack:
+            current, edges = stack[-1]
+            for edge in edges:
+                if edge not in path:
+                    depth += 1
+                    node = self.get_node(edge)
+                    if node.get_num_edges() <= 2:
+                        path.add(edge)
+                        stack.append((edge, iter(node.get_edges())))
+                    break
+            else:
+                stack.pop()
+                path.discard(current)
+
         return depth
 
     def remove_single_loop(self, ca_list):
         trinary_node = self.get_node(ca_list[0])
         trinary_node.edges.remove(ca_list[1])
         trinary_node.edges.remove(ca_list[len(ca_list) - 1])
+        self._invalidate_segments(ca_list[0])
         for index, ca in enumerate(ca_list):
             if index > 0:
-                to_be_removed = self.get_node(ca_list[index])
-                self.nodes.remove(to_be_removed)
+                self.remove_node(ca_list[index])
 
     def remove_tail_loops(self):
-        for node in self.nodes:
-            if node.get_num_edges() >= 3: # This is a trinary connection
-                walk_lists = list()
-                visited = list()
-                visited.append(node.get_location())
-                for edge in node.get_edges():
-                    walk_lists.append(self.walk_until_trinary(edge, deepcopy(visited)))
-                done = False
-                for list1 in walk_lists:
-                    if done:
-                        break
-                    for list2 in walk_lists:
-                        if done:
-                            break
-                        if list1 != list2 and list1[len(list1) - 1] == list2[1] and len(list1) <= 4:
-                            self.remove_single_loop(list1)
-                            done = True
+        # Iterate over a copy since loops are removed from the graph
+        for node in list(self.nodes.values()):
+            if node.get_location() not in self.nodes:
+                continue
+            self.remove_tail_loop(node)
+
+    def remove_tail_loop(self, node):
+        """Applies 'remove_tail_loops' to a single node and returns true if the
+        graph was changed"""
+        if node.get_num_edges() >= 3: # This is a trinary connection
+            walk_lists = list()
+            for edge in node.get_edges():
+                walk_lists.append(self.walk_until_trinary(edge, [node.get_location()]))
+            for list1 in walk_lists:
+                for list2 in walk_lists:
+                    if list1 != list2 and list1[len(list1) - 1] == list2[1] and len(list1) <= 4:
+                        self.remove_single_loop(list1)
+                        return True
+
+        return False
 
     def remove_loops(self, input_image, origin):
         """This method removes one side of a loop in the graph (a cycle). The
         side of the loop with the least density will be removed."""
-        for node in self.nodes:
-            if node.get_num_edges() >= 3: # This is a trinary connection
-                walk_lists = list()
-                visited = list()
-                visited.append(node.get_location())
-                for edge in node.get_edges():
-                    walk_lists.append(self.walk_until_trinary(edge, deepcopy(visited)))
-
-                done = False
-                for list1 in walk_lists:
-                    if done:
-                        break
-                    for list2 in walk_lists:
-                        if done:
-                            break
-
-                        # This removed a loop along the backbone that ends in a different trinary node.
-                        if list1 != list2 and list1[len(list1) - 1] == list2[len(list2) - 1]:
-                            density1 = calculate_density(list1, input_image, origin)
-                            density2 = calculate_density(list2, input_image, origin)
-                            if density1 < density2 and len(list1) <= 4:
-                                self.remove_pairs(list1[0], list1[1])
-                            elif density2 < density1 and len(list2) <= 4:
-                                self.remove_pairs(list2[0], list2[1])
-                            done = True
+        for node in self.nodes.values():
+            self.remove_loop(node, input_image, origin)
+
+    def remove_loop(self, node, input_image, origin):
+        """Applies 'remove_loops' to a single node and returns true if the
+        graph was changed"""
+        if node.get_num_edges() >= 3: # This is a trinary connection
+            walk_lists = list()
+            for edge in node.get_edges():
+                walk_lists.append(self.walk_until_trinary(edge, [node.get_location()]))
+
+            for list1 in walk_lists:
+                for list2 in walk_lists:
+                    # This removed a loop along the backbone that ends in a different trinary node.
+                    if list1 != list2 and list1[len(list1) - 1] == list2[len(list2) - 1]:
+                        density1 = calculate_density(list1, input_image, origin)
+                        density2 = calculate_density(list2, input_image, origin)
+                        if density1 < density2 and len(list1) <= 4:
+                            self.remove_pairs(list1[0], list1[1])
+                            return True
+                        elif density2 < density1 and len(list2) <= 4:
+                            self.remove_pairs(list2[0], list2[1])
+                            return True
+                        return False
+
+        return False
 
     def remove_pairs(self, location_back, location_front):
         """This is a path-walking method used to remove nodes from the graph
 
-        It is a helper function used by other methods in this file. Each call
-        to this method will remove a single node from the graph."""
-        node1 = self.get_node(location_back)
-        node1.edges.remove(location_front)
-        node2 = self.get_node(location_front)
-        node2.edges.remove(location_back)
-        num_edges = node2.get_num_edges()
-        if num_edges == 1:
-            self.remove_pairs(location_front, node2.get_edges()[0]) # Should only be one left
+        It is a helper function used by other methods in this file. The edge
+        between both locations is removed and the walk continues as long as
+        the front node is left with a single edge."""
+        while True:
+            self.remove_edge(location_back, location_front)
+            node2 = self.get_node(location_front)
+            if node2.get_num_edges() != 1:
+                break
+            location_back, location_front = location_front, node2.get_edges()[0] # Should only be one left
 
     def remove_side_chains(self):
         """This method removes sides chains from the graph
@@ -652,36 +1113,96 @@ class Graph:
         calculates if a single trace connects to another node with three or
         more edges. If this is the case then this trace is likely a side chain
         shortcut that should not exist. It is then removed by this method."""
-        for node in self.nodes:
-            if node.get_num_edges() >= 3: # This is a trinary connection
-                visited = list()
-                visited.append(node.get_location())
-                min1 = 111 # Smallest
-                min1_edge = None
-                min2 = 999
-                for edge in node.get_edges():
-                    value = self.walk_graph(edge, deepcopy(visited), 1)
-                    if value < min2 and value < min1:
-                        min2 = min1
-                        min1 = value
-                        min1_edge = edge
-                    elif value < min2:
-                        min2 = value
-                if min1 <= 3 <= min2 - min1: # remove from graph
-                    self.remove_pairs(node.get_location(), min1_edge)
+        for node in self.nodes.values():
+            self.remove_side_chain(node)
+
+    def remove_side_chain(self, node):
+        """Applies 'remove_side_chains' to a single node and returns true if
+        the graph was changed"""
+        if node.get_num_edges() >= 3: # This is a trinary connection
+            min1 = 111 # Smallest
+            min1_edge = None
+            min2 = 999
+            for edge in node.get_edges():
+                value = self.walk_graph(edge, [node.get_location()], 1)
+                if value < min2 and value < min1:
+                    min2 = min1
+                    min1 = value
+                    min1_edge = edge
+                elif value < min2:
+                    min2 = value
+            if min1 <= 3 <= min2 - min1: # remove from graph
+                self.remove_pairs(node.get_location(), min1_edge)
+                return True
+
+        return False
 
     def remove_empty_nodes(self):
         """This function removes empty nodes in the graph. (Garbage collection)"""
-        for node in self.nodes:
-            if node.get_num_edges() == 0:
-                self.nodes.remove(node)
+        empty_nodes = [location for location, node in self.nodes.items() if node.get_num_edges() == 0]
+        for location in empty_nodes:
+            self.remove_node(location)
+
+    def cleanup(self, input_image, origin, remove_tail_loops=False):
+        """Applies the cleanup rules until the graph does not change anymore
+
+        Every node starts on a worklist. A node taken from the worklist is
+        checked by the rules of 'remove_side_chains', 'remove_loops',
+        'remove_tail_loops' (optional), 'remove_single_ends', and
+        'remove_empty_nodes'. Whenever a rule changes the graph, only the
+        modified nodes, their neighbors, and the ends of the traces running
+        through them are put back on the worklist.
+        """
+        self.edge_check()
+
+        worklist = deque(self.nodes)
+        queued = set(worklist)
+        self._modified = list()
+        while worklist:
+            location = worklist.popleft()
+            queued.discard(location)
+            node = self.nodes.get(location)
+            if node is None:
+                continue
 
-    def print_traces(self, sheet_image, helix_image, offset, pdb_file):
-        """This method prints all traces in the graph to a single .PDB file"""
-        writer = open(pdb_file, 'w')
-        already_written = list()
+            if node.get_num_edges() == 0:
+                self.remove_node(location)
+            elif node.get_num_edges() == 1:
+                self.remove_single_end(node)
+            elif node.get_num_edges() >= 3:
+                if not self.remove_side_chain(node) and not self.remove_loop(node, input_image, origin):
+                    if remove_tail_loops:
+                        self.remove_tail_loop(node)
+
+            modified, self._modified = self._modified, list()
+            for modified_location in modified:
+                for dirty_location in self._get_affected_locations(modified_location):
+                    if dirty_location not in queued:
+                        worklist.append(dirty_location)
+                        queued.add(dirty_location)
+
+        self._modified = None
+
+    def _get_affected_locations(self, location):
+        """Returns the locations whose cleanup rules depend on the node at the
+        given location"""
+        if location not in self.nodes:
+            return []
+
+        affected = [location]
+        for edge in self.get_node(location).get_edges():
+            if edge in self.nodes:
+                affected.append(edge)
+                affected.append(self.walk_until_trinary(edge, [location])[-1])
+
+        return affected
+
+    def get_chains(self, sheet_image, helix_image, offset):
+        """Returns all traces in the graph as list of 'Chain' objects with the
+        helices and sheets of the secondary structure images"""
+        already_written = set()
         set_of_traces = list()
-        for node in self.nodes:
+        for node in self.nodes.values():
             if node.get_num_edges() == 1 or node.get_num_edges() > 2:
                 for edge in node.get_edges():
                     trace = list()
@@ -703,10 +1224,9 @@ class Graph:
                     except ValueError as e:
                         print(e)
 
-                    representation = repr(trace[0]) + repr(trace[len(trace) - 1])
-                    if representation not in already_written:
+                    if (trace[0], trace[len(trace) - 1]) not in already_written:
                         set_of_traces.append(trace)
-                        already_written.append(repr(trace[len(trace) - 1]) + repr(trace[0]))
+                        already_written.add((trace[len(trace) - 1], trace[0]))
 
         helix_traces = list()
         helix_chains = list()
@@ -743,9 +1263,7 @@ class Graph:
                         sheet_chains.append(cur_chain)
                         cur_sheet = None
 
-                PDB_Reader_Writer.write_single_pdb(file=writer, type='ATOM', chain='A', node=np.array([ca[0],ca[1],ca[2]]), seqnum=(counter + cur_chain))
                 counter += 1
-            PDB_Reader_Writer.write_single_pdb(file=writer, type='TER')
 
             if cur_helix is not None: # Fence-Posting
                 helix_traces.append(cur_helix)
@@ -754,37 +1272,34 @@ class Graph:
                 sheet_traces.append(cur_sheet)
                 sheet_chains.append(cur_chain)
 
-        for index, trace in enumerate(helix_traces):
-            chain = helix_chains[index]
-            start = str(helix_traces[index][0] + chain - 1)
-            end = str(helix_traces[index][len(helix_traces[index]) - 1] + chain - 1)
-            PDB_Reader_Writer.write_single_pdb(file=writer, type='HELIX', chain='A', node_from=start, node_to=end)
+        # Helices and sheets are counted over all traces, so they are made
+        # relative to the start of their trace
+        trace_starts = np.cumsum([0] + [len(trace) for trace in set_of_traces])
+        helices = [list() for _ in set_of_traces]
+        for trace, chain in zip(helix_traces, helix_chains):
+            helices[chain - 1].append([trace[0] - trace_starts[chain - 1], trace[-1] - trace_starts[chain - 1]])
+        sheets = [list() for _ in set_of_traces]
+        for trace, chain in zip(sheet_traces, sheet_chains):
+            sheets[chain - 1].append([trace[0] - trace_starts[chain - 1], trace[-1] - trace_starts[chain - 1]])
 
-        for index, trace in enumerate(sheet_traces):
-            chain = sheet_chains[index]
-            start = str(sheet_traces[index][0] + chain - 1)
-            end = str(sheet_traces[index][len(sheet_traces[index]) - 1] + chain - 1)
-            PDB_Reader_Writer.write_single_pdb(file=writer, type='SHEET', chain='A', node_from=start, node_to=end)
-
-        writer.close()
+        return [Chain(*chain) for chain in zip(set_of_traces, helices, sheets)]
 
     def refine_backbone(self, backbone_image, origin):
         box_size = np.shape(backbone_image)
         new_backbone = np.zeros(box_size)
         steps = 10
-        already_written = list()
-        for node in self.nodes:
+        already_written = set()
+        for node in self.nodes.values():
             for edge in node.get_edges():
                 node_location = node.get_location()
-                node_location = [int(node_location[2] - origin[2]),
+                node_location = (int(node_location[2] - origin[2]),
                                  int(node_location[1] - origin[1]),
-                                 int(node_location[0] - origin[0])] # Reverse it
-                edge_location = [int(edge[2] - origin[2]),
+                                 int(node_location[0] - origin[0])) # Reverse it
+                edge_location = (int(edge[2] - origin[2]),
                                  int(edge[1] - origin[1]),
-                                 int(edge[0] - origin[0])] # Reverse it
-                representation = repr(edge_location) + repr(node_location)
-                if representation not in already_written:
-                    already_written.append(repr(node_location) + repr(edge_location))
+                                 int(edge[0] - origin[0])) # Reverse it
+                if (edge_location, node_location) not in already_written:
+                    already_written.add((node_location, edge_location))
                     midpoints = list()
                     x_step = (node_location[0] - edge_location[0]) / steps
                     y_step = (node_location[1] - edge_location[1]) / steps
@@ -812,19 +1327,17 @@ class Graph:
 
         There is no ordering in the graph. It is merely a tool for getting a
         feel for each connection between each Ca atom."""
-        writer = open(pdb_file, 'w')
-        already_written = list()
-        counter = 1
-        for node in self.nodes:
+        already_written = set()
+        edges = list()
+        for node in self.nodes.values():
             for edge in node.get_edges():
                 node_location = node.get_location()
-                representation = repr(edge) + repr(node_location)
-                if representation not in already_written:
-                    PDB_Reader_Writer.write_single_pdb(file=writer, type='ATOM', chain='A', node=np.array([node_location[0],node_location[1],node_location[2]]), seqnum=counter)
-                    PDB_Reader_Writer.write_single_pdb(file=writer, type='ATOM', chain='A', node=np.array([edge[0],edge[1],edge[2]]), seqnum=(counter + 1))
-                    counter += 3
-                    already_written.append(repr(node_location) + repr(edge))
-        writer.close()
+                if (edge, node_location) not in already_written:
+                    edges.append([node_location, edge])
+                    already_written.add((node_location, edge))
+
+        with open(pdb_file, 'w') as writer:
+            writer.write(pdb_io.format_chains(edges, ter=False))
 
 
 def calculate_density(walk_list, full_image, origin):
@@ -872,28 +1385,20 @@ def make_graph(pdb_file):
     file into a Graph representation for later processing. This allows the
     prediction step to be separated from the post-processing step. They do not
     have to be run concurrently."""
-    pdb_file = open(pdb_file, 'r')
+    atoms = pdb_io.read_pdb(pdb_file).atoms
     graph = Graph()
     previous_location = None
     cur_index = -1
-    for line in pdb_file:
-        if line.startswith("ATOM"):
-            index = PDB_Reader_Writer.read_single_pdb_line(type='ATOM INDEX', line=line)
-            x, y, z = PDB_Reader_Writer.read_single_pdb_line(type='ATOM', line=line)
-            if index == cur_index + 1:
-                previous = graph.get_node(previous_location)
-                previous.add_edge([x, y, z])
-                if graph.contains_location([x, y, z]):
-                    node = graph.get_node([x, y, z])
-                    node.add_edge(previous_location)
-                else:
-                    new_node = Node([x, y, z])
-                    new_node.add_edge(previous.get_location())
-                    graph.add_node(new_node)
-            else: # new chain
-                if not graph.contains_location([x, y, z]):
-                    new_node = Node([x, y, z])
-                    graph.add_node(new_node)
-            cur_index = index
-            previous_location = [x, y, z] # Update for next go-around
+    for index, location in zip(atoms['residue'].tolist(), atoms['coordinates'].tolist()):
+        location = tuple(location)
+        if index == cur_index + 1:
+            if not graph.contains_location(location):
+                graph.add_node(Node(location))
+            graph.add_edge(previous_location, location)
+        else: # new chain
+            if not graph.contains_location(location):
+                new_node = Node(location)
+                graph.add_node(new_node)
+        cur_index = index
+        previous_location = location # Update for next go-around
     return graph
\ No newline at end of file
@@ -9,28 +9,31 @@ The helix refinement can be applied on a pdb file by calling the function
 """
 
 import numpy as np
-from math import sin, cos
 from scipy.optimize import minimize
 from math import pi
 from .pdb_reader_writer import PDB_Reader_Writer, Chain
+from .parallel import parallel_map
 
 __author__ = 'Jonas Pfab'
 
 
+RESOURCE_CLASS = 'cpu'
+
+
 def update_paths(paths):
-    paths['traces_refined'] = paths['output'] + 'traces_refined.pdb'
+    paths['traces_refined'] = paths['output'] + 'traces_refined.npz'
 
 
 def execute(paths):
     """Coordinates the application of the helix refinement and writes new pdb
     file containing refined backbone structure"""
     reader_writer = PDB_Reader_Writer()
-    chains = reader_writer.read_pdb(paths['traces'])
+    chains = reader_writer.read_chains(paths['traces'])
     fit_helices(chains)
-    reader_writer.write_pdb(chains, paths['traces_refined'])
+    reader_writer.write_chains(chains, paths['traces_refined'], paths.get('debug', False))
 
 
-def fit_helices(chains):
+def fit_helices(chains, parallel=True):
     """Fits nodes that belong to a helix to helix structure
 
     Parameters
@@ -38,30 +41,74 @@ def fit_helices(chains):
     chains: list
         List of 'Chain' objects containing information about nodes, sheets, and
         helices
-    """
-    for chain in chains:
-        i = 0
-        while i < len(chain.helices):
-            helix_start, helix_end = chain.helices[i]
-            original_len = len(chain.nodes)
-            # Don't fit helices that consist of less than 10 atoms
-            if helix_end - helix_start < 10:
-                i += 1
-                continue
-
-            try:
-                helix = Helix(interval_size=9, min_interval_size=3, r=2.11, c=1.149, gap=1.498, flatten=4)
-                helix.fit(chain.nodes[helix_start:helix_end])
 
-                chain.nodes[helix_start:helix_end] = helix.nodes
-                diff = len(chain.nodes) - original_len
-
-                update_sec_structure(chain.helices, helix_start, diff)
-                update_sec_structure(chain.sheets, helix_start, diff)
-
-                i += 1
-            except CurvedScrewAxisError as error:
-                split_helix_at_node(error.node, chain, i)
+    parallel: bool
+        If set the helices are fitted in a process pool first and the results
+        are applied to the chains afterwards. The result is the same as
+        fitting them one after the other
+    """
+    if not parallel:
+        for chain in chains:
+            fit_chain_helices(chain)
+        return
+
+    # Helices only depend on their own nodes, so every helix can be fitted as
+    # a chain of its own
+    helices = [(chain, i) for chain in chains for i, (helix_start, helix_end) in enumerate(chain.helices)
+               if helix_end - helix_start >= 10]
+    params_list = [chain.coordinates[chain.helices[i][0]:chain.helices[i][1]] for chain, i in helices]
+    results = parallel_map(fit_helix, params_list)
+
+    # Every chain's helices are applied in order, which shifts the indices in
+    # the same way as the sequential fit
+    index_offsets = dict()
+    for (chain, i), (nodes, helix_parts) in zip(helices, results):
+        i += index_offsets.get(id(chain), 0)
+        helix_start, helix_end = chain.helices[i]
+        diff = len(nodes) - (helix_end - helix_start)
+        chain.nodes[helix_start:helix_end] = nodes
+
+        # The helix might have been split while it was fitted
+        remaining_helices = np.delete(chain.helices, i, axis=0)
+        update_sec_structure(remaining_helices, helix_start, diff)
+        update_sec_structure(chain.sheets, helix_start, diff)
+        chain.helices = np.concatenate((remaining_helices[:i], helix_parts + helix_start, remaining_helices[i:]))
+        index_offsets[id(chain)] = index_offsets.get(id(chain), 0) + len(helix_parts) - 1
+
+
+def fit_helix(nodes):
+    """Fits a single helix as chain of its own and returns the chain's nodes
+    and helices"""
+    chain = Chain(nodes, helices=[[0, len(nodes)]])
+    fit_chain_helices(chain)
+
+    return chain.coordinates, chain.helices
+
+
+def fit_chain_helices(chain):
+    """Fits the helices of a single chain one after the other"""
+    i = 0
+    while i < len(chain.helices):
+        helix_start, helix_end = chain.helices[i]
+        original_len = len(chain)
+        # Don't fit helices that consist of less than 10 atoms
+        if helix_end - helix_start < 10:
+            i += 1
+            continue
+
+        try:
+            helix = Helix(interval_size=9, min_interval_size=3, r=2.11, c=1.149, gap=1.498, flatten=4)
+            helix.fit(chain.nodes[helix_start:helix_end])
+
+            chain.nodes[helix_start:helix_end] = helix.nodes
+            diff = len(chain) - original_len
+
+            update_sec_structure(chain.helices, helix_start, diff)
+            update_sec_structure(chain.sheets, helix_start, diff)
+
+            i += 1
+        except CurvedScrewAxisError as error:
+            split_helix_at_node(error.node, chain, i)
 
 
 def update_sec_structure(sec_structure, node_start, diff):
@@ -72,8 +119,8 @@ def update_sec_structure(sec_structure, node_start, diff):
 
     Parameters
     ----------
-    sec_structure: list
-        List of chains with secondary structure info for every chain
+    sec_structure: ndarray
+        Array of [start, end] node indices which is updated in place
 
     node_start: int
         Index of node at which the indices need to be adjusted
@@ -81,11 +128,7 @@ def update_sec_structure(sec_structure, node_start, diff):
     diff: int
         Difference by which the indices need to be updated
     """
-    for node_range in sec_structure:
-        if node_range[0] > node_start:
-            node_range[0] += diff
-        if node_range[1] > node_start:
-            node_range[1] += diff
+    sec_structure[sec_structure > node_start] += diff
 
 
 def split_helix_at_node(node, chain, i):
@@ -106,19 +149,14 @@ def split_helix_at_node(node, chain, i):
     """
     helix_start, helix_end = chain.helices[i]
     # Split helix into two helices at closest node
-    closest_node, min_distance = -1, float('inf')
-    for j in range(helix_start, helix_end):
-        distance = get_distance(chain.nodes[j], node)
-        if distance < min_distance:
-            closest_node = j
-            min_distance = distance
+    distances = np.linalg.norm(chain.coordinates[helix_start:helix_end].astype(float) - node, axis=1)
+    closest_node = helix_start + int(np.argmin(distances))
 
     if helix_start == closest_node:
         closest_node += 1
 
-    del chain.helices[i]
-    chain.helices.insert(i, [closest_node, helix_end])
-    chain.helices.insert(i, [helix_start, closest_node])
+    chain.helices = np.concatenate((chain.helices[:i], [[helix_start, closest_node], [closest_node, helix_end]],
+                                    chain.helices[i + 1:]))
 
 
 class CurvedScrewAxisError(Exception):
@@ -193,21 +231,26 @@ class Helix:
         if node_max_angle is not None:
             raise CurvedScrewAxisError(node_max_angle)
 
+        # Evaluations are memoized, since the optimizer evaluates the same
+        # parameters repeatedly
+        offsets = dict()
+
         def evaluate_params(x):
-            self._set_nodes(shift=x[0], rotation=x[1])
+            params = (float(x[0]), float(x[1]))
+            if params not in offsets:
+                offsets[params] = get_avg_offset(nodes, self._get_nodes(params[0], [params[1]])[0])
 
-            return get_avg_offset(nodes, self.nodes)
+            return offsets[params]
 
         # Find best shift and rotation parameters
         # noinspection PyTypeChecker
         res = [minimize(evaluate_params, [-self.gap, -2 * pi], bounds=[(-self.gap, self.gap), (None, None)]),
                minimize(evaluate_params, [0, 0], bounds=[(-self.gap, self.gap), (None, None)]),
                minimize(evaluate_params, [self.gap, 2 * pi], bounds=[(-self.gap, self.gap), (None, None)])]
+        x = min(res, key=lambda params: evaluate_params(params.x)).x
 
-        res.sort(key=lambda params: evaluate_params(params.x))
-
-        self._set_nodes(shift=res[0].x[0], rotation=res[0].x[1])
-        if 0.8 < get_avg_offset(nodes, self.nodes) <= 1.7:
+        self._set_nodes(shift=x[0], rotation=x[1])
+        if 0.8 < evaluate_params(x) <= 1.7:
             self._set_edge_nodes(nodes)
         else:
             self.nodes = nodes
@@ -243,7 +286,7 @@ class Helix:
 
         The vector going from the point at the screw axis at t to the point
         calculated by the formula is then mapped to the plane orthogonal to the
-        direction of the screw axis at t.
+        direction of the screw axis at t. All nodes are calculated at once.
 
         Parameters
         ----------
@@ -253,23 +296,32 @@ class Helix:
         rotation: float
             Initial rotation of the helix
         """
-        self.nodes = []
-        t = shift
-        while self.screw_axis(t) is not None:
-            # The new axises to which the vector is mapped
-            z_axis = -1 * normalize(self.screw_axis.get_vector(t))
-            y_axis = -1 * normalize(np.cross(z_axis, np.array([1, 0, 0])))
-            x_axis = -1 * normalize(np.cross(z_axis, y_axis))
-            rotation_matrix = np.array([x_axis, y_axis, z_axis])
+        self.nodes = list(self._get_nodes(shift, [rotation])[0])
+
+    def _get_nodes(self, shift, rotations):
+        """Returns array with the nodes of the helix for every rotation, see
+        '_set_nodes'
+
+        The screw axis and the axises to which the vectors are mapped only
+        depend on the shift, so they are shared by all rotations."""
+        t = self.screw_axis.get_steps(shift, self.gap)
+        if len(t) == 0:
+            return np.zeros((len(rotations), 0, 3))
+
+        # The new axises to which the vectors are mapped, one row per node
+        z_axes = -1 * normalize_rows(self.screw_axis.get_vector(t))
+        y_axes = -1 * normalize_rows(np.cross(z_axes, np.array([1, 0, 0])))
+        x_axes = -1 * normalize_rows(np.cross(z_axes, y_axes))
+        rotation_matrices = np.stack([x_axes, y_axes, z_axes], axis=1)
 
-            original_vector = np.array([self.r * sin((self.c * t) - shift + rotation),
-                                        self.r * cos((self.c * t) - shift + rotation),
-                                        0])
+        angles = (self.c * t)[None, :] - shift + np.asarray(rotations, dtype=float)[:, None]
+        original_vectors = np.stack([self.r * np.sin(angles),
+                                     self.r * np.cos(angles),
+                                     np.zeros(np.shape(angles))], axis=2)
 
-            rotated_vector = np.dot(original_vector, rotation_matrix)
+        rotated_vectors = np.einsum('rni,nij->rnj', original_vectors, rotation_matrices)
 
-            self.nodes.append(np.add(self.screw_axis(t), rotated_vector))
-            t += self.gap
+        return self.screw_axis(t)[None, :, :] + rotated_vectors
 
     def _set_edge_nodes(self, original_nodes):
         """Sets the edge nodes which were ignored due to the min interval size"""
@@ -294,37 +346,78 @@ class Curve:
 
     flatten: int
         Determines how much the curve is flattened
+
+    Notes
+    ----------
+    The curve can be evaluated at a single t or at an array of t values. For
+    arrays the results are arrays with one row per t value, and rows of t
+    values beyond the end of the curve are NaN.
     """
 
     def __init__(self, nodes, flatten):
         # Remove every flatten node but always keep first and last nodes
         self.nodes = nodes[:-1][::flatten] + [nodes[-1]]
+        self.starts = np.array(self.nodes[:-1], dtype=float).reshape((-1, 3))
+        self.vectors = np.array([get_vector(self.nodes[i], self.nodes[i + 1])
+                                 for i in range(len(self.nodes) - 1)], dtype=float).reshape((-1, 3))
+        self.distances = np.array([np.linalg.norm(vector) for vector in self.vectors])
 
     def __call__(self, t):
         """Returns the node from the curve at t"""
-        for i in range(len(self.nodes) - 1):
-            vector_to_next = get_vector(self.nodes[i], self.nodes[i + 1])
-            distance_to_next = np.linalg.norm(vector_to_next)
+        segments, remaining = self._find_segments(t)
+        valid = segments >= 0
+        result = np.full((len(segments), 3), np.nan)
+        result[valid] = (self.starts[segments[valid]] +
+                         (remaining[valid] / self.distances[segments[valid]])[:, None] * self.vectors[segments[valid]])
 
-            if distance_to_next > t:
-                return self.nodes[i] + ((t / distance_to_next) * vector_to_next)
-            else:
-                t -= distance_to_next
-
-        return None
+        return self._unwrap(t, result, valid)
 
     def get_vector(self, t):
         """Returns the direction vector of the curve at t"""
-        for i in range(len(self.nodes) - 1):
-            vector_to_next = get_vector(self.nodes[i], self.nodes[i + 1])
-            distance_to_next = np.linalg.norm(vector_to_next)
-
-            if distance_to_next > t:
-                return vector_to_next
-            else:
-                t -= distance_to_next
-
-        return None
+        segments, _ = self._find_segments(t)
+        valid = segments >= 0
+        result = np.full((len(segments), 3), np.nan)
+        result[valid] = self.vectors[segments[valid]]
+
+        return self._unwrap(t, result, valid)
+
+    def get_steps(self, start, step):
+        """Returns array of t values from 'start' in increments of 'step' up to
+        the end of the curve"""
+        num_steps = int(max(sum(self.distances) - start, 0) / step) + 2
+        while True:
+            # The cumulative sum adds the steps one after the other, just like
+            # stepping along the curve in a loop
+            t = np.cumsum([start] + [step] * (num_steps - 1))
+            segments, _ = self._find_segments(t)
+            if segments[-1] < 0:
+                return t[:np.argmax(segments < 0)]
+            num_steps *= 2
+
+    def _find_segments(self, t):
+        """Returns index of the line segment and distance along that segment
+        for every t value, indices of t values beyond the end are -1"""
+        remaining = np.array(t, dtype=float).reshape(-1)
+        segments = np.full(len(remaining), -1)
+        distances = np.zeros(len(remaining))
+        # Distances are subtracted segment by segment, so each t value is
+        # reduced by exactly the same amounts as when walking the curve
+        for i, distance_to_next in enumerate(self.distances):
+            unassigned = segments < 0
+            found = unassigned & (distance_to_next > remaining)
+            segments[found] = i
+            distances[found] = remaining[found]
+            remaining[unassigned & ~found] -= distance_to_next
+
+        return segments, distances
+
+    @staticmethod
+    def _unwrap(t, result, valid):
+        """Returns single row or None if t is a single value"""
+        if np.ndim(t) == 0:
+            return result[0] if valid[0] else None
+
+        return result
 
     def get_node_max_angle(self, max_angle, interval_size):
         """Returns first node from where curve exceeds max angle
@@ -355,17 +448,19 @@ class Curve:
 def get_avg_offset(nodes1, nodes2):
     """Calculates the average distance from nodes in nodes1 to the closest
      nodes in nodes2"""
-    sum_offsets = 0
-    for node1 in nodes1:
-        closest_distance = -1
-        for node2 in nodes2:
-            distance = get_distance(node1, node2)
-            if distance < closest_distance or closest_distance == -1:
-                closest_distance = distance
+    if len(nodes2) == 0:
+        return -1
 
-        sum_offsets += closest_distance
+    nodes1 = np.asarray(nodes1, dtype=float)
+    nodes2 = np.asarray(nodes2, dtype=float)
+    differences = nodes1[:, None, :] - nodes2[None, :, :]
+    # Distances are computed with the same dot product as 'get_distance' and
+    # summed in order, so the result does not differ from summing the distances
+    # one at a time. The optimizer of 'Helix.fit' is sensitive to differences in
+    # the last digits
+    distances = np.sqrt(np.matmul(differences[:, :, None, :], differences[:, :, :, None])[:, :, 0, 0])
 
-    return sum_offsets / len(nodes1)
+    return sum(np.min(distances, axis=1).tolist()) / len(nodes1)
 
 
 def get_distance(point1, point2):
@@ -387,6 +482,15 @@ def normalize(v):
     return v / norm
 
 
+def normalize_rows(vectors):
+    """Normalizes every row of the array to a unit vector, rows with a norm of
+    zero are kept as they are"""
+    norms = np.linalg.norm(vectors, axis=1)
+    norms[norms == 0] = 1
+
+    return vectors / norms[:, None]
+
+
 def get_centroid(nodes):
     """Returns centroid node from given list of nodes"""
     n = len(nodes)
@@ -0,0 +1,167 @@
+"""Measures the resources used by the stages of the predictions
+
+Every executed stage is measured in the process it runs in as a 'Span' which
+records its wall time, CPU time, peak resident set size, bytes read and
+written and the time spent waiting for the TensorFlow semaphore. Spans are
+appended to a JSON Lines file as soon as a stage is finished and converted to
+a Chrome trace-event file at the end of a run, which can be opened with
+chrome://tracing or Perfetto.
+
+CPU time and bytes read and written include the subprocesses the stage waited
+for, like the Chimera runs and the process pools of the post-processing steps,
+since the counters of a child are added to its parent when the child is
+reaped. Subprocesses which are still running when the stage finishes are not
+included. The peak resident set size is the one of the measuring process only.
+The peak resident set size and the bytes read and written are taken from the
+proc filesystem and are None where it is not available.
+"""
+
+import json
+import os
+import resource
+from collections import namedtuple
+from contextlib import contextmanager
+from time import time
+
+Span = namedtuple('Span', ['stage', 'protein_id', 'pid', 'start', 'wall_time', 'cpu_time', 'peak_rss', 'read_bytes',
+                           'written_bytes', 'wait_time'])
+
+# Time the process spent waiting for 'TimedSemaphore' objects
+_wait_time = 0.0
+
+
+class TimedSemaphore:
+    """Wraps a semaphore and measures the time spent waiting to acquire it
+
+    Parameters
+    ----------
+    semaphore: multiprocessing.Semaphore
+        Semaphore which is acquired when the context is entered
+    """
+
+    def __init__(self, semaphore):
+        self.semaphore = semaphore
+
+    def __enter__(self):
+        global _wait_time
+        start_time = time()
+        self.semaphore.acquire()
+        _wait_time += time() - start_time
+
+        return self
+
+    def __exit__(self, *exc_info):
+        self.semaphore.release()
+
+
+@contextmanager
+def measure(stage, protein_id, spans):
+    """Measures the code run in the context and appends its 'Span' to 'spans',
+    also if the code raises an exception"""
+    reset_peak_rss()
+    start_time = time()
+    start_cpu_time = get_cpu_time()
+    start_read_bytes, start_written_bytes = get_io_bytes()
+    start_wait_time = _wait_time
+    try:
+        yield
+    finally:
+        read_bytes, written_bytes = get_io_bytes()
+        spans.append(Span(stage,
+                          protein_id,
+                          os.getpid(),
+                          start_time,
+                          time() - start_time,
+                          get_cpu_time() - start_cpu_time,
+                          get_peak_rss(),
+                          read_bytes - start_read_bytes if read_bytes is not None else None,
+                          written_bytes - start_written_bytes if written_bytes is not None else None,
+                          _wait_time - start_wait_time))
+
+
+def get_cpu_time():
+    """Returns user and system time of the process and the subprocesses it
+    waited for"""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return usage.ru_utime + usage.ru_stime + children_usage.ru_utime + children_usage.ru_stime
+
+
+def reset_peak_rss():
+    """Resets the peak resident set size of the process, if supported"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def get_peak_rss():
+    """Returns peak resident set size of the process in bytes since the last
+    reset, or None"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return None
+
+
+def get_io_bytes():
+    """Returns bytes read and written by the process and the subprocesses it
+    waited for, or None
+
+    The counters of /proc/self/io only include a subprocess after it was
+    reaped, for example by 'subprocess.run' or by closing a process pool.
+    """
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+    except OSError:
+        return None, None
+
+    return int(counters['rchar']), int(counters['wchar'])
+
+
+def write_spans(spans, spans_file):
+    """Appends spans as single lines to the JSON Lines file"""
+    with open(spans_file, 'a') as f:
+        for span in spans:
+            f.write(json.dumps(span._asdict()) + '\n')
+
+
+def read_spans(spans_file):
+    """Returns list of the spans stored in the JSON Lines file"""
+    spans = list()
+    with open(spans_file) as f:
+        for line in f:
+            if line.strip():
+                spans.append(Span(**json.loads(line)))
+
+    return spans
+
+
+def write_chrome_trace(spans, trace_file):
+    """Writes spans as complete events of a Chrome trace-event file
+
+    Every process is shown as a separate row, the measured values are shown
+    as arguments of the events."""
+    events = list()
+    for span in spans:
+        events.append({
+            'name': span.stage,
+            'cat': 'stage',
+            'ph': 'X',
+            'ts': span.start * 1e6,
+            'dur': span.wall_time * 1e6,
+            'pid': span.pid,
+            'tid': span.pid,
+            'args': {key: value for key, value in span._asdict().items() if key not in ('stage', 'pid', 'start')}
+        })
+
+    with open(trace_file, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
@@ -1,85 +1,119 @@
+import heapq
 import numpy as np
+from scipy.spatial import cKDTree
 from .pdb_reader_writer import PDB_Reader_Writer
 
 
+RESOURCE_CLASS = 'io'
+
+
 def update_paths(paths):
     paths['fragments_merged'] = paths['output'] + 'fragments_merged.pdb'
 
 
 def execute(paths):
     reader_writer = PDB_Reader_Writer()
-    chains = [c for c in reader_writer.read_pdb(paths['duplicates_removed']) if len(c.nodes) > 0]
-    while merge_closest_chains(chains):
-        pass
+    chains = [c for c in reader_writer.read_chains(paths['duplicates_removed']) if len(c) > 0]
+    merge_all_chains(chains)
 
     reader_writer.write_pdb(chains, paths['fragments_merged'])
 
 
-class PossibleConnection:
-
-    def __init__(self, chain1, chain2, i1, i2):
-        self.chain1 = chain1
-        self.chain2 = chain2
-        self.i1 = i1
-        self.i2 = i2
-        self.distance = get_distance(chain1.nodes[i1], chain2.nodes[i2])
-
-
-def merge_closest_chains(chains):
-    possible_connections = []
-    for chain1 in chains:
-        for chain2 in [c for c in chains if c != chain1]:
-            last_i1, last_i2 = len(chain1.nodes) - 1, len(chain2.nodes) - 1
-            possible_connections += [
-                PossibleConnection(chain1, chain2, 0, 0),
-                PossibleConnection(chain1, chain2, 0, last_i2),
-                PossibleConnection(chain1, chain2, last_i1, 0),
-                PossibleConnection(chain1, chain2, last_i1, last_i2)
-            ]
-
-    possible_connections.sort(key=lambda p: p.distance)
-    possible_connections = list(filter(lambda p: p.distance > 3.2, possible_connections))
-    if len(possible_connections) > 0 and possible_connections[0].distance < 10:
-        merge_chains(chains,
-                     possible_connections[0].chain1,
-                     possible_connections[0].chain2,
-                     possible_connections[0].i1,
-                     possible_connections[0].i2)
-
-        return True
-    else:
-        return False
+def merge_all_chains(chains, min_distance=3.2, max_distance=10):
+    """Repeatedly merges the two chains with the closest endpoints until no
+    endpoints are between 'min_distance' and 'max_distance' apart
+
+    Possible connections between endpoints are kept in a heap, which is only
+    updated for the chains changed by a merge. Ties are broken by the order of
+    the chains, the connections of a chain pair being ordered start-start,
+    start-end, end-start and end-end, so the chains are merged in the same
+    order as when always merging the closest connection of all chains.
+
+    Parameters
+    ----------
+    chains: list
+        List of 'Chain' objects which is updated in place
+    """
+    # Every chain has a start and an end endpoint. Merged chains keep the
+    # outer endpoints of both chains, so a tree of the initial endpoints
+    # contains all endpoints there will ever be
+    endpoints = [node for chain in chains for node in chain.coordinates[[0, -1]].astype(float)]
+    if len(endpoints) == 0:
+        return
+    tree = cKDTree(endpoints)
+    owners = [(index, end) for index in range(len(chains)) for end in (0, 1)]
+    chain_ends = [[2 * index, 2 * index + 1] for index in range(len(chains))]
+    chains_by_index = list(chains)
+    versions = [0] * len(chains)
+
+    heap = list()
+
+    def push_connections(index):
+        for end in (0, 1):
+            endpoint = chain_ends[index][end]
+            for other_endpoint in tree.query_ball_point(endpoints[endpoint], max_distance + 1e-6):
+                if owners[other_endpoint] is None or owners[other_endpoint][0] == index:
+                    continue
+
+                other_index, other_end = owners[other_endpoint]
+                distance = get_distance(endpoints[endpoint], endpoints[other_endpoint])
+                if min_distance < distance < max_distance:
+                    heapq.heappush(heap, (distance, index, other_index, 2 * end + other_end,
+                                          versions[index], versions[other_index]))
+                    heapq.heappush(heap, (distance, other_index, index, 2 * other_end + end,
+                                          versions[other_index], versions[index]))
+
+    for index in range(len(chains)):
+        push_connections(index)
+
+    while len(heap) > 0:
+        _, index1, index2, combination, version1, version2 = heapq.heappop(heap)
+        if version1 != versions[index1] or version2 != versions[index2]:
+            continue
+
+        chain1, chain2 = chains_by_index[index1], chains_by_index[index2]
+        at1 = 0 if combination < 2 else len(chain1) - 1
+        at2 = 0 if combination % 2 == 0 else len(chain2) - 1
+        ends1, ends2 = chain_ends[index1], chain_ends[index2]
+
+        # Find which chain is kept by 'merge_chains' and its new endpoints
+        if at1 == 0 and at2 == 0:
+            kept, removed, new_ends = index1, index2, [ends2[1], ends1[1]]
+        elif at1 == 0:
+            kept, removed, new_ends = index2, index1, [ends2[0], ends1[1]]
+        elif at2 == 0:
+            kept, removed, new_ends = index1, index2, [ends1[0], ends2[1]]
+        else:
+            kept, removed, new_ends = index1, index2, [ends1[0], ends2[0]]
+
+        merge_chains(chains, chain1, chain2, at1, at2)
+
+        for endpoint in ends1 + ends2:
+            owners[endpoint] = None
+        owners[new_ends[0]] = (kept, 0)
+        owners[new_ends[1]] = (kept, 1)
+        chain_ends[kept] = new_ends
+        versions[kept] += 1
+        versions[removed] = -1
+
+        push_connections(kept)
 
 
 def merge_chains(chains, chain1, chain2, at1, at2):
     if at1 == 0 and at2 == 0:
-        chain1.helices = reverse_indices(chain2.helices, chain2.nodes) + add_offset(chain1.helices, len(chain2.nodes))
-        chain1.sheets = reverse_indices(chain2.sheets, chain2.nodes) + add_offset(chain1.sheets, len(chain2.nodes))
-        chain1.nodes = chain2.nodes[::-1] + chain1.nodes
+        chain2.reverse()
+        chain1.concatenate(chain2, prepend=True)
         chains.remove(chain2)
     elif at1 == 0:
-        chain2.helices += add_offset(chain1.helices, len(chain2.nodes))
-        chain2.sheets += add_offset(chain1.sheets, len(chain2.nodes))
-        chain2.nodes += chain1.nodes
+        chain2.concatenate(chain1)
         chains.remove(chain1)
     elif at2 == 0:
-        chain1.helices += add_offset(chain2.helices, len(chain1.nodes))
-        chain1.sheets += add_offset(chain2.sheets, len(chain1.nodes))
-        chain1.nodes += chain2.nodes
+        chain1.concatenate(chain2)
         chains.remove(chain2)
     else:
-        chain1.helices += add_offset(reverse_indices(chain2.helices, chain2.nodes), len(chain1.nodes))
-        chain1.sheets += add_offset(reverse_indices(chain2.sheets, chain2.nodes), len(chain1.nodes))
+        chain2.reverse()
+        chain1.concatenate(chain2)
         chains.remove(chain2)
-        chain1.nodes += chain2.nodes[::-1]
-
-
-def add_offset(sse, offset):
-    return [[i + offset for i in i_s] for i_s in sse]
-
-
-def reverse_indices(sse, nodes):
-    return [[len(nodes) - i - 1 for i in i_s][::-1] for i_s in sse][::-1]
 
 
 def get_distance(point1, point2):
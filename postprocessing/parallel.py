@@ -0,0 +1,31 @@
+"""Helper to distribute independent post-processing work over processes
+
+The prediction pipeline already runs every protein in its own pool worker.
+Pool workers are daemonic processes and cannot start a pool of their own, so
+the work is executed serially whenever the current process is such a worker.
+"""
+
+from multiprocessing import cpu_count, current_process, Pool
+
+
+def parallel_map(function, params_list, processes=None):
+    """Applies 'function' to every element of 'params_list' using a process
+    pool and returns the results in order
+
+    Parameters
+    ----------
+    function: callable
+        Module level function which accepts a single parameter
+
+    params_list: list
+        Parameters for the function calls
+
+    processes: int
+        Maximum number of processes, defaults to the number of cpus
+    """
+    processes = min(processes or cpu_count(), len(params_list))
+    if processes <= 1 or current_process().daemon:
+        return [function(params) for params in params_list]
+
+    with Pool(processes) as pool:
+        return pool.map(function, params_list, chunksize=1)
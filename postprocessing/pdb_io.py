@@ -0,0 +1,404 @@
+"""Reads and writes the records of pdb files used by the prediction
+
+Files are read in a single pass: all lines are loaded into a fixed-width byte
+array and every field is parsed for all records at once by slicing its
+columns. Records are written by formatting all of them with a single format
+operation.
+
+ATOM records are returned as structured array with the fields 'name' (columns
+13-16), 'residue' (residue sequence number), 'segment' (number of TER records
+preceding the atom) and 'coordinates'. HELIX and SHEET records are returned as
+(K, 2) arrays of their start and end residue sequence numbers.
+"""
+
+from collections import namedtuple
+import numpy as np
+from six.moves import range
+from six.moves import zip
+
+digits_upper = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+digits_lower = digits_upper.lower()
+digits_upper_values = dict([pair for pair in zip(digits_upper, range(36))])
+digits_lower_values = dict([pair for pair in zip(digits_lower, range(36))])
+
+class Hybrid36:
+    """
+                   Prototype/reference implementation for
+                          encoding and decoding
+                         atom serial numbers and
+                         residue sequence numbers
+                              in PDB files.
+
+    PDB ATOM and HETATM records reserve columns 7-11 for the atom serial
+    number. This 5-column number is used as a reference in the CONECT
+    records, which also reserve exactly five columns for each serial
+    number.
+
+    With the decimal counting system only up to 99999 atoms can be stored
+    and uniquely referenced in a PDB file. A simple extension to enable
+    processing of more atoms is to adopt a counting system with more than
+    ten digits. To maximize backward compatibility, the counting system is
+    only applied for numbers greater than 99999. The "hybrid-36" counting
+    system implemented in this file is:
+
+      ATOM      1
+      ...
+      ATOM  99999
+      ATOM  A0000
+      ATOM  A0001
+      ...
+      ATOM  A0009
+      ATOM  A000A
+      ...
+      ATOM  A000Z
+      ATOM  ZZZZZ
+      ATOM  a0000
+      ...
+      ATOM  zzzzz
+
+    I.e. the first 99999 serial numbers are represented as usual. The
+    following atoms use a base-36 system (10 digits + 26 letters) with
+    upper-case letters. 43670016 (26*36**4) additional atoms can be
+    numbered this way. If there are more than 43770015 (99999+43670016)
+    atoms, a base-36 system with lower-case letters is used, allowing for
+    43670016 additional atoms. I.e. in total 87440031 (99999+2*43670016)
+    atoms can be stored and uniquely referenced via CONECT records.
+
+    The counting system is designed to avoid lower-case letters until the
+    range of numbers addressable by upper-case letters is exhausted.
+    Importantly, with this counting system the distinction between
+    "traditional" and "extended" PDB files becomes evident only if there
+    are more than 99999 atoms to be stored. Programs that are
+    updated to support the hybrid-36 counting system will continue to
+    interoperate with programs that do not as long as there are less than
+    100000 atoms.
+
+    PDB ATOM and HETATM records also reserve columns 23-26 for the residue
+    sequence number. This 4-column number is used as a reference in other
+    record types (SSBOND, LINK, HYDBND, SLTBRG, CISPEP), which also reserve
+    exactly four columns for each sequence number.
+
+    With the decimal counting system only up to 9999 residues per chain can
+    be stored and uniquely referenced in a PDB file. If the hybrid-36
+    system is adopted, 1213056 (26*36**3) additional residues can be
+    numbered using upper-case letters, and the same number again using
+    lower-case letters. I.e. in total each chain may contain up to 2436111
+    (9999+2*1213056) residues that can be uniquely referenced from the
+    other record types given above.
+
+    The implementation in this file should run with Python 2.2 or higher.
+    There are no other requirements. Run this script without arguments to
+    obtain usage examples.
+
+    Note that there are only about 60 lines of "real" code. The rest is
+    documentation and unit tests.
+
+    To update an existing program to support the hybrid-36 counting system,
+    simply replace the existing read/write source code for integer values
+    with equivalents of the hy36decode() and hy36encode() functions below.
+
+    This file is unrestricted Open Source (cctbx.sf.net).
+    Please send corrections and enhancements to cctbx@cci.lbl.gov .
+
+    See also:
+      http://cci.lbl.gov/hybrid_36/
+      http://www.pdb.org/ "Dictionary & File Formats"
+
+    Ralf W. Grosse-Kunstleve, Feb 2007.
+
+    Retrieved From: https://github.com/cctbx/cctbx_project/blob/master/iotbx/pdb/hybrid_36.py
+    On: August 7, 2019
+    """
+    def __encode_pure(digits, value):
+      "encodes value using the given digits"
+      assert value >= 0
+      if (value == 0): return digits[0]
+      n = len(digits)
+      result = []
+      while (value != 0):
+        rest = value // n
+        result.append(digits[value - rest * n])
+        value = rest
+      result.reverse()
+      return "".join(result)
+
+    def __decode_pure(digits_values, s):
+      "decodes the string s using the digit, value associations for each character"
+      result = 0
+      n = len(digits_values)
+      for c in s:
+        result *= n
+        result += digits_values[c]
+      return result
+
+    def hy36encode(width, value):
+      "encodes value as base-10/upper-case base-36/lower-case base-36 hybrid"
+      i = value
+      if (i >= 1-10**(width-1)):
+        if (i < 10**width):
+          return ("%%%dd" % width) % i
+        i -= 10**width
+        if (i < 26*36**(width-1)):
+          i += 10*36**(width-1)
+          return Hybrid36.__encode_pure(digits_upper, i)
+        i -= 26*36**(width-1)
+        if (i < 26*36**(width-1)):
+          i += 10*36**(width-1)
+          return Hybrid36.__encode_pure(digits_lower, i)
+      raise ValueError("value out of range.")
+
+    def hy36decode(width, s):
+      "decodes base-10/upper-case base-36/lower-case base-36 hybrid"
+      if (len(s) == width):
+        f = s[0]
+        if (f == "-" or f == " " or f.isdigit()):
+          try: return int(s)
+          except ValueError: pass
+          if (s == " "*width): return 0
+        elif (f in digits_upper_values):
+          try: return Hybrid36.__decode_pure(
+            digits_values=digits_upper_values, s=s) - 10*36**(width-1) + 10**width
+          except KeyError: pass
+        elif (f in digits_lower_values):
+          try: return Hybrid36.__decode_pure(
+            digits_values=digits_lower_values, s=s) + 16*36**(width-1) + 10**width
+          except KeyError: pass
+      raise ValueError("invalid number literal.")
+
+
+def get_digit_values(digits):
+    """Returns table of the value of every hybrid-36 digit by its byte, -1
+    for bytes which are no digits"""
+    values = np.full(256, -1, dtype=np.int64)
+    values[np.frombuffer(digits.encode(), dtype=np.uint8)] = np.arange(len(digits))
+
+    return values
+
+
+UPPER_VALUES = get_digit_values(digits_upper)
+LOWER_VALUES = get_digit_values(digits_lower)
+
+ATOM_DTYPE = np.dtype([('name', 'S4'), ('residue', np.int64), ('segment', np.int64), ('coordinates', np.float64, (3,))])
+
+PDBRecords = namedtuple('PDBRecords', ['atoms', 'helices', 'sheets', 'segments'])
+
+LINE_WIDTH = 80
+
+
+def read_pdb(file_name):
+    """Reads ATOM, HELIX, SHEET and TER records of a pdb file
+
+    Records which cannot be parsed are reported and skipped.
+
+    Parameters
+    ----------
+    file_name: str
+        Name of the pdb file
+
+    Returns
+    ----------
+    records: PDBRecords
+        Structured array of the atoms, arrays of the helices and sheets and the
+        number of segments, which is the number of TER records plus one
+    """
+    with open(file_name, 'rb') as pdb_file:
+        lines = np.array(pdb_file.read().splitlines(), dtype='S%d' % LINE_WIDTH)
+    columns = lines.view('S1').reshape((-1, LINE_WIDTH))
+
+    record_types = get_column(columns, 0, 6)
+    is_ter = np.char.startswith(record_types, b'TER')
+    segments = np.cumsum(is_ter)
+
+    is_atom = np.char.startswith(record_types, b'ATOM')
+    atom_columns, atom_lines = columns[is_atom], lines[is_atom]
+    residues, valid = parse_residues(atom_columns[:, 22:26], atom_lines)
+    coordinates = list()
+    for start in (30, 38, 46):
+        values, valid_values = parse_column(get_column(atom_columns, start, start + 8), atom_lines, np.float64, float)
+        coordinates.append(values)
+        valid &= valid_values
+
+    atoms = np.zeros(np.count_nonzero(valid), dtype=ATOM_DTYPE)
+    atoms['name'] = get_column(atom_columns, 12, 16)[valid]
+    atoms['residue'] = residues[valid]
+    atoms['segment'] = segments[is_atom][valid]
+    atoms['coordinates'] = np.stack(coordinates, axis=1)[valid]
+
+    helices = read_intervals(columns, lines, np.char.startswith(record_types, b'HELIX'), 21)
+    sheets = read_intervals(columns, lines, np.char.startswith(record_types, b'SHEET'), 22)
+
+    return PDBRecords(atoms, helices, sheets, int(np.count_nonzero(is_ter)) + 1)
+
+
+def read_intervals(columns, lines, rows, start):
+    """Returns start and end residue sequence numbers of HELIX or SHEET
+    records, the start being read from the four columns at 'start'"""
+    starts, valid_starts = parse_residues(columns[rows, start:start + 4], lines[rows])
+    ends, valid_ends = parse_residues(columns[rows, 33:37], lines[rows])
+    valid = valid_starts & valid_ends
+
+    return np.stack((starts[valid], ends[valid]), axis=1).reshape((-1, 2))
+
+
+def get_column(columns, start, end):
+    """Returns array of the bytes between 'start' and 'end' of every line"""
+    return np.ascontiguousarray(columns[:, start:end]).view('S%d' % (end - start)).ravel()
+
+
+def parse_column(column, lines, dtype, parse):
+    """Parses all values of a column at once as 'dtype'
+
+    If a value cannot be parsed, the values are parsed one after the other
+    with 'parse' and records with invalid values are reported.
+
+    Returns
+    ----------
+    values: ndarray
+        Parsed values, 0 for invalid values
+
+    valid: ndarray
+        Boolean mask of the valid values
+    """
+    try:
+        return column.astype(dtype), np.ones(len(column), dtype=bool)
+    except ValueError:
+        pass
+
+    values = np.zeros(len(column), dtype=dtype)
+    valid = np.ones(len(column), dtype=bool)
+    for i, value in enumerate(column):
+        try:
+            values[i] = parse(value.decode())
+        except ValueError as error:
+            print('Error parsing ' + lines[i].decode() + '\n' + str(error))
+            valid[i] = False
+
+    return values, valid
+
+
+def parse_residues(columns, lines):
+    """Parses residue sequence numbers from (N, 4) array of their columns
+
+    Numbers starting with a letter are hybrid-36 encoded, they are decoded
+    at once by looking up the value of every digit.
+    """
+    values = np.zeros(len(columns), dtype=np.int64)
+    valid = np.ones(len(columns), dtype=bool)
+    decoded = np.zeros(len(columns), dtype=bool)
+
+    digits = columns.view(np.uint8)
+    for table, offset in ((UPPER_VALUES, 10 ** 4 - 10 * 36 ** 3), (LOWER_VALUES, 10 ** 4 + 16 * 36 ** 3)):
+        digit_values = table[digits]
+        rows = (digit_values[:, 0] >= 10) & np.all(digit_values >= 0, axis=1)
+        values[rows] = np.dot(digit_values[rows], 36 ** np.arange(3, -1, -1)) + offset
+        decoded |= rows
+
+    # All other numbers are decimal or invalid
+    rows = ~decoded
+    values[rows], valid[rows] = parse_column(get_column(columns[rows], 0, 4), lines[rows], np.int64, decode_residue)
+
+    return values, valid
+
+
+def decode_residue(value):
+    """Decodes residue sequence number which may be hybrid-36 encoded"""
+    return Hybrid36.hy36decode(4, value.ljust(4))
+
+
+def encode_residues(residues):
+    """Returns list of the residue sequence numbers encoded as hybrid-36
+
+    Numbers which do not fit into four decimal digits are encoded at once by
+    computing their base-36 digits."""
+    residues = np.asarray(residues, dtype=np.int64).ravel()
+    if np.any(residues <= -1000) or np.any(residues >= 10 ** 4 + 2 * 26 * 36 ** 3):
+        raise ValueError("value out of range.")
+
+    encoded = residues.astype('U4')
+    for digits, start, offset in ((digits_upper, 10 ** 4, 10 ** 4 - 10 * 36 ** 3),
+                                  (digits_lower, 10 ** 4 + 26 * 36 ** 3, 10 ** 4 + 16 * 36 ** 3)):
+        rows = (residues >= start) & (residues < start + 26 * 36 ** 3)
+        values = (residues[rows] - offset)[:, None] // 36 ** np.arange(3, -1, -1) % 36
+        characters = np.array([ord(digit) for digit in digits], dtype=np.uint32)[values]
+        encoded[rows] = np.ascontiguousarray(characters).view('U4').ravel()
+
+    return encoded.tolist()
+
+
+def format_atoms(coordinates, residues, chain='A'):
+    """Formats Ca atoms as ATOM records
+
+    Parameters
+    ----------
+    coordinates: array_like
+        (N, 3) coordinates of the atoms
+
+    residues: array_like
+        Residue sequence numbers of the atoms
+
+    chain: str
+        Chain identifier of the atoms
+    """
+    coordinates = np.asarray(coordinates, dtype=np.float64).reshape((-1, 3))
+
+    return (get_atom_format(chain) * len(coordinates)) % get_atom_values(coordinates, residues)
+
+
+def format_chains(chains, chain='A', ter=True):
+    """Formats Ca atoms of consecutive chains as ATOM records
+
+    Residue sequence numbers are counted over all chains, leaving a gap of one
+    between two chains. If 'ter' is set every chain is followed by a TER
+    record.
+
+    Parameters
+    ----------
+    chains: list
+        List of (N, 3) coordinates of every chain
+    """
+    atom_format = get_atom_format(chain)
+    chain_formats = list()
+    residues = list()
+    offset = 0
+    for coordinates in chains:
+        chain_formats.append(atom_format * len(coordinates) + ('TER\n' if ter else ''))
+        residues.append(np.arange(offset + 1, offset + len(coordinates) + 1))
+        offset += len(coordinates) + 1
+
+    if len(chains) == 0:
+        return ''
+
+    coordinates = np.concatenate([np.asarray(c, dtype=np.float64).reshape((-1, 3)) for c in chains])
+
+    return ''.join(chain_formats) % get_atom_values(coordinates, np.concatenate(residues))
+
+
+def get_atom_values(coordinates, residues):
+    """Returns tuple of the encoded residue sequence number and coordinates of
+    every atom, in the order of the fields of the ATOM format"""
+    values = np.empty((len(coordinates), 4), dtype=object)
+    values[:, 0] = encode_residues(residues)
+    values[:, 1:] = coordinates
+
+    return tuple(values.ravel().tolist())
+
+
+def format_helices(intervals, chain='A'):
+    """Formats HELIX records from (K, 2) array of start and end atom indices,
+    which are written as residue sequence numbers counted from one"""
+    return format_intervals('HELIX    1   1 GLY ' + chain + ' %4s  GLY ' + chain + ' %4s  1\n', intervals)
+
+
+def format_sheets(intervals, chain='A'):
+    """Formats SHEET records, see 'format_helices'"""
+    return format_intervals('SHEET    1   A 6 GLY ' + chain + '%4s  GLY ' + chain + '%4s  0\n', intervals)
+
+
+def format_intervals(interval_format, intervals):
+    intervals = np.asarray(intervals, dtype=np.int64).reshape((-1, 2))
+
+    return (interval_format * len(intervals)) % tuple(encode_residues(intervals.ravel() + 1))
+
+
+def get_atom_format(chain):
+    return 'ATOM      1  CA  GLY ' + chain + '%4s    %8.3f%8.3f%8.3f  1.00  0.00           C  \n'
@@ -1,167 +1,164 @@
+import os
 import numpy as np
-from six.moves import range
-from six.moves import zip
+from collections.abc import MutableSequence
+from . import pdb_io
+from .pdb_io import Hybrid36
 
-digits_upper = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
-digits_lower = digits_upper.lower()
-digits_upper_values = dict([pair for pair in zip(digits_upper, range(36))])
-digits_lower_values = dict([pair for pair in zip(digits_lower, range(36))])
+class Chain:
+    """Tracks nodes, sheets, and helices for a certain chain
 
-########################################################################################################################
-# Data IO methods
-########################################################################################################################
+    The coordinates of all nodes are stored in a single (N, 3) float32 array
+    whose capacity grows geometrically, so appending nodes takes amortized
+    constant time. Helices and sheets are stored as int32 (K, 2) arrays of
+    [start, end] node indices.
 
-class Hybrid36:
-    """
-                   Prototype/reference implementation for
-                          encoding and decoding
-                         atom serial numbers and
-                         residue sequence numbers
-                              in PDB files.
-
-    PDB ATOM and HETATM records reserve columns 7-11 for the atom serial
-    number. This 5-column number is used as a reference in the CONECT
-    records, which also reserve exactly five columns for each serial
-    number.
-
-    With the decimal counting system only up to 99999 atoms can be stored
-    and uniquely referenced in a PDB file. A simple extension to enable
-    processing of more atoms is to adopt a counting system with more than
-    ten digits. To maximize backward compatibility, the counting system is
-    only applied for numbers greater than 99999. The "hybrid-36" counting
-    system implemented in this file is:
-
-      ATOM      1
-      ...
-      ATOM  99999
-      ATOM  A0000
-      ATOM  A0001
-      ...
-      ATOM  A0009
-      ATOM  A000A
-      ...
-      ATOM  A000Z
-      ATOM  ZZZZZ
-      ATOM  a0000
-      ...
-      ATOM  zzzzz
-
-    I.e. the first 99999 serial numbers are represented as usual. The
-    following atoms use a base-36 system (10 digits + 26 letters) with
-    upper-case letters. 43670016 (26*36**4) additional atoms can be
-    numbered this way. If there are more than 43770015 (99999+43670016)
-    atoms, a base-36 system with lower-case letters is used, allowing for
-    43670016 additional atoms. I.e. in total 87440031 (99999+2*43670016)
-    atoms can be stored and uniquely referenced via CONECT records.
-
-    The counting system is designed to avoid lower-case letters until the
-    range of numbers addressable by upper-case letters is exhausted.
-    Importantly, with this counting system the distinction between
-    "traditional" and "extended" PDB files becomes evident only if there
-    are more than 99999 atoms to be stored. Programs that are
-    updated to support the hybrid-36 counting system will continue to
-    interoperate with programs that do not as long as there are less than
-    100000 atoms.
-
-    PDB ATOM and HETATM records also reserve columns 23-26 for the residue
-    sequence number. This 4-column number is used as a reference in other
-    record types (SSBOND, LINK, HYDBND, SLTBRG, CISPEP), which also reserve
-    exactly four columns for each sequence number.
-
-    With the decimal counting system only up to 9999 residues per chain can
-    be stored and uniquely referenced in a PDB file. If the hybrid-36
-    system is adopted, 1213056 (26*36**3) additional residues can be
-    numbered using upper-case letters, and the same number again using
-    lower-case letters. I.e. in total each chain may contain up to 2436111
-    (9999+2*1213056) residues that can be uniquely referenced from the
-    other record types given above.
-
-    The implementation in this file should run with Python 2.2 or higher.
-    There are no other requirements. Run this script without arguments to
-    obtain usage examples.
-
-    Note that there are only about 60 lines of "real" code. The rest is
-    documentation and unit tests.
-
-    To update an existing program to support the hybrid-36 counting system,
-    simply replace the existing read/write source code for integer values
-    with equivalents of the hy36decode() and hy36encode() functions below.
-
-    This file is unrestricted Open Source (cctbx.sf.net).
-    Please send corrections and enhancements to cctbx@cci.lbl.gov .
-
-    See also:
-      http://cci.lbl.gov/hybrid_36/
-      http://www.pdb.org/ "Dictionary & File Formats"
-
-    Ralf W. Grosse-Kunstleve, Feb 2007.
-
-    Retrieved From: https://github.com/cctbx/cctbx_project/blob/master/iotbx/pdb/hybrid_36.py
-    On: August 7, 2019
+    'nodes' is a list-like view on the coordinates for code which works on
+    single nodes. Nodes are read from it as float64 copies.
+
+    Parameters
+    ----------
+    coordinates: array_like
+        Optional (N, 3) coordinates of the nodes
+
+    helices: array_like
+        Optional (K, 2) start and end indices of the helices
+
+    sheets: array_like
+        Optional (K, 2) start and end indices of the sheets
     """
-    def __encode_pure(digits, value):
-      "encodes value using the given digits"
-      assert value >= 0
-      if (value == 0): return digits[0]
-      n = len(digits)
-      result = []
-      while (value != 0):
-        rest = value // n
-        result.append(digits[value - rest * n])
-        value = rest
-      result.reverse()
-      return "".join(result)
-
-    def __decode_pure(digits_values, s):
-      "decodes the string s using the digit, value associations for each character"
-      result = 0
-      n = len(digits_values)
-      for c in s:
-        result *= n
-        result += digits_values[c]
-      return result
-
-    def hy36encode(width, value):
-      "encodes value as base-10/upper-case base-36/lower-case base-36 hybrid"
-      i = value
-      if (i >= 1-10**(width-1)):
-        if (i < 10**width):
-          return ("%%%dd" % width) % i
-        i -= 10**width
-        if (i < 26*36**(width-1)):
-          i += 10*36**(width-1)
-          return Hybrid36.__encode_pure(digits_upper, i)
-        i -= 26*36**(width-1)
-        if (i < 26*36**(width-1)):
-          i += 10*36**(width-1)
-          return Hybrid36.__encode_pure(digits_lower, i)
-      raise ValueError("value out of range.")
-
-    def hy36decode(width, s):
-      "decodes base-10/upper-case base-36/lower-case base-36 hybrid"
-      if (len(s) == width):
-        f = s[0]
-        if (f == "-" or f == " " or f.isdigit()):
-          try: return int(s)
-          except ValueError: pass
-          if (s == " "*width): return 0
-        elif (f in digits_upper_values):
-          try: return Hybrid36.__decode_pure(
-            digits_values=digits_upper_values, s=s) - 10*36**(width-1) + 10**width
-          except KeyError: pass
-        elif (f in digits_lower_values):
-          try: return Hybrid36.__decode_pure(
-            digits_values=digits_lower_values, s=s) + 16*36**(width-1) + 10**width
-          except KeyError: pass
-      raise ValueError("invalid number literal.")
 
+    __slots__ = ('_coordinates', '_length', '_helices', '_sheets')
+
+    def __init__(self, coordinates=(), helices=(), sheets=()):
+        self._coordinates = np.zeros((0, 3), dtype=np.float32)
+        self._length = 0
+        self.coordinates = coordinates
+        self.helices = helices
+        self.sheets = sheets
+
+    def __len__(self):
+        return self._length
+
+    @property
+    def coordinates(self):
+        """(N, 3) float32 view on the coordinates of the nodes"""
+        return self._coordinates[:self._length]
+
+    @coordinates.setter
+    def coordinates(self, coordinates):
+        self._coordinates = np.array(coordinates, dtype=np.float32).reshape((-1, 3))
+        self._length = len(self._coordinates)
+
+    @property
+    def nodes(self):
+        return NodeList(self)
+
+    @nodes.setter
+    def nodes(self, nodes):
+        self.coordinates = list(nodes)
+
+    @property
+    def helices(self):
+        return self._helices
+
+    @helices.setter
+    def helices(self, helices):
+        self._helices = np.array(helices, dtype=np.int32).reshape((-1, 2))
+
+    @property
+    def sheets(self):
+        return self._sheets
+
+    @sheets.setter
+    def sheets(self, sheets):
+        self._sheets = np.array(sheets, dtype=np.int32).reshape((-1, 2))
+
+    def append(self, node):
+        """Appends single node to the end of the chain"""
+        self.__reserve(self._length + 1)
+        self._coordinates[self._length] = node
+        self._length += 1
+
+    def reverse(self):
+        """Reverses the order of the nodes and secondary structures in place"""
+        self.coordinates = self.coordinates[::-1]
+        self.helices = reverse_intervals(self.helices, self._length)
+        self.sheets = reverse_intervals(self.sheets, self._length)
+
+    def concatenate(self, other, prepend=False):
+        """Adds the nodes and secondary structures of 'other' to the end of
+        the chain, or to its front if 'prepend' is set"""
+        if prepend:
+            self.helices = np.concatenate((other.helices, offset_intervals(self.helices, len(other))))
+            self.sheets = np.concatenate((other.sheets, offset_intervals(self.sheets, len(other))))
+            self.coordinates = np.concatenate((other.coordinates, self.coordinates))
+        else:
+            self.helices = np.concatenate((self.helices, offset_intervals(other.helices, self._length)))
+            self.sheets = np.concatenate((self.sheets, offset_intervals(other.sheets, self._length)))
+            self.__reserve(self._length + len(other))
+            self._coordinates[self._length:self._length + len(other)] = other.coordinates
+            self._length += len(other)
+
+    def __reserve(self, length):
+        if length > len(self._coordinates):
+            coordinates = np.zeros((max(length, 2 * len(self._coordinates), 16), 3), dtype=np.float32)
+            coordinates[:self._length] = self.coordinates
+            self._coordinates = coordinates
+
+
+class NodeList(MutableSequence):
+    """List-like view on the nodes of a 'Chain'"""
+
+    __slots__ = ('chain',)
+
+    def __init__(self, chain):
+        self.chain = chain
+
+    def __len__(self):
+        return len(self.chain)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self.chain.coordinates[index].astype(np.float64))
+
+        return self.chain.coordinates[index].astype(np.float64)
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            coordinates = self.chain.coordinates
+            start, stop, step = index.indices(len(coordinates))
+            if step != 1:
+                raise ValueError('Only contiguous slices of nodes can be assigned')
+            stop = max(start, stop)
+            value = np.array(list(value), dtype=np.float32).reshape((-1, 3))
+            self.chain.coordinates = np.concatenate((coordinates[:start], value, coordinates[stop:]))
+        else:
+            self.chain.coordinates[index] = value
+
+    def __delitem__(self, index):
+        self.chain.coordinates = np.delete(self.chain.coordinates, index, axis=0)
+
+    def insert(self, index, value):
+        self.chain.coordinates = np.insert(self.chain.coordinates, index, value, axis=0)
+
+    def append(self, value):
+        self.chain.append(value)
+
+
+def split(array, counts):
+    """Splits array into consecutive parts of the given lengths"""
+    return np.split(array, np.cumsum(counts)[:-1]) if len(counts) > 0 else []
 
-class Chain:
-    """Tracks nodes, sheets, and helices for a certain chain"""
-    def __init__(self):
-        self.nodes = []
-        self.sheets = []
-        self.helices = []
+
+def offset_intervals(intervals, offset):
+    """Returns intervals of node indices shifted by 'offset'"""
+    return intervals + offset
+
+
+def reverse_intervals(intervals, length):
+    """Returns intervals of node indices of a chain of given length after the
+    chain was reversed"""
+    return (length - 1 - intervals)[::-1, ::-1]
 
 
 class PDB_Reader_Writer:
@@ -183,51 +180,72 @@ class PDB_Reader_Writer:
         Information about helices is not parsed from the pbd file but rather has to
         be parsed from the helix mrc file
         """
-        chains = [Chain()]
-        with open(pdb_name) as pdb_file:
-            for line in pdb_file:
-                if 'TER' in line:
-                    chains.append(Chain())
-                try:
-                    if line[:4] == 'ATOM':
-                        data = self.__parse_node(line)
-                        chains[-1].nodes.append(data)
-                    elif line[:5] == 'HELIX':
-                        data, i = self.__parse_helix(line, chains)
-                        chains[i].helices.append(data)
-                    elif line[:5] == 'SHEET':
-                        data, i = self.__parse_sheet(line, chains)
-                        chains[i].sheets.append(data)
-                except ValueError as error:
-                    print('Error parsing ' + line + str(error))
+        records = pdb_io.read_pdb(pdb_name)
+        lengths = np.bincount(records.atoms['segment'], minlength=records.segments)
+        nodes = np.split(records.atoms['coordinates'], np.cumsum(lengths)[:-1])
+        helices = self.__split_intervals(records.helices - 1, lengths, 'left')
+        sheets = self.__split_intervals(records.sheets - 1, lengths, 'right')
+
+        chains = [Chain(*chain) for chain in zip(nodes, helices, sheets)]
 
         return chains
 
 
     def write_pdb(self, chains, file_name):
         """Writes nodes and secondary structure info to pdb file with given name"""
-        nodes_str = []
-        helices_str = []
-        sheets_str = []
+        offsets = np.cumsum([0] + [len(chain) + 1 for chain in chains[:-1]])
+        helices = [chain.helices + offset for chain, offset in zip(chains, offsets)]
+        sheets = [chain.sheets + offset for chain, offset in zip(chains, offsets)]
 
-        offset = 0
-        for chain in chains:
-            for i in range(len(chain.nodes)):
-                nodes_str.append(self.__format_node(chain.nodes[i], 'A', offset + i + 1))
-            nodes_str.append('TER\n')
+        with open(file_name, 'w') as pdb_file:
+            pdb_file.write(pdb_io.format_chains([chain.coordinates for chain in chains]))
+            pdb_file.write(pdb_io.format_helices(np.concatenate(helices) if helices else ()))
+            pdb_file.write(pdb_io.format_sheets(np.concatenate(sheets) if sheets else ()))
 
-            for helix_start, helix_end in chain.helices:
-                helices_str.append(self.__format_helix_info('A', helix_start + offset, helix_end + offset))
 
-            for sheet_start, sheet_end in chain.sheets:
-                sheets_str.append(self.__format_sheet_info('A', sheet_start + offset, sheet_end + offset))
+    def read_chains(self, file_name):
+        """Reads chains from binary file written by 'write_chains'"""
+        with np.load(file_name) as data:
+            nodes = split(data['coordinates'], data['lengths'])
+            helices = split(data['helices'], data['helix_counts'])
+            sheets = split(data['sheets'], data['sheet_counts'])
 
-            offset += len(chain.nodes) + 1
+        return [Chain(*chain) for chain in zip(nodes, helices, sheets)]
 
-        with open(file_name, 'w') as pdb_file:
-            pdb_file.write(''.join(nodes_str))
-            pdb_file.write(''.join(helices_str))
-            pdb_file.write(''.join(sheets_str))
+
+    def write_chains(self, chains, file_name, debug=False):
+        """Writes chains to binary file with given name
+
+        The file is used to pass chains from one post-processing step to the
+        next without parsing them and without rounding their coordinates. If
+        'debug' is set the chains are additionally written to a pdb file of the
+        same name."""
+        with open(file_name, 'wb') as chains_file:
+            np.savez(chains_file,
+                     lengths=np.array([len(chain) for chain in chains], dtype=np.int64),
+                     coordinates=np.concatenate([chain.coordinates for chain in chains] + [np.zeros((0, 3), np.float32)]),
+                     helix_counts=np.array([len(chain.helices) for chain in chains], dtype=np.int64),
+                     helices=np.concatenate([chain.helices for chain in chains] + [np.zeros((0, 2), np.int32)]),
+                     sheet_counts=np.array([len(chain.sheets) for chain in chains], dtype=np.int64),
+                     sheets=np.concatenate([chain.sheets for chain in chains] + [np.zeros((0, 2), np.int32)]))
+
+        if debug:
+            self.write_pdb(chains, os.path.splitext(file_name)[0] + '.pdb')
+
+
+    @staticmethod
+    def __split_intervals(intervals, lengths, side):
+        """Splits secondary structure intervals of all chains, which are
+        counted over all chains, into the intervals of every chain
+
+        An interval belongs to the first chain whose last index (plus one if
+        'side' is 'left') is at least the interval's end index."""
+        starts = np.cumsum(lengths + 1) - (lengths + 1)
+        indices = np.searchsorted(starts + lengths, intervals[:, 1], side=side)
+        for interval in intervals[indices >= len(lengths)]:
+            print('Error parsing interval ' + str(interval + 1) + ' which exceeds all chains')
+
+        return [intervals[indices == i] - starts[i] for i in range(len(lengths))]
 
 
     @staticmethod
@@ -272,73 +290,19 @@ class PDB_Reader_Writer:
                          float(line[46:54])])
 
 
-    @staticmethod
-    def __parse_helix(line, chains):
-        """Parses helix data from given 'line' and calculates chain index 'i' from
-        'chains'"""
-        i = 0
-        data = [Hybrid36.hy36decode(4, line[21:25]) - 1, Hybrid36.hy36decode(4, line[33:37]) - 1]
-        for chain in chains:
-            if data[1] <= len(chain.nodes):
-                break
-
-            data[0] -= len(chain.nodes) + 1
-            data[1] -= len(chain.nodes) + 1
-            i += 1
-
-        return data, i
-
-
-    @staticmethod
-    def __parse_sheet(line, chains):
-        """Parses sheet data from given 'line' and calculates chain index 'i' from
-        'chains'"""
-        i = 0
-        data = [Hybrid36.hy36decode(4, line[22:26]) - 1, Hybrid36.hy36decode(4, line[33:37]) - 1]
-        for chain in chains:
-            if data[1] < len(chain.nodes):
-                break
-
-            data[0] -= len(chain.nodes) + 1
-            data[1] -= len(chain.nodes) + 1
-            i += 1
-
-        return data, i
-
-
     @staticmethod
     def __format_node(node, chain, n):
         """Encodes node to str in PDB format"""
-        return \
-            'ATOM      1  CA  GLY ' + \
-            chain + \
-            Hybrid36.hy36encode(4, n).rjust(4) + '    ' + \
-            '{0:.3f}'.format(node[0]).rjust(8) + \
-            '{0:.3f}'.format(node[1]).rjust(8) + \
-            '{0:.3f}'.format(node[2]).rjust(8) + \
-            '  1.00  0.00           C  \n'
+        return pdb_io.format_atoms([node], [n], chain)
 
 
     @staticmethod
     def __format_helix_info(chain, node_from, node_to):
         """Encodes helix info to str in PDB format"""
-        return \
-            'HELIX    1   1 GLY ' + \
-            chain + ' ' + \
-            Hybrid36.hy36encode(4, int(node_from) + 1).rjust(4) + '  GLY ' + \
-            chain + ' ' + \
-            Hybrid36.hy36encode(4, int(node_to) + 1).rjust(4) + '  1\n'
+        return pdb_io.format_helices([[int(node_from), int(node_to)]], chain)
 
 
     @staticmethod
     def __format_sheet_info(chain, node_from, node_to):
         """Encodes sheet info to str in PDB format"""
-        return \
-            'SHEET    1   A 6 GLY ' + \
-            chain + \
-            Hybrid36.hy36encode(4, int(node_from) + 1).rjust(4) + '  GLY ' + \
-            chain + \
-            Hybrid36.hy36encode(4, int(node_to) + 1).rjust(4) + '  0\n'
-
-
-
+        return pdb_io.format_sheets([[int(node_from), int(node_to)]], chain)
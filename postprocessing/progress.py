@@ -0,0 +1,107 @@
+"""Structured progress reporting for the prediction steps
+
+Long running loops like the confidence walk report their progress as
+'ProgressEvent' tuples instead of printing every iteration. Events are passed
+to an optional callback (for example the put method of a queue) and, unless
+the reporter is quiet, logged to stdout. Intermediate events are rate-limited,
+so reporting progress does not slow down the loop which reports it.
+
+Every process has a single reporter which is set with 'set_reporter' and
+retrieved by the reporting code with 'get_reporter'.
+"""
+
+from collections import namedtuple
+from time import time
+
+ProgressEvent = namedtuple('ProgressEvent', ['stage', 'protein_id', 'edges_placed', 'voxels_remaining', 'rate',
+                                             'finished'])
+
+
+class ProgressReporter:
+    """Creates progress events and passes them to the callback and the log
+
+    Parameters
+    ----------
+    protein_id: str
+        Id of the protein which is predicted, part of every event
+
+    callback: callable
+        Optional function which is called with every event
+
+    interval: float
+        Minimum number of seconds between two intermediate events of a stage
+
+    quiet: bool
+        If set events are not logged, the callback is still called
+    """
+
+    def __init__(self, protein_id=None, callback=None, interval=10.0, quiet=False):
+        self.protein_id = protein_id
+        self.callback = callback
+        self.interval = interval
+        self.quiet = quiet
+        self.start_times = dict()
+        self.last_times = dict()
+
+    def start(self, stage):
+        """Marks the start of a stage, rates are measured from this point"""
+        self.start_times[stage] = self.last_times[stage] = time()
+
+    def is_due(self, stage):
+        """Returns true if an intermediate event of the stage would be
+        emitted, so expensive values only have to be computed if needed"""
+        return time() - self.last_times.get(stage, 0) >= self.interval
+
+    def update(self, stage, edges_placed=None, voxels_remaining=None):
+        """Emits intermediate event of the stage unless the last one was
+        emitted less than 'interval' seconds ago"""
+        if self.is_due(stage):
+            self.__emit(stage, edges_placed, voxels_remaining, False)
+
+    def finish(self, stage, edges_placed=None, voxels_remaining=None):
+        """Emits final event of the stage"""
+        self.__emit(stage, edges_placed, voxels_remaining, True)
+
+    def __emit(self, stage, edges_placed, voxels_remaining, finished):
+        now = time()
+        self.last_times[stage] = now
+        elapsed = now - self.start_times.get(stage, now)
+        rate = edges_placed / elapsed if edges_placed is not None and elapsed > 0 else None
+        event = ProgressEvent(stage, self.protein_id, edges_placed, voxels_remaining, rate, finished)
+
+        if self.callback is not None:
+            self.callback(event)
+
+        if not self.quiet:
+            print(format_event(event, elapsed), flush=True)
+
+
+def format_event(event, elapsed):
+    """Formats event as single log line"""
+    parts = list()
+    if event.edges_placed is not None:
+        parts.append('%d edges placed' % event.edges_placed)
+    if event.voxels_remaining is not None:
+        parts.append('%d voxels remaining' % event.voxels_remaining)
+    if event.rate is not None:
+        parts.append('%.1f edges/s' % event.rate)
+    if event.finished:
+        parts.append('finished after %.1fs' % elapsed)
+
+    prefix = '[' + event.protein_id + '] ' if event.protein_id is not None else ''
+
+    return prefix + event.stage + ': ' + ', '.join(parts)
+
+
+_reporter = ProgressReporter()
+
+
+def set_reporter(reporter):
+    """Sets the reporter used by all prediction steps of this process"""
+    global _reporter
+    _reporter = reporter
+
+
+def get_reporter():
+    """Returns the reporter of this process"""
+    return _reporter
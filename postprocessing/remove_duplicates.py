@@ -1,33 +1,69 @@
 """Removes duplicate nodes (same coordinates)"""
 
+from collections import deque
 from .pdb_reader_writer import PDB_Reader_Writer
 
 
+RESOURCE_CLASS = 'io'
+
+
 def update_paths(paths):
-    paths['duplicates_removed'] = paths['output'] + 'duplicates_removed.pdb'
+    paths['duplicates_removed'] = paths['output'] + 'duplicates_removed.npz'
 
 
 def execute(paths):
     reader_writer = PDB_Reader_Writer()
-    chains = reader_writer.read_pdb(paths['traces_refined'])
+    chains = reader_writer.read_chains(paths['traces_refined'])
     remove_duplicates(chains)
-    reader_writer.write_pdb(chains, paths['duplicates_removed'])
+    reader_writer.write_chains(chains, paths['duplicates_removed'], paths.get('debug', False))
 
 
 def remove_duplicates(chains):
-    for i in range(len(chains)):
-        chain = chains[i]
-        for other_chain in (chains[0:i] + chains[i + 1:]):
-            for j, k in [(0, 0), (0, -1), (-1, 0), (-1, -1)]:
-                if not chain.nodes or not other_chain.nodes:
-                    continue
-
-                if is_equal(chain.nodes[j], other_chain.nodes[k]):
-                    if len(chain.nodes) > len(other_chain.nodes):
-                        del other_chain.nodes[k]
-                    else:
-                        del chain.nodes[j]
-
-
-def is_equal(node1, node2):
-    return node1[0] == node2[0] and node1[1] == node2[1] and node1[2] == node2[2]
+    """Removes endpoints which are shared by different chains
+
+    A shared endpoint is deleted from the shorter chain, or from the chain
+    which comes first if both have the same length. Deleting an endpoint makes
+    the next node the new endpoint, which might be a duplicate as well, so
+    endpoints are checked with a worklist until no chains share an endpoint.
+
+    Parameters
+    ----------
+    chains: list
+        List of 'Chain' objects which are updated in place
+    """
+    owners = dict()
+    worklist = deque()
+
+    def get_ends(index):
+        coordinates = chains[index].coordinates
+        return {get_key(coordinates[0]), get_key(coordinates[-1])} if len(coordinates) > 0 else set()
+
+    def register(index):
+        for key in get_ends(index):
+            owners.setdefault(key, set()).add(index)
+            worklist.append(key)
+
+    def unregister(index):
+        for key in get_ends(index):
+            owners[key].discard(index)
+
+    for index in range(len(chains)):
+        register(index)
+
+    while len(worklist) > 0:
+        key = worklist.popleft()
+        while len(owners.get(key, ())) > 1:
+            # Delete the endpoint from the shortest chain
+            index = min(owners[key], key=lambda i: (len(chains[i]), i))
+            nodes = chains[index].nodes
+            unregister(index)
+            if get_key(nodes[0]) == key:
+                del nodes[0]
+            else:
+                del nodes[-1]
+            register(index)
+
+
+def get_key(node):
+    """Returns hashable key of the node's exact coordinates"""
+    return float(node[0]), float(node[1]), float(node[2])
@@ -0,0 +1,196 @@
+"""Container for the traces built by the confidence walk
+
+Every trace is stored as deque of coordinate tuples so Ca atoms can be added
+to both of its ends in constant time. The trace set additionally keeps a
+dictionary from every coordinate to the traces and positions it appears at,
+which replaces scanning all traces whenever a Ca atom has to be looked up.
+"""
+
+from collections import deque
+import numpy as np
+
+
+class Trace:
+    """Single trace of Ca atoms, see 'TraceSet'
+
+    Positions of Ca atoms are counted from 'start', which is decremented for
+    every Ca atom added to the front, so positions stay valid while the trace
+    grows in both directions.
+    """
+
+    __slots__ = ('cas', 'start', 'index', 'locations')
+
+    def __init__(self, index, locations):
+        self.cas = deque()
+        self.start = 0
+        self.index = index
+        self.locations = locations
+
+    def __len__(self):
+        return len(self.cas)
+
+    def __iter__(self):
+        return iter(self.cas)
+
+    def __getitem__(self, index):
+        return self.cas[index]
+
+    def __setitem__(self, index, location):
+        index %= len(self.cas)
+        self.__remove_location(self.cas[index], self.start + index)
+        self.cas[index] = tuple(location)
+        self.__add_location(self.cas[index], self.start + index)
+
+    def __eq__(self, other):
+        return len(self) == len(other) and all(ca == tuple(other_ca) for ca, other_ca in zip(self.cas, other))
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def append(self, location):
+        self.cas.append(tuple(location))
+        self.__add_location(self.cas[-1], self.start + len(self.cas) - 1)
+
+    def appendleft(self, location):
+        self.start -= 1
+        self.cas.appendleft(tuple(location))
+        self.__add_location(self.cas[0], self.start)
+
+    def __add_location(self, location, position):
+        self.locations.setdefault(location, list()).append((self.index, position))
+
+    def __remove_location(self, location, position):
+        positions = self.locations[location]
+        positions.remove((self.index, position))
+        if len(positions) == 0:
+            del self.locations[location]
+
+
+class TraceSet:
+    """Ordered set of traces which are built by adding edges to their ends
+
+    Parameters
+    ----------
+    traces: iterable
+        Optional traces the set is initialized with, every trace being an
+        iterable of (x, y, z) voxel indices
+    """
+
+    __slots__ = ('traces', 'locations')
+
+    def __init__(self, traces=()):
+        self.traces = list()
+        self.locations = dict()
+        for cas in traces:
+            trace = self.__new_trace()
+            for ca in cas:
+                trace.append(ca)
+
+    def __len__(self):
+        return len(self.traces)
+
+    def __iter__(self):
+        return iter(self.traces)
+
+    def __getitem__(self, index):
+        return self.traces[index]
+
+    def __reduce__(self):
+        return TraceSet.from_arrays, self.to_arrays()
+
+    def find(self, location):
+        """Returns (trace, index) of the first occurrence of 'location' in the
+        order of the traces or None if it is not part of any trace"""
+        positions = self.locations.get(tuple(location))
+        if positions is None:
+            return None
+
+        trace_index, position = min(positions)
+        trace = self.traces[trace_index]
+
+        return trace, position - trace.start
+
+    def add_edge(self, location, neighbor):
+        """Adds 'neighbor' to the trace which contains 'location' first
+
+        The neighbor is added to the front if 'location' is the first Ca atom
+        of that trace, otherwise it is added to the back. If 'location' is not
+        part of any trace a new trace is started."""
+        found = self.find(location)
+        if found is None:
+            trace = self.__new_trace()
+            trace.append(location)
+            trace.append(neighbor)
+        elif found[0][0] == tuple(location):
+            found[0].appendleft(neighbor)
+        else:
+            found[0].append(neighbor)
+
+    def get_ends(self):
+        """Returns list of the first and last Ca atoms of all traces"""
+        ends = list()
+        for trace in self.traces:
+            ends.append(trace.cas[0])
+            if len(trace.cas) > 1:
+                ends.append(trace.cas[-1])
+
+        return ends
+
+    def get_neighbors(self, location, count=5):
+        """Returns the 'count' Ca atoms following and then the 'count' Ca atoms
+        preceding every occurrence of 'location'"""
+        neighbors = list()
+        for trace_index, position in sorted(self.locations.get(tuple(location), ())):
+            trace = self.traces[trace_index]
+            index = position - trace.start
+            neighbors += [trace.cas[i] for i in range(index + 1, min(index + count + 1, len(trace.cas)))]
+            neighbors += [trace.cas[i] for i in range(index - 1, max(index - count - 1, -1), -1)]
+
+        return neighbors
+
+    def get_adjacent(self, location):
+        """Returns the Ca atom following (or if there is none, preceding) the
+        first occurrence of 'location' or None"""
+        found = self.find(location)
+        if found is None:
+            return None
+
+        trace, index = found
+        if index + 1 < len(trace.cas):
+            return trace.cas[index + 1]
+        elif index > 0:
+            return trace.cas[index - 1]
+
+        return None
+
+    def to_lists(self):
+        """Returns traces as list of lists of [x, y, z] voxel indices"""
+        return [[list(ca) for ca in trace.cas] for trace in self.traces]
+
+    def to_arrays(self):
+        """Returns compact representation of the traces as array of trace
+        lengths and int16 array of all coordinates"""
+        lengths = np.array([len(trace.cas) for trace in self.traces], dtype=np.int64)
+        coordinates = np.array([ca for trace in self.traces for ca in trace.cas], dtype=np.int16).reshape((-1, 3))
+
+        return lengths, coordinates
+
+    @staticmethod
+    def from_arrays(lengths, coordinates):
+        """Creates trace set from the arrays returned by 'to_arrays'"""
+        coordinates = coordinates.tolist()
+        traces = list()
+        start = 0
+        for length in lengths.tolist():
+            traces.append(coordinates[start:start + length])
+            start += length
+
+        return TraceSet(traces)
+
+    def __new_trace(self):
+        trace = Trace(len(self.traces), self.locations)
+        self.traces.append(trace)
+
+        return trace
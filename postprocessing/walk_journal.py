@@ -0,0 +1,195 @@
+"""Append-only checkpoint journal for the confidence walk
+
+Every iteration of the confidence walk is appended as a single line to a
+journal file. Every 'snapshot_interval' iterations a compact snapshot of the
+walk state (traces, edge count hash and the voxels which were zeroed in the
+remaining image) is written and the journal is truncated. If the walk is
+interrupted it can be resumed by loading the last snapshot and replaying the
+journal entries written after it.
+
+Snapshot and journal store a fingerprint of the images the walk was started
+with. A journal whose fingerprint does not match the current images was left by
+a walk on different data and is removed instead of being resumed.
+"""
+
+import hashlib
+import os
+import numpy as np
+
+
+class WalkJournal:
+    """Journal which allows a confidence walk to be resumed
+
+    Parameters
+    ----------
+    path: str
+        Path of the pdb file produced by the confidence walk. The journal and
+        snapshot files are stored next to it
+
+    fingerprint: str
+        Fingerprint of the images the walk depends on, see 'hash_images'
+
+    snapshot_interval: int
+        Number of walk iterations after which a new snapshot is written
+    """
+
+    def __init__(self, path, fingerprint, snapshot_interval=1000):
+        self.journal_path = path + '.journal'
+        self.snapshot_path = path + '.snapshot.npz'
+        self.fingerprint = fingerprint
+        self.snapshot_interval = snapshot_interval
+        self.journal_file = None
+
+    @staticmethod
+    def hash_images(*images):
+        """Returns hash of the shapes and values of the images"""
+        sha1 = hashlib.sha1()
+        for image in images:
+            image = np.ascontiguousarray(image, dtype=np.float32)
+            sha1.update(str(image.shape).encode())
+            sha1.update(image.tobytes())
+
+        return sha1.hexdigest()
+
+    def exists(self):
+        """Returns true if there is an unfinished walk of the same images that
+        can be resumed
+
+        Journal and snapshot of a walk on different images are removed.
+        """
+        if not os.path.isfile(self.journal_path) and not os.path.isfile(self.snapshot_path):
+            return False
+
+        if any(fingerprint != self.fingerprint for fingerprint in self.__read_fingerprints()):
+            self.remove()
+            return False
+
+        return True
+
+    def restore(self, prediction_image, num_ca_edges_hash):
+        """Restores the snapshot into the given images and returns the traces
+        as well as the index of the next iteration
+
+        The journal entries written after the snapshot are returned as a list
+        of (index, location, neighbor) tuples and have to be replayed by the
+        caller since they require the walk's update functions.
+        """
+        set_of_ca_sets = list()
+        next_index = 0
+        if not self.exists():
+            return set_of_ca_sets, next_index, list()
+
+        if os.path.isfile(self.snapshot_path):
+            with np.load(self.snapshot_path) as snapshot:
+                next_index = int(snapshot['next_index'])
+                prediction_image.flat[snapshot['zeroed_indices']] = 0
+                num_ca_edges_hash.flat[snapshot['hash_indices']] = snapshot['hash_values']
+                coordinates = snapshot['trace_coordinates'].tolist()
+                start = 0
+                for length in snapshot['trace_lengths'].tolist():
+                    set_of_ca_sets.append(coordinates[start:start + length])
+                    start += length
+
+        entries = list()
+        if os.path.isfile(self.journal_path):
+            with open(self.journal_path) as journal_file:
+                for line in journal_file:
+                    entry = self.__parse_entry(line)
+                    # Entries of an interrupted write or entries which are
+                    # already part of the snapshot are skipped
+                    if entry is not None and entry[0] >= next_index:
+                        entries.append(entry)
+
+        return set_of_ca_sets, next_index, entries
+
+    def record(self, index, location, neighbor):
+        """Appends a single walk iteration to the journal"""
+        if self.journal_file is None:
+            self.journal_file = open(self.journal_path, 'a')
+            if self.journal_file.tell() == 0:
+                self.__write_header()
+
+        values = [index] + list(location) + (list(neighbor) if neighbor is not None else [])
+        self.journal_file.write(' '.join(str(int(value)) for value in values) + '\n')
+        self.journal_file.flush()
+
+    def snapshot(self, next_index, set_of_ca_sets, prediction_image, untouched_prediction, num_ca_edges_hash):
+        """Writes snapshot of the current walk state and truncates the journal"""
+        zeroed_indices = np.flatnonzero((prediction_image == 0) & (untouched_prediction != 0))
+        hash_indices = np.flatnonzero(num_ca_edges_hash)
+        coordinates = [ca for ca_set in set_of_ca_sets for ca in ca_set]
+
+        # Snapshot is written to a temporary file first so an interrupted write
+        # never replaces a valid snapshot
+        temp_path = self.snapshot_path + '.tmp'
+        with open(temp_path, 'wb') as snapshot_file:
+            np.savez(snapshot_file,
+                     fingerprint=self.fingerprint,
+                     next_index=next_index,
+                     zeroed_indices=zeroed_indices,
+                     hash_indices=hash_indices,
+                     hash_values=num_ca_edges_hash.flat[hash_indices],
+                     trace_lengths=np.array([len(ca_set) for ca_set in set_of_ca_sets], dtype=np.int64),
+                     trace_coordinates=np.array(coordinates, dtype=np.int32).reshape((-1, 3)))
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(temp_path, self.snapshot_path)
+
+        if self.journal_file is not None:
+            self.journal_file.close()
+        self.journal_file = open(self.journal_path, 'w')
+        self.__write_header()
+
+    def remove(self):
+        """Removes journal and snapshot once the walk is finished"""
+        if self.journal_file is not None:
+            self.journal_file.close()
+            self.journal_file = None
+
+        for path in [self.journal_path, self.snapshot_path]:
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def __write_header(self):
+        """Writes fingerprint as first line of the journal"""
+        self.journal_file.write('fingerprint ' + self.fingerprint + '\n')
+        self.journal_file.flush()
+
+    def __read_fingerprints(self):
+        """Returns list of the fingerprints stored in snapshot and journal,
+        None for files without a valid fingerprint"""
+        fingerprints = list()
+        if os.path.isfile(self.snapshot_path):
+            try:
+                with np.load(self.snapshot_path) as snapshot:
+                    fingerprints.append(str(snapshot['fingerprint']))
+            except (OSError, KeyError, ValueError):
+                fingerprints.append(None)
+
+        if os.path.isfile(self.journal_path):
+            with open(self.journal_path) as journal_file:
+                header = journal_file.readline().split()
+            # A journal which is empty was truncated before its header was
+            # written and does not contain any entries
+            if len(header) > 0:
+                fingerprints.append(header[1] if len(header) == 2 and header[0] == 'fingerprint' else None)
+
+        return fingerprints
+
+    @staticmethod
+    def __parse_entry(line):
+        """Parses journal line into (index, location, neighbor) tuple"""
+        if not line.endswith('\n'):
+            return None
+
+        try:
+            values = [int(value) for value in line.split()]
+        except ValueError:
+            return None
+
+        if len(values) == 4:
+            return values[0], values[1:4], None
+        elif len(values) == 7:
+            return values[0], values[1:4], values[4:7]
+
+        return None
@@ -1,7 +1,10 @@
+import json
 import math
+import numpy as np
+from scipy.spatial import cKDTree
 import xlwt
 from datetime import timedelta
-from postprocessing import pdb_reader_writer
+from postprocessing import pdb_io
 
 
 class Evaluator:
@@ -14,120 +17,85 @@ class Evaluator:
         """This method finds the closest pred_ca/gt_ca pair in the entire
         structure. Then removes them from the set and continues to find the next
         closest pair until all pairs with a distance of less than 3A have been
-        removed."""
-        gt_pdb = open(gt_file, 'r')
-        gt_ca_atoms = list()
-        for line in gt_pdb:
-            if line.startswith("ATOM") and line[13:16] == "CA ":
-                x = float(line[30:38])
-                y = float(line[38:46])
-                z = float(line[46:54])
-                gt_ca_atoms.append(tuple([x, y, z]))
-        gt_pdb.close()
-        native_ca_atoms = len(gt_ca_atoms)
-        prediction_file = open(predicted_file, 'r')
-        modeled_ca = 0
-        pred_ca_atoms = list()
-        previous_index = -2
-        for line in prediction_file:
-            if line.startswith("ATOM") and line[13:16] == "CA ":
-                modeled_ca += 1
-                index = pdb_reader_writer.PDB_Reader_Writer.read_single_pdb_line(type='ATOM INDEX', line=line)
-                x = float(line[30:38])
-                y = float(line[38:46])
-                z = float(line[46:54])
-                if index != previous_index + 1:
-                    pred_ca_atoms.append(list())
-                pred_ca_atoms[len(pred_ca_atoms) - 1].append(tuple([x, y, z]))
-                previous_index = index
-        prediction_file.close()
+        removed.
+
+        Every fragment of the prediction is matched in both directions and the
+        direction which matches more gt_ca atoms (or has the lower RMSD) is
+        used. Closest pairs are found with a 'CaMatcher'.
+
+        The result is added to the evaluation results and returned."""
+        gt_atoms = get_ca_atoms(gt_file)
+        native_ca_atoms = len(gt_atoms)
+        pred_atoms = get_ca_atoms(predicted_file)
+        modeled_ca = len(pred_atoms)
+
+        # A new fragment starts wherever the residue numbers are not consecutive
+        breaks = np.flatnonzero(np.diff(pred_atoms['residue']) != 1) + 1
+        pred_ca_atoms = np.split(pred_atoms['coordinates'], breaks)
+
+        matcher = CaMatcher(gt_atoms['coordinates'])
 
         # Find the number incorrect
-        incorrect = 0
-        for partial_set in pred_ca_atoms:
-            for pred_ca in partial_set:
-                min_dist = 1000000
-                for gt_ca in gt_ca_atoms:
-                    dist = distance(pred_ca[2], gt_ca[2], pred_ca[1], gt_ca[1], pred_ca[0], gt_ca[0])
-                    if dist < min_dist:
-                        min_dist = dist
-                if min_dist > 3:
-                    incorrect += 1
+        incorrect = matcher.count_incorrect(pred_atoms['coordinates'])
 
         total_ca = 0
         squared_sum = 0
         for partial_set in pred_ca_atoms:
-            # Do the first direction now
-            removed_gt_atoms_one = list()
-            one_squared_sum = 0
-            one_total_ca = 0
-            for pred_ca in partial_set:
-                min_dist = 1000000
-                closest_gt_ca = None
-                for gt_ca in gt_ca_atoms:
-                    dist = distance(pred_ca[2], gt_ca[2], pred_ca[1], gt_ca[1], pred_ca[0], gt_ca[0])
-                    if dist < min_dist:
-                        min_dist = dist
-                        closest_gt_ca = gt_ca
-                if min_dist < 3:
-                    gt_ca_atoms.remove(closest_gt_ca)
-                    removed_gt_atoms_one.append(closest_gt_ca)
-                    one_total_ca += 1
-                    one_squared_sum += min_dist ** 2
-            # Restore the gt_list
-            for removed_ca in removed_gt_atoms_one:
-                gt_ca_atoms.append(removed_ca)
-            # Now do the other direction
-            partial_set.reverse()
-            removed_gt_atoms_two = list()
-            two_squared_sum = 0
-            two_total_ca = 0
-            for pred_ca in partial_set:
-                min_dist = 1000000
-                closest_gt_ca = None
-                for gt_ca in gt_ca_atoms:
-                    dist = distance(pred_ca[2], gt_ca[2], pred_ca[1], gt_ca[1], pred_ca[0], gt_ca[0])
-                    if dist < min_dist:
-                        min_dist = dist
-                        closest_gt_ca = gt_ca
-                if min_dist < 3:
-                    gt_ca_atoms.remove(closest_gt_ca)
-                    removed_gt_atoms_two.append(closest_gt_ca)
-                    two_total_ca += 1
-                    two_squared_sum += min_dist ** 2
-            # Restore the gt_list
-            for removed_ca in removed_gt_atoms_two:
-                gt_ca_atoms.append(removed_ca)
+            candidates = matcher.find_candidates(partial_set)
+            # Do the first direction now, then the other direction
+            removed_gt_atoms_one, one_squared_sum = matcher.match(candidates)
+            removed_gt_atoms_two, two_squared_sum = matcher.match(candidates[::-1])
+            one_total_ca = len(removed_gt_atoms_one)
+            two_total_ca = len(removed_gt_atoms_two)
             # Now use the better fit
             one_fit = 0 if one_total_ca == 0 else math.sqrt(one_squared_sum / one_total_ca)
             two_fit = 0 if two_total_ca == 0 else math.sqrt(two_squared_sum / two_total_ca)
             if two_total_ca > one_total_ca or (two_total_ca == one_total_ca and two_fit < one_fit):
-                for ca in removed_gt_atoms_two:
-                    gt_ca_atoms.remove(ca)
+                matcher.remove(removed_gt_atoms_two)
                 total_ca += two_total_ca
                 squared_sum += two_squared_sum
             else:
-                for ca in removed_gt_atoms_one:
-                    gt_ca_atoms.remove(ca)
+                matcher.remove(removed_gt_atoms_one)
                 total_ca += one_total_ca
                 squared_sum += one_squared_sum
 
-        self.evaluation_results.append(EvaluationResult(emdb_id,
-                                                        modeled_ca,
-                                                        native_ca_atoms,
-                                                        total_ca,
-                                                        total_ca / native_ca_atoms,
-                                                        math.sqrt(squared_sum / total_ca) if total_ca != 0 else 0,
-                                                        incorrect,
-                                                        execution_time,
-                                                        incorrect / modeled_ca))
-
-    def create_report(self, output_path, execution_time):
-        """Creates excel document containing evaluation reports"""
+        result = EvaluationResult(emdb_id,
+                                  modeled_ca,
+                                  native_ca_atoms,
+                                  total_ca,
+                                  total_ca / native_ca_atoms,
+                                  math.sqrt(squared_sum / total_ca) if total_ca != 0 else 0,
+                                  incorrect,
+                                  execution_time,
+                                  incorrect / modeled_ca)
+        self.evaluation_results.append(result)
+
+        return result
+
+    def read_results(self, results_file):
+        """Adds the evaluation results stored in the JSON Lines file to the
+        evaluation results, see 'write_result'"""
+        with open(results_file) as f:
+            for line in f:
+                if line.strip():
+                    self.evaluation_results.append(EvaluationResult(**json.loads(line)))
+
+    def create_report(self, output_path, execution_time, spans=(), stages=()):
+        """Creates excel document containing evaluation reports
+
+        The wall time of every stage in 'stages' is added as column of the
+        results, all values measured for the stages are listed in a separate
+        sheet. Spans are the 'instrumentation.Span' tuples of the stages."""
         # Don't create report if there are no evaluation results
         if not self.evaluation_results:
             return
 
+        # Sum of the wall times of every protein and stage
+        stage_times = dict()
+        for span in spans:
+            key = (span.protein_id, span.stage)
+            stage_times[key] = stage_times.get(key, 0) + span.wall_time
+
         self.evaluation_results.sort(key=lambda r: r.name)
 
         book = xlwt.Workbook()
@@ -142,6 +110,8 @@ class Evaluator:
         sh.write(0, 6, 'Incorrect')
         sh.write(0, 7, 'FP')
         sh.write(0, 8, 'Execution Time')
+        for j, stage in enumerate(stages):
+            sh.write(0, 9 + j, stage + ' (s)')
 
         for i in range(len(self.evaluation_results)):
             sh.write(1 + i, 0, self.evaluation_results[i].name)
@@ -153,6 +123,9 @@ class Evaluator:
             sh.write(1 + i, 6, self.evaluation_results[i].num_incorrect)
             sh.write(1 + i, 7, self.evaluation_results[i].fp_per)
             sh.write(1 + i, 8, str(timedelta(seconds=int(self.evaluation_results[i].execution_time))))
+            for j, stage in enumerate(stages):
+                if (self.evaluation_results[i].name, stage) in stage_times:
+                    sh.write(1 + i, 9 + j, stage_times[(self.evaluation_results[i].name, stage)])
 
         rmsd_avg = sum(r.rmsd for r in self.evaluation_results) / len(self.evaluation_results)
         matching_ca_per_avg = sum(r.matching_ca_per for r in self.evaluation_results) / len(self.evaluation_results)
@@ -165,9 +138,39 @@ class Evaluator:
         sh.write(len(self.evaluation_results) + 1, 8, str(timedelta(seconds=int(execution_time_avg))))
         sh.write(len(self.evaluation_results) + 2, 0, 'Total')
         sh.write(len(self.evaluation_results) + 2, 8, str(timedelta(seconds=int(execution_time))))
+        for j, stage in enumerate(stages):
+            times = [wall_time for (_, span_stage), wall_time in stage_times.items() if span_stage == stage]
+            if times:
+                sh.write(len(self.evaluation_results) + 1, 9 + j, sum(times) / len(times))
+                sh.write(len(self.evaluation_results) + 2, 9 + j, sum(times))
+
+        if spans:
+            self.write_stages(book.add_sheet('stages'), spans)
 
         book.save(output_path + 'results.xls')
 
+    @staticmethod
+    def write_stages(sh, spans):
+        """Writes the values measured for every stage to the sheet"""
+        sh.write(0, 0, 'EMDB ID')
+        sh.write(0, 1, 'Stage')
+        sh.write(0, 2, 'Wall Time (s)')
+        sh.write(0, 3, 'CPU Time (s)')
+        sh.write(0, 4, 'Peak RSS (MB)')
+        sh.write(0, 5, 'Read (MB)')
+        sh.write(0, 6, 'Written (MB)')
+        sh.write(0, 7, 'TF Semaphore Wait (s)')
+
+        for i, span in enumerate(sorted(spans, key=lambda s: (s.protein_id, s.start))):
+            sh.write(1 + i, 0, span.protein_id)
+            sh.write(1 + i, 1, span.stage)
+            sh.write(1 + i, 2, span.wall_time)
+            sh.write(1 + i, 3, span.cpu_time)
+            for j, value in enumerate((span.peak_rss, span.read_bytes, span.written_bytes)):
+                if value is not None:
+                    sh.write(1 + i, 4 + j, value / 2 ** 20)
+            sh.write(1 + i, 7, span.wait_time)
+
 
 class EvaluationResult:
 
@@ -184,10 +187,130 @@ class EvaluationResult:
         self.fp_per = fp_per
 
 
-def distance(z1, z2, y1, y2, x1, x2):
-    """Calculates Euclidean distance between two points"""
-    z_diff = z1 - z2
-    y_diff = y1 - y2
-    x_diff = x1 - x2
-    sum_squares = math.pow(z_diff, 2) + math.pow(y_diff, 2) + math.pow(x_diff, 2)
-    return math.sqrt(sum_squares)
+def write_result(result, results_file):
+    """Appends evaluation result as single line to the JSON Lines file
+
+    Results are written as soon as a protein is evaluated, so the file can be
+    read while other proteins are still predicted."""
+    with open(results_file, 'a') as f:
+        f.write(json.dumps(vars(result)) + '\n')
+
+
+class CaMatcher:
+    """Matches predicted Ca atoms to their closest remaining ground truth Ca
+    atoms
+
+    Ground truth atoms within 'max_distance' of a predicted atom are looked up
+    in a KD-tree and matched atoms are masked instead of being removed from a
+    list. Distances are summed in z, y, x order, so they are equal to the
+    distances of the former brute-force matching down to the last bit.
+
+    Ties between equally close atoms are broken by the order of a list of the
+    remaining ground truth atoms, to which atoms are appended again when a
+    match is discarded. This is the order in which the atoms were compared
+    when the matching was done on such a list.
+
+    Parameters
+    ----------
+    gt_ca_atoms: array_like
+        (N, 3) coordinates of the ground truth Ca atoms
+
+    max_distance: float
+        Atoms are matched if they are closer than this distance
+    """
+
+    def __init__(self, gt_ca_atoms, max_distance=3):
+        self.gt_ca_atoms = np.asarray(gt_ca_atoms, dtype=np.float64).reshape((-1, 3))
+        self.tree = cKDTree(self.gt_ca_atoms) if len(self.gt_ca_atoms) > 0 else None
+        self.max_distance = max_distance
+        self.available = np.ones(len(self.gt_ca_atoms), dtype=bool)
+        self.order = np.arange(len(self.gt_ca_atoms))
+        self.next_order = len(self.gt_ca_atoms)
+        self.keys = [tuple(ca) for ca in self.gt_ca_atoms.tolist()]
+        self.duplicates = dict()
+        for index, key in enumerate(self.keys):
+            self.duplicates.setdefault(key, list()).append(index)
+
+    def find_candidates(self, pred_ca_atoms, inclusive=False):
+        """Returns list of the ground truth atoms closer than 'max_distance' (or
+        as close if 'inclusive' is set) of every predicted atom as list of
+        (distance, index) tuples sorted by distance"""
+        pred_ca_atoms = np.asarray(pred_ca_atoms, dtype=np.float64).reshape((-1, 3))
+        if self.tree is None:
+            return [list() for _ in pred_ca_atoms]
+
+        # The radius is slightly larger, since the tree sums the squares in a
+        # different order
+        neighbors = self.tree.query_ball_point(pred_ca_atoms, self.max_distance + 1e-6)
+        candidates = list()
+        for pred_ca, indices in zip(pred_ca_atoms, neighbors):
+            gt_cas = self.gt_ca_atoms[indices]
+            distances = np.sqrt((pred_ca[2] - gt_cas[:, 2]) ** 2 + (pred_ca[1] - gt_cas[:, 1]) ** 2 +
+                                (pred_ca[0] - gt_cas[:, 0]) ** 2)
+            in_range = distances <= self.max_distance if inclusive else distances < self.max_distance
+            candidates.append(sorted(zip(distances[in_range].tolist(), np.asarray(indices)[in_range].tolist())))
+
+        return candidates
+
+    def count_incorrect(self, pred_ca_atoms):
+        """Returns number of predicted atoms without any ground truth atom
+        within 'max_distance'"""
+        return sum(1 for candidates in self.find_candidates(pred_ca_atoms, inclusive=True) if len(candidates) == 0)
+
+    def match(self, candidates):
+        """Matches predicted atoms one after the other to their closest
+        available ground truth atom
+
+        The matched atoms stay available and are moved to the end of the order,
+        they are only removed by 'remove'.
+
+        Parameters
+        ----------
+        candidates: list
+            Candidates of the predicted atoms as returned by 'find_candidates'
+
+        Returns
+        ----------
+        matched: list
+            Indices of the matched ground truth atoms
+
+        squared_sum: float
+            Sum of the squared distances of the matches
+        """
+        matched = list()
+        squared_sum = 0
+        for pred_candidates in candidates:
+            closest = None
+            for distance, index in pred_candidates:
+                if closest is not None and distance > closest[0]:
+                    break
+                if self.available[index] and (closest is None or self.order[index] < self.order[closest[1]]):
+                    closest = distance, index
+
+            if closest is not None:
+                self.available[closest[1]] = False
+                matched.append(closest[1])
+                squared_sum += closest[0] ** 2
+
+        for index in matched:
+            self.available[index] = True
+            self.order[index] = self.next_order
+            self.next_order += 1
+
+        return matched, squared_sum
+
+    def remove(self, indices):
+        """Removes matched ground truth atoms
+
+        Atoms with equal coordinates can't be told apart by their matches, so
+        the first of them in the order is removed like 'list.remove' would."""
+        for index in indices:
+            index = min((i for i in self.duplicates[self.keys[index]] if self.available[i]), key=self.order.__getitem__)
+            self.available[index] = False
+
+
+def get_ca_atoms(pdb_file):
+    """Returns ATOM records of the Ca atoms in the pdb file"""
+    atoms = pdb_io.read_pdb(pdb_file).atoms
+    return atoms[np.char.startswith(atoms['name'], b'CA ', start=1)]
+
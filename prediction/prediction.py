@@ -5,14 +5,21 @@ All prediction steps have to be added to the prediction pipeline.
 
 import os
 import sys
+import math
+import mrcfile
 from shutil import copyfile
-from multiprocessing import cpu_count, Pool, Semaphore
+from collections import namedtuple
+from multiprocessing import cpu_count, Lock, Semaphore
 from time import time
 import traceback
-from .evaluation import Evaluator
+from .evaluation import Evaluator, write_result
+from .scheduler import run_stages
+from . import stage_cache
 import preprocessing as pre
 import cnn
 import postprocessing as post
+from postprocessing.progress import ProgressReporter, set_reporter
+from postprocessing import instrumentation
 
 
 # List contains every prediction step that is executed in order to produce
@@ -28,11 +35,58 @@ PREDICTION_PIPELINE = [
     post.merge_chains
 ]
 
-
-def run_predictions(input_path, output_path, thresholds_file, num_skip, check_existing, hidedusts_file, debug, chimera_path):
+# Every prediction step declares the resource class of the processes it is run
+# in as 'RESOURCE_CLASS': 'chimera' for steps which run Chimera, 'tf' for
+# TensorFlow, 'cpu' for steps which are limited by computation and 'io' for
+# steps which mostly read and write files. The limits are the maximum number of
+# processes of every resource class, 'None' standing for the number of cpus.
+# The final stage of every prediction, which copies and evaluates the
+# prediction, is run as 'io'
+RESOURCE_LIMITS = {
+    'chimera': None,
+    'tf': 4,
+    'cpu': None,
+    'io': 2
+}
+
+# Prediction of a single protein which has to run stage 'stage' next. The
+# stages are the prediction steps followed by the final stage, 'fingerprint'
+# is the fingerprint of the previous stage
+PredictionJob = namedtuple('PredictionJob', ['stage', 'params', 'paths', 'execution_time', 'fingerprint'])
+
+# Edge length of the boxes the CNN predicts the maps in, at a voxel size of 1
+BOX_SIZE = 64
+
+# JSON Lines file in the output path to which the evaluation result of every
+# protein is appended as soon as its prediction is finished
+RESULTS_FILE = 'results.jsonl'
+
+# JSON Lines file in the output path to which the 'Span' of every executed
+# stage is appended, and the Chrome trace-event file created from it
+SPANS_FILE = 'spans.jsonl'
+TRACE_FILE = 'trace.json'
+
+# Name of the final stage of every prediction in the spans
+FINISH_STAGE = 'finish_prediction'
+
+
+def run_predictions(input_path, output_path, thresholds_file, num_skip, check_existing, hidedusts_file, debug, chimera_path,
+                    component_walks=False, peak_seeding=False, quiet=False, progress_callback=None):
     """Creates thread pool which will concurrently run the prediction for every
     protein map in the 'input_path'
 
+    Every prediction step runs in the process pool of its resource class and
+    a prediction is passed to the pool of its next step as soon as a step is
+    finished, so for example one protein is traced while another one is
+    predicted by the CNN. The largest maps are started first, so a large map
+    which would otherwise be predicted last does not keep the other processes
+    idle.
+
+    Every prediction is evaluated by the process which ran it and its result
+    is appended to the 'RESULTS_FILE'. The resources used by every stage are
+    appended to the 'SPANS_FILE'. The excel report and the 'TRACE_FILE' are
+    created from these files once all predictions are finished.
+
     Parameters
     ----------
     input_path: str
@@ -50,40 +104,78 @@ def run_predictions(input_path, output_path, thresholds_file, num_skip, check_ex
         The number of prediction steps that should be skipped
 
     check_existing: bool
-        If set prediction steps are only executed if their results are not
-        existing in the output path yet
+        If set prediction steps are only executed if their results do not
+        exist in the output path yet or their inputs changed since, see
+        'stage_cache'
 		
     chimera_path: str
 	    Path to indicate the location of the symbolic link to the chimera
 		binary file
+
+    component_walks: bool
+        If set the connected components of the backbone prediction are traced
+        in parallel
+
+    peak_seeding: bool
+        If set the Ca atoms of the traces are extracted as peaks of the Ca
+        confidence map instead of being found by the confidence walk
+
+    quiet: bool
+        If set progress of the prediction steps is not logged
+
+    progress_callback: callable
+        Optional function which is called with every 'ProgressEvent'. If more
+        than one map is predicted it has to be picklable, for example the put
+        method of a 'multiprocessing.Manager' queue
     """
     # Create list of parameters for every prediction
-    params_list = [(emdb_id, input_path, output_path, thresholds_file, num_skip, check_existing, hidedusts_file, debug, chimera_path)
+    params_list = [(emdb_id, input_path, output_path, thresholds_file, num_skip, check_existing, hidedusts_file, debug,
+                    chimera_path, component_walks, peak_seeding, quiet, progress_callback)
                    for emdb_id in filter(lambda d: os.path.isdir(input_path + d), os.listdir(input_path))]
+    params_list.sort(key=lambda params: estimate_cost(input_path, params[0]), reverse=True)
 
-    start_time = time()
-    max_processes_allowed_to_access_tensorflow = 4
-    semaphore = Semaphore(min(min(cpu_count(), len(params_list)), max_processes_allowed_to_access_tensorflow))
-    pool = Pool(min(cpu_count(), len(params_list)), initializer=init_child, initargs=(semaphore,))
-    results = pool.map(run_prediction, params_list)
+    results_file = output_path + RESULTS_FILE
+    spans_file = output_path + SPANS_FILE
+    for file_name in (results_file, spans_file):
+        if os.path.isfile(file_name):
+            os.remove(file_name)
 
-    # Filter 'None' results
-    results = filter(lambda r: r is not None, results)
+    start_time = time()
+    lock = Lock()
+    limits = {resource: min(limit or cpu_count(), len(params_list)) for resource, limit in RESOURCE_LIMITS.items()}
+    semaphore = Semaphore(max(1, limits['tf']))
+    if len(params_list) == 1:
+        # A single prediction runs in this process, so its prediction steps
+        # are able to start process pools of their own
+        init_child(semaphore, lock)
+        run_prediction(params_list[0])
+    else:
+        # Results are evaluated and written by the processes themselves
+        resources = [prediction_step.RESOURCE_CLASS for prediction_step in PREDICTION_PIPELINE] + ['io']
+        run_stages(run_stage, [PredictionJob(0, params, None, 0, None) for params in params_list], resources, limits,
+                   init_child, (semaphore, lock))
 
     evaluator = Evaluator(input_path)
-    for emdb_id, predicted_file, gt_file, execution_time in results:
-        evaluator.evaluate(emdb_id, predicted_file, gt_file, execution_time)
+    if os.path.isfile(results_file):
+        evaluator.read_results(results_file)
+
+    spans = instrumentation.read_spans(spans_file) if os.path.isfile(spans_file) else list()
+    instrumentation.write_chrome_trace(spans, output_path + TRACE_FILE)
 
-    evaluator.create_report(output_path, time() - start_time)
+    stages = [prediction_step.__name__.split('.')[-1] for prediction_step in PREDICTION_PIPELINE] + [FINISH_STAGE]
+    evaluator.create_report(output_path, time() - start_time, spans, stages)
 
-def init_child(semaphore_):
-    global semaphore
-    semaphore = semaphore_
+def init_child(semaphore_, lock_):
+    global semaphore, lock
+    # Semaphore which limits the number of processes running TensorFlow
+    semaphore = instrumentation.TimedSemaphore(semaphore_)
+    # Lock which guards appending to the results file
+    lock = lock_
 
 
 def run_prediction(params):
     """Coordinates the execution of every prediction step in the prediction
-    pipeline
+    pipeline and evaluates the prediction
 
     Parameters
     ----------
@@ -97,32 +189,104 @@ def run_prediction(params):
         Result as tuple containing the emdb id, predicted file, ground truth
         file, and execution time respectively
     """
+    job = PredictionJob(0, params, None, 0, None)
+    while job is not None and job.stage <= len(PREDICTION_PIPELINE):
+        job = run_stage(job)
+
+    if job is None:
+        return None
+
+    return params[0], job.paths['fragments_merged'], job.paths['ground_truth'], job.execution_time
+
+
+def run_stage(job):
+    """Runs a single stage of a prediction
+
+    The stages are the prediction steps of the 'PREDICTION_PIPELINE' followed
+    by a final stage which copies, cleans up and evaluates the prediction.
+
+    Parameters
+    ----------
+    job: PredictionJob
+        Prediction of which stage 'job.stage' is run
+
+    Returns
+    ----------
+    job: PredictionJob
+        Prediction which has to run the next stage, or None if the stage
+        failed
+    """
     # Unpack parameters
-    emdb_id, input_path, output_path, thresholds_file, num_skip, check_existing, hidedusts_file, debug, chimera_path = params
-    paths = make_paths(input_path, emdb_id, thresholds_file, hidedusts_file, chimera_path)
+    emdb_id, input_path, output_path, thresholds_file, num_skip, check_existing, hidedusts_file, debug, chimera_path, \
+        component_walks, peak_seeding, quiet, progress_callback = job.params
+    reporter = ProgressReporter(emdb_id, progress_callback, quiet=quiet)
+    set_reporter(reporter)
 
     start_time = time()
-    for prediction_step in PREDICTION_PIPELINE:
-        paths['output'] = output_path + emdb_id + '/' + prediction_step.__name__.split('.')[0] + '/'
-        os.makedirs(paths['output'], exist_ok=True)
+    fingerprint = job.fingerprint
+    spans = list()
+    try:
+        if job.paths is None:
+            paths = make_paths(input_path, emdb_id, thresholds_file, hidedusts_file, chimera_path, component_walks,
+                               peak_seeding, debug)
+            # Fingerprints are only needed to skip steps whose results exist
+            fingerprint = stage_cache.hash_file(paths['input']) if check_existing else None
+        else:
+            paths = dict(job.paths)
+
+        if job.stage < len(PREDICTION_PIPELINE):
+            prediction_step = PREDICTION_PIPELINE[job.stage]
+            step_name = prediction_step.__name__.split('.')[-1]
+            paths['output'] = output_path + emdb_id + '/' + prediction_step.__name__.split('.')[0] + '/'
+            os.makedirs(paths['output'], exist_ok=True)
 
-        try:
             prediction_step.update_paths(paths)
-            if num_skip > 0 or (check_existing and files_exist(paths)):
-                num_skip -= 1
-            else:
-                prediction_step.execute(paths)
-        except BaseException:
-            exc_info = sys.exc_info()
-            traceback.print_exception(*exc_info)
+            if check_existing:
+                fingerprint = stage_cache.get_fingerprint(prediction_step, paths, fingerprint)
+            manifest_file = output_path + emdb_id + '/' + stage_cache.MANIFEST_FILE
+            if job.stage >= num_skip and not (check_existing and files_exist(paths) and
+                                              stage_cache.is_cached(manifest_file, step_name, fingerprint)):
+                # The step is removed from the manifest first, so results of
+                # an interrupted step, or of a run without fingerprints, are
+                # never mistaken as up to date
+                stage_cache.record(manifest_file, step_name, None)
+                reporter.start(step_name)
+                with instrumentation.measure(step_name, emdb_id, spans):
+                    prediction_step.execute(paths)
+                reporter.finish(step_name)
+                if fingerprint is not None:
+                    stage_cache.record(manifest_file, step_name, fingerprint)
+        else:
+            with instrumentation.measure(FINISH_STAGE, emdb_id, spans):
+                finished = finish_prediction(job.params, paths, job.execution_time + time() - start_time)
+            if not finished:
+                return None
+    except BaseException:
+        exc_info = sys.exc_info()
+        traceback.print_exception(*exc_info)
+
+        return None
+    finally:
+        if len(spans) > 0:
+            with lock:
+                instrumentation.write_spans(spans, output_path + SPANS_FILE)
+
+    return job._replace(stage=job.stage + 1, paths=paths, execution_time=job.execution_time + time() - start_time,
+                        fingerprint=fingerprint)
+
 
-            return None
+def finish_prediction(params, paths, execution_time):
+    """Copies the prediction to the output path, removes the large files of
+    the prediction steps unless in debug mode, and evaluates the prediction
+
+    Returns false if the prediction does not exist"""
+    emdb_id, input_path, output_path = params[:3]
+    debug = params[7]
 
     if not os.path.isfile(paths['fragments_merged']):
-        return None
+        return False
 
-    if 'fragments_merged' in paths:
-        copyfile(paths['fragments_merged'], output_path + emdb_id + '/' + emdb_id + '.pdb')
+    copyfile(paths['fragments_merged'], output_path + emdb_id + '/' + emdb_id + '.pdb')
 
     if debug is False:
         try:
@@ -137,12 +301,54 @@ def run_prediction(params):
         except:
             pass
 
-    return emdb_id, paths['fragments_merged'], paths['ground_truth'], time() - start_time
+    try:
+        result = Evaluator(input_path).evaluate(emdb_id, paths['fragments_merged'], paths['ground_truth'],
+                                                execution_time)
+        with lock:
+            write_result(result, output_path + RESULTS_FILE)
+    except BaseException:
+        exc_info = sys.exc_info()
+        traceback.print_exception(*exc_info)
 
+    return True
+
+
+def estimate_cost(input_path, emdb_id):
+    """Estimates the cost of the prediction of a protein map from its header
 
-def make_paths(input_path, emdb_id, thresholds_file, hidedusts_file, chimera_path):
+    Returns
+    ----------
+    cost: tuple
+        Number of boxes the CNN predicts and number of voxels of the map
+        re-sampled to a voxel size of 1. Maps whose header can't be read have
+        cost (0, 0), their prediction reports the error.
+    """
+    try:
+        mrc_file = get_file(input_path + emdb_id, ['mrc', 'map'])
+        with mrcfile.open(input_path + emdb_id + '/' + mrc_file, header_only=True, permissive=True) as mrc:
+            shape = [int(mrc.header.nx), int(mrc.header.ny), int(mrc.header.nz)]
+            voxel_size = [float(mrc.voxel_size.x), float(mrc.voxel_size.y), float(mrc.voxel_size.z)]
+    except (StopIteration, OSError, ValueError):
+        return 0, 0
+
+    boxes = 1
+    voxels = 1
+    for n, size in zip(shape, voxel_size):
+        # Maps without voxel size are assumed to have a voxel size of 1
+        length = n * (size if size > 0 else 1)
+        boxes *= math.ceil(length / BOX_SIZE)
+        voxels *= length
+
+    return boxes, voxels
+
+
+def make_paths(input_path, emdb_id, thresholds_file, hidedusts_file, chimera_path, component_walks=False,
+               peak_seeding=False, debug=False):
     """Creates base paths dictionary with density map, ground truth, and
-    optionally the thresholds file and chimera symbolic link"""
+    optionally the thresholds file and chimera symbolic link
+
+    Options of the prediction steps which are not paths, like
+    'component_walks', are stored in the dictionary as well."""
     mrc_file = get_file(input_path + emdb_id, ['mrc', 'map'])
     gt_file = get_file(input_path + emdb_id, ['pdb', 'ent'])
     # Directory that contains paths to all relevant files. This will be
@@ -164,13 +370,23 @@ def make_paths(input_path, emdb_id, thresholds_file, hidedusts_file, chimera_pat
     if chimera_path is not None:
         paths['chimera_path'] = chimera_path
 
+    if component_walks:
+        paths['component_walks'] = True
+
+    if peak_seeding:
+        paths['peak_seeding'] = True
+
+    if debug:
+        # Post-processing steps additionally write their chains as pdb files
+        paths['debug'] = True
+
     return paths
 
 
 def files_exist(paths):
     """Checks if all files specified in the 'paths' dict exist"""
     for path in paths.values():
-        if not os.path.isdir(path) and not os.path.isfile(path):
+        if isinstance(path, str) and not os.path.isdir(path) and not os.path.isfile(path):
             return False
 
     return True
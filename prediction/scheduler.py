@@ -0,0 +1,82 @@
+"""Runs jobs which consist of several stages in separate process pools
+
+Every stage of a job belongs to a resource class, for example 'tf' for stages
+which run TensorFlow. Every resource class has a pool of processes of its own
+whose size limits how many stages of that class run at the same time. A job is
+passed to the pool of its next stage as soon as its current stage finishes, so
+different stages of different jobs keep all resources busy.
+"""
+
+import queue
+import traceback
+from multiprocessing import Pool
+
+
+def run_stages(function, jobs, resources, limits, initializer=None, initargs=()):
+    """Runs all stages of every job and returns the finished jobs in the order
+    in which they finished
+
+    Parameters
+    ----------
+    function: callable
+        Module level function which runs the stage 'job.stage' of a job and
+        returns the job of the next stage, or None if the stage failed
+
+    jobs: list
+        Jobs with a 'stage' attribute, the first stages of the jobs are
+        started in order
+
+    resources: list
+        Resource class of every stage, a job is finished when 'job.stage'
+        reaches the number of stages
+
+    limits: dict
+        Maximum number of processes of every resource class
+
+    initializer: callable
+        Optional function every process of the pools is initialized with
+
+    initargs: tuple
+        Parameters of the initializer
+    """
+    if len(jobs) == 0:
+        return list()
+
+    pools = {resource: Pool(max(1, min(limits[resource], len(jobs))), initializer, initargs)
+             for resource in set(resources)}
+    # Finished stages are put into this queue by the result handler threads
+    # of the pools
+    finished_stages = queue.Queue()
+
+    def report_error(error):
+        traceback.print_exception(type(error), error, error.__traceback__)
+        finished_stages.put(None)
+
+    def submit(job):
+        pools[resources[job.stage]].apply_async(function, (job,), callback=finished_stages.put,
+                                                error_callback=report_error)
+
+    for job in jobs:
+        submit(job)
+
+    finished_jobs = list()
+    remaining = len(jobs)
+    try:
+        while remaining > 0:
+            job = finished_stages.get()
+            if job is not None and job.stage < len(resources):
+                submit(job)
+            else:
+                remaining -= 1
+                if job is not None:
+                    finished_jobs.append(job)
+    except BaseException:
+        for pool in pools.values():
+            pool.terminate()
+        raise
+
+    for pool in pools.values():
+        pool.close()
+        pool.join()
+
+    return finished_jobs
@@ -0,0 +1,147 @@
+"""Records fingerprints of the inputs of the prediction steps
+
+The fingerprint of a prediction step is a hash of everything its results
+depend on: the fingerprint of the previous step, the code of the step's module
+and of the modules of its package it uses, the data files listed in its
+optional 'DATA_FILES' list (paths relative to the module, like the CNN
+checkpoint) and the values the step returns from its optional
+'get_fingerprint(paths)' function, like the threshold of the map. The
+fingerprint of the first step additionally depends on the input map.
+
+Since every fingerprint includes the fingerprint of the previous step, all
+steps after a step whose inputs changed get new fingerprints as well. The
+fingerprints of the finished steps of a protein are stored in a manifest file
+in its output directory, so a step only has to be executed again if its
+fingerprint does not match the one in the manifest.
+"""
+
+import hashlib
+import inspect
+import json
+import os
+import sys
+
+MANIFEST_FILE = 'manifest.json'
+
+# Hashes are computed once per process, files are identified by their path,
+# size and modification time
+_file_hashes = dict()
+_step_hashes = dict()
+
+
+def hash_file(file_name):
+    """Returns SHA-256 hash of the content of the file"""
+    stat = os.stat(file_name)
+    key = (os.path.abspath(file_name), stat.st_size, stat.st_mtime_ns)
+    if key not in _file_hashes:
+        file_hash = hashlib.sha256()
+        with open(file_name, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                file_hash.update(block)
+
+        _file_hashes[key] = file_hash.hexdigest()
+
+    return _file_hashes[key]
+
+
+def hash_step(prediction_step):
+    """Returns hash of the code and data files of the prediction step"""
+    if prediction_step.__name__ not in _step_hashes:
+        directory = os.path.dirname(os.path.abspath(prediction_step.__file__))
+        file_names = get_source_files(prediction_step, prediction_step.__name__.split('.')[0], set())
+        for data_file in getattr(prediction_step, 'DATA_FILES', []):
+            path = os.path.join(directory, data_file)
+            if os.path.isdir(path):
+                for root, directories, names in os.walk(path):
+                    file_names.update(os.path.join(root, name) for name in names)
+            else:
+                file_names.add(path)
+
+        step_hash = hashlib.sha256()
+        for file_name in sorted(file_names):
+            step_hash.update(os.path.relpath(file_name, directory).encode())
+            step_hash.update(hash_file(file_name).encode())
+
+        _step_hashes[prediction_step.__name__] = step_hash.hexdigest()
+
+    return _step_hashes[prediction_step.__name__]
+
+
+def get_source_files(module, package, file_names):
+    """Adds the file of the module and of all modules of the package it uses,
+    directly or through other modules of the package, to 'file_names' and
+    returns it"""
+    file_name = os.path.abspath(module.__file__)
+    if file_name in file_names:
+        return file_names
+
+    file_names.add(file_name)
+    for value in vars(module).values():
+        if inspect.ismodule(value):
+            dependency = value
+        elif isinstance(getattr(value, '__module__', None), str):
+            dependency = sys.modules.get(value.__module__)
+        else:
+            continue
+
+        if (dependency is not None and dependency.__name__.startswith(package + '.')
+                and getattr(dependency, '__file__', None) is not None):
+            get_source_files(dependency, package, file_names)
+
+    return file_names
+
+
+def get_fingerprint(prediction_step, paths, previous_fingerprint):
+    """Returns fingerprint of the prediction step
+
+    Parameters
+    ----------
+    prediction_step: module
+        Prediction step whose paths have already been updated
+
+    paths: dict
+        Paths and options of the prediction
+
+    previous_fingerprint: str
+        Fingerprint of the previous prediction step, or of the input map for
+        the first step
+    """
+    fingerprint = hashlib.sha256()
+    fingerprint.update(previous_fingerprint.encode())
+    fingerprint.update(prediction_step.__name__.encode())
+    fingerprint.update(hash_step(prediction_step).encode())
+    if hasattr(prediction_step, 'get_fingerprint'):
+        fingerprint.update(json.dumps(prediction_step.get_fingerprint(paths), sort_keys=True).encode())
+
+    return fingerprint.hexdigest()
+
+
+def is_cached(manifest_file, step_name, fingerprint):
+    """Checks if the results of the step were created with the fingerprint"""
+    return read_manifest(manifest_file).get(step_name) == fingerprint
+
+
+def record(manifest_file, step_name, fingerprint):
+    """Stores fingerprint of the step in the manifest, or removes the step
+    from the manifest if the fingerprint is None"""
+    manifest = read_manifest(manifest_file)
+    if fingerprint is None:
+        if step_name not in manifest:
+            return
+        manifest.pop(step_name)
+    else:
+        manifest[step_name] = fingerprint
+
+    # Replace the manifest at once, so it is never read half written
+    with open(manifest_file + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+
+def read_manifest(manifest_file):
+    """Returns dict from step names to fingerprints of the manifest file"""
+    if not os.path.isfile(manifest_file):
+        return dict()
+
+    with open(manifest_file) as f:
+        return json.load(f)
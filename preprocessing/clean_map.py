@@ -14,12 +14,24 @@ from shutil import copyfile
 import json
 
 
+RESOURCE_CLASS = 'chimera'
+
+# Files the step copies into its output, relative to this module
+DATA_FILES = ['bounding_box.ent']
+
+
 def update_paths(paths):
     paths['cleaned_map'] = paths['output'] + 'cleaned_map.mrc'
     paths['bounding_box'] = paths['output'] + 'bounding_box.ent'
     paths['bounding_box_centered'] = paths['output'] + 'bounding_box_centered.ent'
 
 
+def get_fingerprint(paths):
+    """Returns the hide dust values the cleaning depends on besides the input
+    map, see 'prediction.stage_cache'"""
+    return get_hidedust(paths)
+
+
 def execute(paths):
     """Creates the cleaning and re-sampling script and passes it to chimera
 
@@ -34,13 +46,10 @@ def execute(paths):
 
     chimera_script = open(paths['output'] + 'resample.cmd', 'w')
 
-    if 'hidedusts_file' in paths:
-        emdb_id = paths['input'].split('/')[-2]
-        with open(paths['hidedusts_file']) as f:
-            hidedusts = json.load(f)
+    hidedust = get_hidedust(paths)
 
-    if 'hidedusts_file' in paths and emdb_id in hidedusts:
-        level, hidedust_size = hidedusts[emdb_id]
+    if hidedust is not None:
+        level, hidedust_size = hidedust
 
         chimera_script.write('open ' + paths['input'] + '\n'
                          'cofr models\n'
@@ -84,4 +93,18 @@ def execute(paths):
 
     os.remove(chimera_script.name)
 
+
+def get_hidedust(paths):
+    """Returns [contour level, hideDust size] of the map from the hide dusts
+    file or None if none are provided"""
+    if 'hidedusts_file' in paths:
+        emdb_id = paths['input'].split('/')[-2]
+        with open(paths['hidedusts_file']) as f:
+            hidedusts = json.load(f)
+
+        if emdb_id in hidedusts:
+            return hidedusts[emdb_id]
+
+    return None
+
 # Removing the function, as the chimera link parameter should handle the symbolic link.
\ No newline at end of file
@@ -24,10 +24,19 @@ import numpy as np
 __author__ = 'Jonas Pfab'
 
 
+RESOURCE_CLASS = 'chimera'
+
+
 def update_paths(paths):
     paths['threshold'] = paths['output'] + 'threshold'
 
 
+def get_fingerprint(paths):
+    """Returns the threshold value provided by the user, on which this and
+    all following steps depend, see 'prediction.stage_cache'"""
+    return get_provided_threshold(paths)
+
+
 def execute(paths):
     """Finds threshold level and writes it to threshold file if no threshold
     level was provided by the user"""
@@ -115,12 +124,17 @@ def parse_sav(output):
 
 def is_threshold_provided(paths):
     """Checks if threshold value is already provided by user"""
+    return get_provided_threshold(paths) is not None
+
+
+def get_provided_threshold(paths):
+    """Returns threshold value provided by user or None"""
     if 'thresholds_file' in paths:
         emdb_id = paths['input'].split('/')[-2]
         with open(paths['thresholds_file']) as f:
             thresholds = json.load(f)
 
         if emdb_id in thresholds:
-            return True
+            return thresholds[emdb_id]
 
-    return False
+    return None
@@ -5,6 +5,9 @@ import mrcfile
 import json
 
 
+RESOURCE_CLASS = 'cpu'
+
+
 def update_paths(paths):
     paths['normalized_map'] = paths['output'] + 'normalized_map.mrc'
 